@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+'''
+Planner benchmarks - times parsing and dry-run planning for synthetic
+pipelines and records the memory high-water mark for each one.
+
+Usage: planner.py {options} {case1 case2...}
+
+Cases (default: all of them):
+    wide     N samples through M chained rules
+    deep     one sample through a long chain of rules
+    fanin    N samples merged into one output
+    loops    targets defined in "#$ for" loops with @{} lists
+    include  a pipeline that includes a large library of files
+
+Options:
+    -scale N       Size multiplier for the synthetic pipelines (default: 1)
+    -repeat N      Number of times to run each case (default: 3)
+    -runner name   Dry-run runner to use, may be given more than once
+                   (default: sge and slurm)
+    -o fname       Write the results (JSON) to this file (default: stdout)
+    -compare fname Compare the results to an earlier run and print the
+                   ratios (new / old) to stderr
+
+Each case is run in a new process, so the memory numbers (ru_maxrss) are
+for that case alone. Nothing is submitted: the runners are all run with
+dryrun=True.
+
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import datetime
+import resource
+import platform
+import subprocess
+
+try:
+    import mvpipe
+except:
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+    import mvpipe
+
+import mvpipe.logger
+import mvpipe.runner.sge
+import mvpipe.runner.slurm
+
+_runners = {
+    'sge': mvpipe.runner.sge.SGERunner,
+    'slurm': mvpipe.runner.slurm.SlurmRunner,
+}
+
+_rule = '''\
+%%.r%(k)s: ${1}.r%(j)s
+    #$ job.procs = %(procs)s
+    #$ job.mem = %(mem)sG
+    #$ job.walltime = 1:00:00
+    step%(k)s --threads ${job.procs} -i $< -o $>
+    echo "${1} done with r%(k)s"
+
+'''
+
+
+def _samples(n):
+    return ['s%s' % (i + 1) for i in xrange(n)]
+
+
+def _chain(rules):
+    src = ''
+    for k in xrange(1, rules + 1):
+        src += _rule % {'k': k, 'j': k - 1, 'procs': (k % 4) + 1, 'mem': (k % 8) + 1}
+    return src
+
+
+def case_wide(scale):
+    samples = _samples(100 * scale)
+    src = '#$ samples = %s\n' % ' '.join(samples)
+    src += 'all: @{samples}.r10\n\n'
+    src += _chain(10)
+    return src, {}, ['%s.r0' % s for s in samples]
+
+
+def case_deep(scale):
+    depth = 200 * scale
+    src = 'all: s1.r%s\n\n' % depth
+    src += _chain(depth)
+    return src, {}, ['s1.r0']
+
+
+def case_fanin(scale):
+    samples = _samples(500 * scale)
+    src = '#$ samples = %s\n' % ' '.join(samples)
+    src += 'merged.txt: @{samples}.r2\n'
+    src += '    #$ job.mem = 16G\n'
+    src += '    merge $< > $>\n\n'
+    src += _chain(2)
+    return src, {}, ['%s.r0' % s for s in samples]
+
+
+def case_loops(scale):
+    n = 100 * scale
+    src = '#$ num = %s\n' % n
+    src += 'all: out.@{1..${num}}.txt\n'
+    src += '    cat $< > $>\n\n'
+    src += '#$ for i in 1..${num}\n'
+    src += '#$ if ${i} > 1\n'
+    src += '#$ job.procs = 2\n'
+    src += '#$ endif\n\n'
+    src += 'out.${i}.txt: in.${i}.txt part.${i}.@{1..4}.txt\n'
+    src += '    cat $< > $>\n'
+    src += '    # parts: @{1..4}\n\n'
+    src += 'part.${i}.@{1..4}.txt: in.${i}.txt\n'
+    src += '    split -n 4 $< part.${i}.\n\n'
+    src += '#$ done\n'
+    return src, {}, ['in.%s.txt' % (i + 1) for i in xrange(n)]
+
+
+def case_include(scale):
+    # a small pipeline on top of a large library of variables and rules, in
+    # nested include files (like examples/Pipeline.incl)
+    files = 20 * scale
+    lib = {}
+    for i in xrange(files):
+        src = ''
+        if i + 1 < files:
+            src += '#$ include "lib.%s"\n' % (i + 1)
+        for j in xrange(20):
+            src += '#$ lib%s_var%s = value%s\n' % (i, j, j)
+        src += '#$ if ${lib%s_var0} == value0\n' % i
+        src += '#$ lib%s_ok = T\n' % i
+        src += '#$ endif\n\n'
+        src += '%%.lib%s: ${1}.txt\n' % i
+        src += '    tool%s ${lib%s_var1} $< > $>\n\n' % (i, i)
+        lib['lib.%s' % i] = src
+
+    samples = _samples(10 * scale)
+    src = '#$ samples = %s\n' % ' '.join(samples)
+    src += 'all: @{samples}.lib%s\n\n' % (files - 1)
+    src += '#$ include "lib.0"\n'
+    return src, lib, ['%s.txt' % s for s in samples]
+
+
+_cases = [('wide', case_wide), ('deep', case_deep), ('fanin', case_fanin), ('loops', case_loops), ('include', case_include)]
+
+
+def run_case(name, runner_name, scale):
+    '''
+    Runs one case (in this process) and returns the results
+    '''
+    src, lib, inputs = dict(_cases)[name](scale)
+
+    tmpdir = tempfile.mkdtemp(prefix='mvpipe-bench.')
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    try:
+        os.chdir(tmpdir)
+        with open('Pipeline', 'w') as f:
+            f.write(src)
+        for fname in lib:
+            with open(fname, 'w') as f:
+                f.write(lib[fname])
+        for fname in inputs:
+            open(fname, 'w').close()
+
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # dry-run job scripts are written to stdout
+        sys.stdout = open(os.devnull, 'w')
+
+        start = time.time()
+        log = mvpipe.logger.FileLogger('bench.log')
+        runner_inst = _runners[runner_name](dryrun=True, verbose=False, logger=log)
+        loader = mvpipe.PipelineLoader({}, runner_inst=runner_inst, logger=log, dryrun=True)
+        loader.load_file('Pipeline')
+        parsed = time.time()
+
+        loader.build(None)
+        loader.close()
+        built = time.time()
+
+        sys.stdout.close()
+        sys.stdout = stdout
+
+        return {
+            'case': name,
+            'runner': runner_name,
+            'scale': scale,
+            'jobs': len(loader.graph),
+            'parse_secs': round(parsed - start, 4),
+            'build_secs': round(built - parsed, 4),
+            'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'maxrss_start_kb': rss_start,
+        }
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def run_child(name, runner_name, scale):
+    '''
+    Runs one case in a new process
+    '''
+    proc = subprocess.Popen([sys.executable, os.path.realpath(__file__), '-child', name, runner_name, str(scale)], stdout=subprocess.PIPE)
+    out, _ = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError('Benchmark failed: %s (%s)' % (name, runner_name))
+    return json.loads(out)
+
+
+def _median(vals):
+    vals = sorted(vals)
+    mid = len(vals) / 2
+    if len(vals) % 2:
+        return vals[mid]
+    return (vals[mid - 1] + vals[mid]) / 2.0
+
+
+def summarize(runs):
+    out = dict(runs[0])
+    for k in ['parse_secs', 'build_secs', 'maxrss_kb']:
+        vals = [r[k] for r in runs]
+        out[k] = _median(vals)
+        out['%s_min' % k] = min(vals)
+        out['%s_max' % k] = max(vals)
+    out['repeat'] = len(runs)
+    return out
+
+
+def _version():
+    try:
+        proc = subprocess.Popen(['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.realpath(__file__)))
+        out, _ = proc.communicate()
+        if proc.returncode == 0:
+            return out.strip()
+    except OSError:
+        pass
+    return None
+
+
+def compare(results, fname):
+    with open(fname) as f:
+        old = dict([((r['case'], r['runner'], r['scale']), r) for r in json.load(f)['results']])
+
+    sys.stderr.write('case\trunner\tscale\tparse\tbuild\tmaxrss\n')
+    for r in results:
+        key = (r['case'], r['runner'], r['scale'])
+        if not key in old:
+            continue
+        ratios = []
+        for k in ['parse_secs', 'build_secs', 'maxrss_kb']:
+            if old[key][k]:
+                ratios.append('%.2f' % (float(r[k]) / old[key][k]))
+            else:
+                ratios.append('-')
+        sys.stderr.write('%s\t%s\t%s\t%s\n' % (key[0], key[1], key[2], '\t'.join(ratios)))
+
+
+def usage(msg=None):
+    if msg:
+        sys.stderr.write('%s\n' % msg)
+    sys.stderr.write(__doc__)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '-child':
+        print json.dumps(run_case(sys.argv[2], sys.argv[3], int(sys.argv[4])))
+        sys.exit(0)
+
+    scale = 1
+    repeat = 3
+    runners = []
+    outname = None
+    compare_fname = None
+    cases = []
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-scale':
+            scale = int(arg)
+            last = None
+        elif last == '-repeat':
+            repeat = int(arg)
+            last = None
+        elif last == '-runner':
+            if not arg in _runners:
+                usage('Unknown runner: %s' % arg)
+            runners.append(arg)
+            last = None
+        elif last == '-o':
+            outname = arg
+            last = None
+        elif last == '-compare':
+            compare_fname = arg
+            last = None
+        elif arg in ['-h', '-help', '--help']:
+            usage()
+        elif arg in ['-scale', '-repeat', '-runner', '-o', '-compare']:
+            last = arg
+        elif arg in dict(_cases):
+            cases.append(arg)
+        else:
+            usage('Unknown argument: %s' % arg)
+
+    if not cases:
+        cases = [x[0] for x in _cases]
+    if not runners:
+        runners = ['sge', 'slurm']
+
+    results = []
+    for name in cases:
+        for runner_name in runners:
+            runs = [run_child(name, runner_name, scale) for i in xrange(repeat)]
+            r = summarize(runs)
+            sys.stderr.write('%s\t%s\t%s jobs\tparse: %.3fs\tbuild: %.3fs\tmaxrss: %sK\n' % (name, runner_name, r['jobs'], r['parse_secs'], r['build_secs'], r['maxrss_kb']))
+            results.append(r)
+
+    doc = {
+        'version': _version(),
+        'python': platform.python_version(),
+        'host': socket.gethostname(),
+        'date': datetime.datetime.now().isoformat(),
+        'results': results,
+    }
+
+    if outname:
+        with open(outname, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        print json.dumps(doc, indent=2, sort_keys=True)
+
+    if compare_fname:
+        compare(results, compare_fname)
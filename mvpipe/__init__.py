@@ -3,16 +3,23 @@ import sys
 import stat
 import tempfile
 import subprocess
+import multiprocessing.pool
 
 import context
+import directives
 import support
 import logger
 import runner
 import config
+import shellcache
+import targetindex
+import manifest
+import state
+import pipecache
 
 def parse(fname, args, logfile=None, outfile=None, dryrun=False, verbose=False, **kwargs):
     config_args = config.load_config(args)
-    log_inst = logger.FileLogger(logfile)
+    log_inst = logger.FileLogger(logfile, **config.config_prefix('mvpipe.log.'))
 
     runner_inst = config.get_runner(dryrun, verbose, log_inst)
     loader_config = config.config_prefix('mvpipe.loader.')
@@ -22,7 +29,7 @@ def parse(fname, args, logfile=None, outfile=None, dryrun=False, verbose=False,
             kwargs[k] = loader_config[k]
 
     loader = PipelineLoader(config_args, runner_inst=runner_inst, logger=log_inst, outfile=outfile, dryrun=dryrun, verbose=verbose, **kwargs)
-    loader.load_file(fname)
+    loader.load(fname)
     return loader
 
 
@@ -31,10 +38,22 @@ class ParseError(Exception):
         Exception.__init__(self, s)
         self.parent = parent
 
+        # set to the line that caused the error
+        self.lineno = None
+        self.line = None
+
+
+class JobCheckError(ParseError):
+    '''
+    The job runner couldn't check the status of existing jobs
+    '''
+    pass
+
 
 class PipelineLoader(object):
-    def __init__(self, args, runner_inst, logger=None, dryrun=False, verbose=False, libpath=None, outfile=None):
-        self.context = context.RootContext(None, args, loader=self, verbose=verbose)
+    def __init__(self, args, runner_inst, logger=None, dryrun=False, verbose=False, libpath=None, outfile=None, shell_cache=None, shell_cache_ttl=3600, shell_cache_env=None, shell_threads=4, stat_threads=4, submit_threads=4, rebuild=None, order=None, pipeline_cache=None, pipeline_cache_ttl=3600, pipeline_cache_env=None):
+        self.args = args
+        self.context = context.RootContext(args, loader=self, verbose=verbose)
         self.verbose = verbose
         self.dryrun = dryrun
         self.paths = []
@@ -42,27 +61,76 @@ class PipelineLoader(object):
         self.logger = logger
         self.output_jobs = {}
         self.pending_jobs = {}
+        self.graph = runner.JobGraph()
         self.runner_inst = runner_inst
         self.is_setup = False
+        self._target_index = None
+        self.stat_cache = support.StatCache(stat_threads)
+        self.shell_cache = shellcache.ShellCache(shell_cache, shell_cache_ttl, shell_cache_env, shell_threads, log=self.log)
+
+        # parsed pipelines can be cached between runs
+        self.pipeline_cache = None
+        if pipeline_cache:
+            self.pipeline_cache = pipecache.PipelineCache(pipeline_cache, pipeline_cache_ttl, pipeline_cache_env, log=self.log)
+
+        # the files that were loaded (with their hashes) and the log/outfile
+        # directives, so that they can be replayed from the cache
+        self.loaded_files = []
+        self.replay = []
+
+        # independent jobs are submitted at the same time, using up to this
+        # many threads (also limited by the runner's max_submit)
+        self.submit_threads = int(submit_threads)
+        self._submit_pool = None
+
+        # rebuild existing outputs if they are out of date:
+        #   mtime  - an input is newer than the output
+        #   strict - also if the recipe or an input's contents changed
+        #            (requires an outfile for the manifest)
+        self.rebuild = rebuild
+        self.manifest = None
+
+        # the order to submit jobs in (and the priorities to give them), see
+        # runner.JobGraph.priorities
+        if order and not order in runner.ORDERS:
+            raise ParseError('Unknown submission order: %s' % order)
+        self.order = order
+
+        # set to a timing.Profiler to write a timing report when closed
+        self.profiler = None
 
         self._outfile = None
-        self.outfile_jobids = {}
+        self.state = None
+        self._valid_jobids = {}
         if outfile:
             self.set_outfile(outfile)
 
     def close(self):
+        self._close_submit_pool()
         self.runner_inst.done()
         self.teardown()
+        self.shell_cache.close()
+        if self.manifest:
+            self.manifest.save()
+        if self.state:
+            self.state.close()
+
+        if self.profiler:
+            self.profiler.report(lambda msg: self.log(msg, True))
 
         if self.logger:
             self.logger.close()
 
     def abort(self):
+        self._close_submit_pool()
         self.runner_inst.abort()
+        if self.state:
+            self.state.close()
         if self.logger:
             self.logger.close()
 
     def set_log(self, fname):
+        self.replay.append(('log', fname))
         if self.logger:
             if not os.path.exists(os.path.dirname(fname)):
                 self.log('Creating directory: %s' % os.path.dirname(fname))
@@ -70,38 +138,69 @@ class PipelineLoader(object):
 
             self.logger.set_fname(fname)
 
-    def write_outfile(self, outfile, jobid):
-        if self._outfile:
-            with open(self._outfile, 'a') as f:
-                f.write('%s\t%s\n' % (outfile, jobid))
+    def write_outfile(self, outfile, jobid, script=None):
+        if self.state:
+            self.state.record(outfile, jobid, self.runner_inst.name, script)
 
     def set_outfile(self, fname):
         self.log("Setting output-file: %s" % fname)
+        self.replay.append(('outfile', fname))
+        if self.state:
+            self.state.close()
+
         self._outfile = fname
-        self.outfile_jobids = {}
+        if self.rebuild == 'strict':
+            self.manifest = manifest.Manifest('%s.manifest' % fname)
         if not os.path.exists(os.path.dirname(fname)):
             self.log('Creating directory: %s' % os.path.dirname(fname))
             os.makedirs(os.path.dirname(fname))
-        if not os.path.exists(fname):
-            f = open(fname, 'w')
-            f.close()
-            return
 
-        with open(fname) as f:
-            for line in f:
-                cols = line.strip('\n').split('\t')
-                self.outfile_jobids[cols[0]] = cols[1]
-
-        # rewrite the outlog to remove duplicates...
-        # 
-        # ON SECOND THOUGHT - KEEP THE DUPLICATES FOR BETTER LOGGING
-        #with open(fname, 'w') as f:
-        #    for k in self.outfile_jobids:
-        #        f.write('%s\t%s\n' % (k, self.outfile_jobids[k]))
-
-    def log(self, msg, stderr=False):
+        # an existing tab-delimited outfile is imported the first time
+        self.state = state.open_store(fname)
+
+    def check_jobid(self, jobid):
+        '''
+        Checks if a job from the outfile is still valid. The first time this
+        is called, all of the jobs in the outfile that might still be valid
+        are checked with one bulk query, and the results are kept for the
+        life of the loader (and saved in the state store). If the query
+        fails, a JobCheckError is raised and nothing is saved.
+        '''
+        if not jobid in self._valid_jobids:
+            if self.state and self.state.status(jobid) == 'invalid':
+                # jobs that were invalid don't come back
+                self._valid_jobids[jobid] = False
+                return False
+
+            jobids = set(self.state.active_jobids()) if self.state else set()
+            jobids.add(jobid)
+            jobids.difference_update(self._valid_jobids)
+            self.log('Checking the status of %s existing job(s)' % len(jobids))
+            try:
+                valid = self.runner_inst.check_jobids(sorted(jobids))
+            except RuntimeError, e:
+                # nothing is recorded, so the jobs are checked again next time
+                self.log('ERROR: %s' % e, True, logger.ERROR)
+                raise JobCheckError("Can't check the status of existing jobs")
+            self._valid_jobids.update(valid)
+
+            if self.state:
+                for k in valid:
+                    self.state.set_status(k, 'valid' if valid[k] else 'invalid')
+
+        return self._valid_jobids[jobid]
+
+    @property
+    def target_index(self):
+        # targets are only added while parsing, so the index is rebuilt
+        # if any targets were added since it was last built
+        if not self._target_index or self._target_index.size != len(self.context._targets):
+            self._target_index = targetindex.TargetIndex(self.context._targets)
+        return self._target_index
+
+    def log(self, msg, stderr=False, level=logger.INFO):
         if self.logger:
-            self.logger.write(msg)
+            self.logger.write(msg, level)
             if stderr:
                 sys.stderr.write('%s\n' % msg)
         elif self.verbose:
@@ -131,9 +230,11 @@ class PipelineLoader(object):
                 raise ParseError("Error loading file: %s" % fname)
 
             self.log("Loading file: %s" % (os.path.relpath(srcfile)))
+            self.loaded_files.append((os.path.abspath(srcfile), manifest.hash_file(srcfile)))
             f = open(srcfile)
             self.paths.append(os.path.dirname(os.path.abspath(srcfile)))
 
+        lines = []
         for i, line in enumerate(f):
             if not line or not line.strip():
                 continue
@@ -146,7 +247,7 @@ class PipelineLoader(object):
             if line[:2] == '##':
                 continue
 
-            # TODO: find a better way to strip comments from 
+            # TODO: find a better way to strip comments from
             #       the script... maybe...
             # if line[:2] == '#$':
             #     spl = line[2:].split('#')
@@ -155,23 +256,53 @@ class PipelineLoader(object):
             #     if not line:
             #         continue
 
-            try:
-                self.context.parse_line(line)
-            except ParseError, e:
-                self.log('ERROR: %s\n[%s:%s] %s\n\n' % (e, fname, i+1, line), True)
-                f.close()
-                sys.exit(1)
+            lines.append((i+1, line))
 
         f.close()
 
+        # the whole file is compiled first, then run
+        try:
+            directives.run(directives.compile_file(lines), self.context)
+        except ParseError, e:
+            self.log('ERROR: %s\n[%s:%s] %s\n\n' % (e, fname, e.lineno, e.line), True, logger.ERROR)
+            sys.exit(1)
+
         if fname != '-':
             self.paths = self.paths[:-1]
 
+        # the output is echoed once, after the outermost file is loaded
+        # (not again after each include)
+        if not self.paths:
+            self._echo()
+
+    def _echo(self):
         for line in self.context.out:
             self.log(line)
             if line and line[0] == '#':
                 sys.stderr.write('%s\n' % line)
 
+    def load(self, fname):
+        '''
+        Loads a pipeline file, from the pipeline cache if it is enabled and
+        has a valid entry for this file.
+        '''
+        if not self.pipeline_cache or fname == '-':
+            self.load_file(fname)
+            return
+
+        if self.pipeline_cache.restore(self, fname):
+            self._echo()
+            return
+
+        calls = self.shell_cache.calls
+        uncached = self.shell_cache.uncached
+        self.load_file(fname)
+
+        if self.shell_cache.uncached != uncached:
+            self.log('Not caching the pipeline, it has uncached shell-outs')
+        else:
+            self.pipeline_cache.store(self, fname, self.shell_cache.calls != calls)
+
 
     def setup(self):
         for tgt in self.context._targets:
@@ -182,13 +313,7 @@ class PipelineLoader(object):
                         self.log("setup: %s" % line.strip())
 
                 src = '\n'.join(cmd.out)
-                kwargs = {}
-                target_vals = cmd._clonevals()
-                for k in target_vals:
-                    if k[:4] == 'job.':
-                        kwargs[k[4:]] = target_vals[k]
-
-                job = runner.Job(src, **kwargs)
+                job = runner.Job(src, **cmd.args)
                 return job
         return None
                 # if self.dryrun:
@@ -206,13 +331,7 @@ class PipelineLoader(object):
                         self.log("teardown: %s" % line.strip())
 
                 src = '\n'.join(cmd.out)
-                kwargs = {}
-                target_vals = cmd._clonevals()
-                for k in target_vals:
-                    if k[:4] == 'job.':
-                        kwargs[k[4:]] = target_vals[k]
-
-                job = runner.Job(src, **kwargs)
+                job = runner.Job(src, **cmd.args)
                 return job
         return None
 
@@ -224,7 +343,7 @@ class PipelineLoader(object):
     def run_script(self, script):
         shell = config.get_shell()
         if not shell:
-            self.log("ERROR: MISSING SHELL")
+            self.log("ERROR: MISSING SHELL", level=logger.ERROR)
             raise ParseError("Valid shell can't be found! (%s)" % shell)
 
         (fd, fname) = tempfile.mkstemp()
@@ -248,6 +367,7 @@ class PipelineLoader(object):
         self.runner_inst.reset()
         self.missing = []
         self.pending_jobs = {}
+        self.graph = runner.JobGraph()
 
         pre = ''
         post = ''
@@ -266,12 +386,16 @@ class PipelineLoader(object):
         self.log('Attempting to build target: %s' % target)
         self.log('Job runner: %s' % self.runner_inst.name)
 
+        if self.rebuild == 'strict' and not self.manifest:
+            self.log('WARNING: strict rebuild checks need an outfile, only checking timestamps', True, logger.WARNING)
+
         self.log('[State]')
         vals=self.context._clonevals()
         for k in sorted(vals):
             self.log('    %s => %s' % (k,vals[k]))
 
         valid, lastjob = self._build(target, pre, post)
+        self.log('File checks: %s cached, %s from the filesystem' % (self.stat_cache.hits, self.stat_cache.misses))
 
         if valid:
             if type(lastjob) == str:
@@ -282,8 +406,26 @@ class PipelineLoader(object):
                 sys.stderr.write('Nothing to do...\n')
                 self.log('Nothing to do...')
                 return
-            joblist = lastjob.flatten()
-            added = True
+
+            # jobs that were built for a target alternative that didn't work
+            # out are still in the graph, so only keep what lastjob needs
+            graph = self.graph.subgraph(self.graph.ancestors(lastjob))
+            joblist = graph.order()
+            self.log('Build graph: %s job(s), %s root(s), %s leaf job(s)' % (len(graph), len(graph.roots()), len(graph.leaves())))
+
+            # join any outstanding shell-outs before anything is submitted
+            for job in joblist:
+                if type(job) != str:
+                    job.src
+                    if self.manifest:
+                        self.manifest.record(job.outputs, job.inputs, job.src)
+
+            priorities = {}
+            if self.order:
+                priorities = graph.priorities(self.order)
+                for job in priorities:
+                    job.priority = priorities[job]
+                self.log('Submission order: %s' % self.order)
 
             setup_job = self.setup()
             if setup_job:
@@ -292,128 +434,165 @@ class PipelineLoader(object):
                 else:
                     self.runner_inst.submit(setup_job)
 
-            submitted = []
-            while added:
-                added = False
-                for job in joblist:
-                    if job in submitted:
-                        continue
+            submitted = [job for job in joblist if type(job) == str]
 
-                    if type(job) == str:
-                        submitted.append(job)
-                        continue
-
-                    added = True
+            # jobs are submitted a layer at a time, so that the runner can
+            # group jobs that don't depend on each other (job arrays), and
+            # so that they can be submitted concurrently
+            for layer in graph.layers():
+                if priorities:
+                    layer = sorted(layer, key=lambda job: -priorities[job])
 
+                batch = []
+                for job in layer:
                     if job.direct_exec:
                         self.run_script(job.src)
 
                         for out in job.outputs:
                             self.output_jobs[out] = '__direct_exec__'
+                            self.stat_cache.invalidate(out)
 
+                        submitted.append(job)
                     else:
                         if setup_job:
                             job.add_dep(setup_job)
-                        self.runner_inst.submit(job)
-                    
-                    submitted.append(job)
-
-                    if job.jobid:
-                        self.log("Submitted job: %s %s" % (job.jobid, job.name))
-                        if job.outputs:
-                            self.log("      outputs: %s" % ' '.join(job.outputs))
-                        if job.depids:
-                            self.log("     requires: %s" % (','.join(job.depids)))
-
-                        if job.pre: 
-                            for i, line in enumerate(job.pre.split('\n')):
-                                if i == 0:
-                                    self.log("          pre: %s" % line)
-                                else:
-                                    self.log("             : %s" % line)
-                        for i, line in enumerate(job.src.split('\n')):
-                            if i == 0:
-                                self.log("          src: %s" % line)
-                            else:
-                                self.log("             : %s" % line)
-                        if job.post:
-                            for i, line in enumerate(job.post.split('\n')):
-                                if i == 0:
-                                    self.log("         post: %s" % line)
-                                else:
-                                    self.log("             : %s" % line)
+                        batch.append(job)
 
-                        for out in job.outputs:
-                            self.output_jobs[out] = job.jobid
-                            self.write_outfile(out, job.jobid)
+                units = self.runner_inst.coalesce(batch)
+                self._submit_all(units)
+
+                for unit in units:
+                    if isinstance(unit, runner.JobArray):
+                        if unit.jobid:
+                            self.log("Submitted array job: %s %s (%s tasks)" % (unit.jobid, unit.name, len(unit)))
+                        jobs = unit.jobs
+                    else:
+                        jobs = [unit]
+
+                    for job in jobs:
+                        submitted.append(job)
+                        if job.jobid:
+                            self._log_job(job)
+                            if not self.runner_inst.deferred:
+                                job.release()
 
             teardown_job = self.teardown()
             if teardown_job:
                 if teardown_job.direct_exec:
                     self.run_script(teardown_job.src)
                 else:
-                    for job in submitted:
-                        teardown_job.add_dep(job)
+                    teardown_job.add_deps(submitted)
                     self.runner_inst.submit(teardown_job)
 
             if len(submitted) != len(joblist):
-                self.log("WARNING: Didn't submit as many jobs as we had in the build-graph!", True)
-                self.log("Build-list: %s" % ','.join([str(x) for x in joblist]), True)
-                self.log("Submitted : %s" % ','.join([str(x) for x in submitted]), True)
+                self.log("WARNING: Didn't submit as many jobs as we had in the build-graph!", True, logger.WARNING)
+                self.log("Build-list: %s" % ','.join([str(x) for x in joblist]), True, logger.WARNING)
+                self.log("Submitted : %s" % ','.join([str(x) for x in submitted]), True, logger.WARNING)
 
         else:
             if self.missing:
-                self.log("Missing files: %s\n" % ', '.join([str(x) for x in self.missing]), True)
+                self.log("Missing files: %s\n" % ', '.join([str(x) for x in self.missing]), True, logger.ERROR)
 
             raise ParseError("ERROR: Can't build target: %s\n" % target)
 
 
+    def _submit_all(self, units):
+        '''
+        Submits a list of jobs that don't depend on each other. If the runner
+        allows it, the jobs are submitted concurrently.
+        '''
+        threads = min(self.submit_threads, self.runner_inst.max_submit)
+        if threads < 2 or len(units) < 2:
+            for unit in units:
+                self.runner_inst.submit(unit)
+            return
+
+        # the pool is kept for the whole run (starting and joining a pool
+        # for each layer is slow)
+        if not self._submit_pool:
+            self._submit_pool = multiprocessing.pool.ThreadPool(threads)
+
+        results = [self._submit_pool.apply_async(self.runner_inst.submit, (unit,)) for unit in units]
+        # errors from submit() are re-raised here
+        for result in results:
+            result.get()
+
+    def _close_submit_pool(self):
+        if self._submit_pool:
+            self._submit_pool.close()
+            self._submit_pool.join()
+            self._submit_pool = None
+
+    def _log_job(self, job):
+        self.log("Submitted job: %s %s" % (job.jobid, job.name))
+        if job.outputs:
+            self.log("      outputs: %s" % ' '.join(job.outputs))
+        if job.depids:
+            self.log("     requires: %s" % (','.join(job.depids)))
+
+        if job.pre:
+            self._log_script("          pre: ", job.pre)
+        self._log_script("          src: ", job.src)
+        if job.post:
+            self._log_script("         post: ", job.post)
+
+        for out in job.outputs:
+            self.output_jobs[out] = job.jobid
+            self.write_outfile(out, job.jobid, manifest.hash_recipe(job.src))
+
+    def _log_script(self, prefix, src):
+        if self.logger:
+            self.logger.write_script(prefix, src, "             : ")
+        else:
+            for i, line in enumerate(src.split('\n')):
+                self.log('%s%s' % (prefix if i == 0 else "             : ", line))
+
     def _build(self, target, pre, post, indent=0):
         indentstr = ' ' * (indent * 4)
-        self.log('%sTrying to build file: %s' % (indentstr, target))
+        self.log('%sTrying to build file: %s' % (indentstr, target), level=logger.DEBUG)
 
 #        if self.verbose:
 #            sys.stderr.write('Target: %s\n' % target)
 
+        exists = False
         if target:
-            exists = support.target_exists(target)
-            if exists:
-                self.log('%s  - %s exists' % (indentstr, target))
+            exists = support.target_exists(target, self.stat_cache)
+            if exists and not self.rebuild:
+                self.log('%s  - %s exists' % (indentstr, target), level=logger.DEBUG)
                 return True, None
             
             if target in self.output_jobs:
-                self.log('%s  - %s already set to be built (%s)' % (indentstr, target, self.output_jobs[target]))
+                self.log('%s  - %s already set to be built (%s)' % (indentstr, target, self.output_jobs[target]), level=logger.DEBUG)
                 return True, self.output_jobs[target]
 
-            if target in self.outfile_jobids:
-                valid = self.runner_inst.check_jobid(self.outfile_jobids[target])
+            jobid = self.state.get(target) if self.state and not exists else None
+            if jobid:
+                valid = self.check_jobid(jobid)
                 if valid:
-                    self.log('%s - %s already set to be built by existing job (%s)' % (indentstr, target, self.outfile_jobids[target]))
-                    return True, self.outfile_jobids[target]
+                    self.log('%s - %s already set to be built by existing job (%s)' % (indentstr, target, jobid), level=logger.DEBUG)
+                    return True, jobid
                 else:
-                    self.log('%s - %s already set to be built by existing job (%s), but it is no longer valid!' % (indentstr, target, self.outfile_jobids[target]))
+                    self.log('%s - %s already set to be built by existing job (%s), but it is no longer valid!' % (indentstr, target, jobid), level=logger.DEBUG)
 
         target_found = False
         
-        for tgt in self.context._targets:
-            if '__pre__' in tgt.outputs or '__post__' in tgt.outputs:
-                continue
-
-            match, numargs, outputs = tgt.match_target(target)
+        for tgt in self.target_index.candidates(target):
+            match, numargs, outputs, wildcards = tgt.match_target(target)
             if match:
                 target_found = True
                 good_input = True
                 depends = []
 
-                self.log('%s  - found build definition: %s' % (indentstr, tgt))
+                self.log('%s  - found build definition: %s' % (indentstr, tgt), level=logger.DEBUG)
 
-                inputs = [tgt.replace_token(inputstr, numargs) for inputstr in tgt.inputs]
-                self.log('%s  - required inputs: %s' % (indentstr, inputs))
+                inputs = tgt.eval_inputs(numargs, wildcards)
+                self.log('%s  - required inputs: %s' % (indentstr, inputs), level=logger.DEBUG)
+                self.stat_cache.prefetch(inputs)
 
                 try:
                     for inp in inputs:
                         if inp in self.pending_jobs:
-                            self.log('%s  - %s pending' % (indentstr, inp))
+                            self.log('%s  - %s pending' % (indentstr, inp), level=logger.DEBUG)
                             depends.append(self.pending_jobs[inp])
                         else:
                             isvalid, dep = self._build(inp, pre, post, indent+1)
@@ -425,33 +604,73 @@ class PipelineLoader(object):
                             if dep:
                                 depends.append(dep)
 
+                except JobCheckError:
+                    raise
                 except Exception, e:
-                    self.log("%s  ***** Exception: %s" % (indentstr, str(e)))
+                    self.log("%s  ***** Exception: %s" % (indentstr, str(e)), level=logger.DEBUG)
                     good_input = False
                     break
 
                 if good_input:
-                    tcxt = tgt.eval_src(outputs, inputs, numargs)
-                    src = '\n'.join(tcxt.out)
-                    kwargs = {}
-                    target_vals = tcxt._clonevals()
-                    for k in target_vals:
-                        if k[:4] == 'job.':
-                            kwargs[k[4:]] = target_vals[k]
+                    # shell-outs in the body are joined when the job source
+                    # is first needed (see build)
+                    tcxt = tgt.eval_src(outputs, inputs, numargs, wildcards, defer=True)
+                    src = lambda tcxt=tcxt: '\n'.join(tcxt.resolve())
 
-                    job = runner.Job(src, outputs, depends=depends, pre=pre, post=post, **kwargs)
+                    if exists:
+                        reason = self._stale(target, outputs, inputs, depends, src)
+                        if not reason:
+                            self.log('%s  - %s exists (up to date)' % (indentstr, target), level=logger.DEBUG)
+                            return True, None
+                        self.log('%s  - %s exists, but is out of date (%s)' % (indentstr, target, reason), level=logger.DEBUG)
 
-                    self.log('%s  * submitting job' % (indentstr, ))
+                    job = runner.Job(src, outputs, inputs=inputs, depends=depends, pre=pre, post=post, rule=tgt, **tcxt.args)
+                    self.graph.add(job)
+                    for dep in depends:
+                        self.graph.add_dep(job, dep)
+
+                    self.log('%s  * submitting job' % (indentstr, ), level=logger.DEBUG)
 
 
                     for out in outputs:
                         self.pending_jobs[out] = job
+                        self.stat_cache.set_pending(out)
 
                     return True, job
 
                 # look for an alternative target
 
+        if exists:
+            # the file exists, but we can't find a way to rebuild it, so
+            # it must be up to date
+            self.log('%s  - %s exists' % (indentstr, target), level=logger.DEBUG)
+            return True, None
+
         if not target_found:
             self.missing.append(target)
 
         return False, None
+
+    def _stale(self, target, outputs, inputs, depends, src):
+        '''
+        Returns the reason that an existing target needs to be rebuilt, or
+        None if it is up to date.
+        '''
+        if depends:
+            return 'inputs will be rebuilt'
+
+        newer = manifest.newer_input(target, inputs)
+        if newer:
+            return 'input is newer: %s' % newer
+
+        if self.rebuild == 'strict' and self.manifest:
+            src = src()
+            changed = self.manifest.changed(target, inputs, src)
+            if changed:
+                return changed
+
+            # fill in any input hashes that weren't known when the
+            # target was scheduled
+            self.manifest.record(outputs, inputs, src)
+
+        return None
@@ -2,6 +2,8 @@ import os
 import support
 import runner
 import runner.bash
+import runner.ninja
+import runner.local
 import runner.sge
 try:
     import runner.sjqrunner
@@ -10,6 +12,7 @@ except:
     NOSJQ=True
     pass
 import runner.slurm
+import runner.slurmrest
 import socket
 
 CONFIG_FILE=os.path.expanduser("~/.mvpiperc")
@@ -97,6 +100,12 @@ def get_runner(dryrun=False, verbose=False, logger=None, global_hold=None):
     if cfg['mvpipe.runner'] == 'bash':
         return runner.bash.BashRunner(dryrun=dryrun, verbose=verbose, logger=logger, **config_prefix('mvpipe.runner.bash.'))
 
+    if cfg['mvpipe.runner'] == 'local':
+        return runner.local.LocalRunner(dryrun=dryrun, verbose=verbose, logger=logger, **config_prefix('mvpipe.runner.local.'))
+
+    if cfg['mvpipe.runner'] == 'ninja':
+        return runner.ninja.NinjaRunner(dryrun=dryrun, verbose=verbose, logger=logger, **config_prefix('mvpipe.runner.ninja.'))
+
     if cfg['mvpipe.runner'] == 'sjq':
         if NOSJQ:
             raise ConfigError("Cannot load SJQ job runner")
@@ -114,4 +123,11 @@ def get_runner(dryrun=False, verbose=False, logger=None, global_hold=None):
 
         return runner.slurm.SlurmRunner(dryrun=dryrun, verbose=verbose, logger=logger, **runnercfg)
 
+    if cfg['mvpipe.runner'] == 'slurmrest':
+        runnercfg = config_prefix('mvpipe.runner.slurmrest.')
+        if global_hold is not None:
+            runnercfg['global_hold'] = global_hold
+
+        return runner.slurmrest.SlurmRestRunner(dryrun=dryrun, verbose=verbose, logger=logger, **runnercfg)
+
     raise ConfigError("Cannot load job runner: %s" % cfg['mvpipe.runner'])
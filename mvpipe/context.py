@@ -1,498 +1,305 @@
 import os
-import re
-import subprocess
 import sys
+import weakref
 
-import ops
+import template
+import directives
+import shellcache
+import targetindex
 import mvpipe
 import mvpipe.runner
 
-class ExecContext(object):
-    def __init__(self, parent=None, initvals=None, verbose=False):
-        self.parent = parent
-        if parent:
-            self.level = parent.level + 1
-            self.verbose = parent.verbose
-        else:            
-            self.verbose = verbose
+# the number of snapshots a scope can be layered over before they are
+# merged into one
+MAX_DEPTH = 16
 
-        self.child = None
-        self._values = {}
 
-        self._var_numargs = None
-        self._var_outputs = None
-        self._var_inputs = None
+class _Unset(object):
+    '''
+    Marks a variable that was unset in a scope, but is still set in its base
+    '''
 
-        self.test = True
 
-        if initvals:
-            for k in initvals:
-                self._values[k] = initvals[k]
+class _Prefix(object):
+    '''
+    A list in a frozen scope: the first size items of a list that may still
+    be appended to. The first scope to append to the list after it was frozen
+    keeps appending to it in place (see Scope.append); any other scope copies
+    the prefix.
+    '''
+    __slots__ = ['items', 'size']
 
-    def __repr__(self):
-        return '<%s:%s>' % (self.__class__.__name__, self.level)
+    def __init__(self, items, size):
+        self.items = items
+        self.size = size
 
-    @property
-    def var_outputs(self):
-        if self._var_outputs:
-            return self._var_outputs
-        elif self.parent:
-            return self.parent.var_outputs
-        return None
+    def __repr__(self):
+        return repr(self.get())
 
-    @property
-    def var_inputs(self):
-        if self._var_inputs:
-            return self._var_inputs
-        elif self.parent:
-            return self.parent.var_inputs
-        return None
+    def get(self):
+        return self.items[:self.size]
 
-    @property
-    def var_numargs(self):
-        if self._var_numargs:
-            return self._var_numargs
-        elif self.parent:
-            return self.parent.var_numargs
-        return None
 
-    @property
-    def root(self):
-        if self.parent:
-            return self.parent.root
-        return self
+class Scope(object):
+    '''
+    A set of variables that can be captured cheaply. The values set in a
+    scope are kept in a dict, layered over a (frozen) base scope.
 
-    @property
-    def active(self):
-        if not self.test:
-            return False
+    snapshot() freezes the values that were set since the last snapshot into
+    a new layer, which is shared by the snapshot and the scope. So capturing
+    a scope only costs as much as the number of values that have changed,
+    and nothing if none of them have. Frozen layers are never changed (but
+    they can be the base for other scopes).
 
-        if self.parent:
-            return self.parent.active
-        return True
+    Lists aren't copied when they are frozen, or when they are appended to
+    afterwards (a frozen layer only sees the items the list had when it was
+    frozen), so appending to a list between snapshots doesn't copy it.
+    '''
+    __slots__ = ['vals', 'base', 'depth']
 
-    @property
-    def lastchild(self):
-        if self.child:
-            return self.child.lastchild
-        return self
+    def __init__(self, vals=None, base=None):
+        self.vals = vals if vals is not None else {}
+        self.base = base
+        self.depth = base.depth + 1 if base is not None else 0
 
-    def get(self, k):
-        if k in self._values:
-            return self._values[k]
-
-        if self.parent:
-            return self.parent.get(k)
-
-        if k in os.environ:
-            return os.environ[k]
+    def __repr__(self):
+        return '<Scope:%s %s>' % (self.depth, self.vals)
+
+    def _find(self, k):
+        # returns the scope where k is set (or None)
+        scope = self
+        while scope is not None:
+            if k in scope.vals:
+                return scope
+            scope = scope.base
         return None
 
-    def _contains_append(self, k, v):
-        if k in self._values:
-            if type(self._values[k]) == list:
-                self._values[k].append(v)
-            else:
-                self._values[k] = [self._values[k],v]
+    def get(self, k, default=None):
+        scope = self._find(k)
+        if scope is None:
+            return default
 
-            return True
+        val = scope.vals[k]
+        if val is _Unset:
+            return default
+        if type(val) == _Prefix:
+            # the frozen list is copied once, when it is first read
+            val = scope.vals[k] = val.get()
+        return val
 
-        if self.parent:
-            return self.parent._contains_append(k,v)
+    def __contains__(self, k):
+        scope = self._find(k)
+        return scope is not None and scope.vals[k] is not _Unset
 
-    def _contains_set(self, k, v):
-        if k in self._values:
-            self._values[k] = v
-            return True
-        if self.parent:
-            return self.parent._contains_set(k,v)
-        return False
+    def __getitem__(self, k):
+        val = self.get(k, _Unset)
+        if val is _Unset:
+            raise KeyError(k)
+        return val
 
-    def contains(self, k):
-        if k in self._values:
-            return True
-        if self.parent:
-            return self.parent.contains(k)
-        return False
-
-    def set(self, k, v):
-        if not self._contains_set(k, v):
-            self._values[k] = v
-
-    def set_ine(self, k, v):
-        # set the value if it doesn't already exist
-        # (allows for defaults to be given on command-line)
-        if not self.contains(k):
-            self._values[k] = v
+    def __setitem__(self, k, v):
+        self.vals[k] = v
 
     def append(self, k, v):
-        if not self._contains_append(k, v):
-            self._values[k] = [v,]
-
-    def unset(self, k):
-        if k in self._values:
-            del self._values[k]
-        elif self.parent:
-            self.parent.unset(k)
-
-    def _clonevals(self):
-        vals = {}
-        for k in self._values:
-            vals[k] = self._values[k]
-
-        if self.parent:
-            pvals = self.parent._clonevals()
-            for k in pvals:
-                vals[k] = pvals[k]
+        '''
+        Appends a value to a list (a value that isn't a list becomes one)
+        '''
+        val = self.vals.get(k)
+        if type(val) == list:
+            val.append(v)
+            return
+
+        scope = self._find(k)
+        val = scope.vals[k] if scope is not None else _Unset
+        if type(val) == _Prefix and len(val.items) == val.size:
+            # nothing was appended to the list since it was frozen, so this
+            # scope can keep appending to it
+            val.items.append(v)
+            self.vals[k] = val.items
+        elif type(val) == _Prefix:
+            self.vals[k] = val.get() + [v]
+        elif type(val) == list:
+            self.vals[k] = val + [v]
+        elif val is _Unset:
+            self.vals[k] = [v]
+        else:
+            self.vals[k] = [val, v]
 
+    def __delitem__(self, k):
+        if self.base is not None and k in self.base:
+            self.vals[k] = _Unset
+        else:
+            del self.vals[k]
+
+    def flatten(self, frozen=False):
+        '''
+        Returns all of the values in the scope as a new dict. If frozen is
+        set, frozen lists are kept as they are (for merging frozen layers).
+        '''
+        if self.base is None:
+            vals = {}
+        else:
+            vals = self.base.flatten(frozen)
+
+        for k in self.vals:
+            val = self.vals[k]
+            if val is _Unset:
+                vals.pop(k, None)
+            elif type(val) == _Prefix and not frozen:
+                vals[k] = val.get()
+            else:
+                vals[k] = val
         return vals
 
-    def parse_line(self, line):
-        if self.child:
-            return self.child.parse_line(line)
-
-        if not self.eval_line(line):
-            raise mvpipe.ParseError("Don't know how to parse line: %s" % line)
+    def snapshot(self):
+        '''
+        Returns a frozen copy of the scope
+        '''
+        if not self.vals and self.base is not None:
+            return self.base
 
-    def replace_token(self, token, numargs=None, allow_missing=False):
-        if not token:
-            return ''
-        
-        token = token.replace("\\$", "$__ESCAPED_$__")
-        token = token.replace("\\@", "$__ESCAPED_@__")
+        for k, val in self.vals.items():
+            if type(val) == list:
+                self.vals[k] = _Prefix(val, len(val))
 
-        # print "****"
-        # print "Evaluating: %s" % token
+        frozen = Scope(self.vals, self.base)
+        if frozen.depth >= MAX_DEPTH:
+            frozen = Scope(frozen.flatten(True))
 
-        regex_var = re.compile('^(.*)\$\{([a-zA-Z_][a-zA-Z0-9_\.]*\??)\}(.*)$')
+        self.vals = {}
+        self.base = frozen
+        self.depth = frozen.depth + 1
+        return frozen
 
-        # var-replace
-        m = regex_var.match(token)
 
-        while m:
-            if m.group(2):
-                # print "var found => %s" % m.group(2)
-
-                if m.group(2)[-1] == '?':
-                    k = m.group(2)[:-1]
-                    allow_missing = True
-                else:
-                    k = m.group(2)
+class ExecContext(object):
+    '''
+    A flat stack of scopes. The first scope holds the context's own values;
+    a scope is pushed for each iteration of a for loop. Variables are looked
+    up from the innermost scope out (and then in the environment). Setting a
+    variable changes it in the scope where it is already defined, otherwise it
+    is added to the innermost scope.
+    '''
+    def __init__(self, initvals=None, verbose=False, loader=None):
+        self.verbose = verbose
+        self.loader = loader
+        self.scopes = [Scope(dict(initvals) if initvals else None)]
 
-                val = self.get(k)
-                if type(val) == list:
-                    val = ' '.join(val)
+        self._var_numargs = None
+        self._var_outputs = None
+        self._var_inputs = None
 
-                if val is None:
-                    if not allow_missing:
-                        raise mvpipe.ParseError("Variable \"%s\" not found!" % k)
-                    else:
-                        val = ''
+    def __repr__(self):
+        return '<%s:%s>' % (self.__class__.__name__, len(self.scopes))
 
-                token = '%s%s%s' % (m.group(1), val, m.group(3))
-                m = regex_var.match(token)
-            else:
-                m = None
+    @property
+    def _values(self):
+        return self.scopes[0]
 
-        # var-replace arrays - replace foo_@{bar}_baz with space delimited versions... foo_bar1_baz foo_bar2_baz foo_bar3_baz...
-        regex_array = re.compile('^(.*?)([A-Za-z0-9_\-\.]*)\@\{([a-zA-Z_][a-zA-Z0-9_\.]*)\}([A-Za-z0-9_\-\.]*)(.*)$')
-        m = regex_array.match(token)
+    @property
+    def var_outputs(self):
+        return self._var_outputs
 
-        while m:
-            if m.group(3):
-                # print "1", m.group(1)
-                # print "2", m.group(2)
-                # print "3", m.group(3)
-                # print "4", m.group(4)
-                # print "5", m.group(5)
-                # print "var found => %s" % m.group(2)
+    @property
+    def var_inputs(self):
+        return self._var_inputs
 
-                allow_missing = False
-                k = m.group(3)
+    @property
+    def var_numargs(self):
+        return self._var_numargs
 
-                val = self.get(k)
+    def push(self, vals=None):
+        self.scopes.append(Scope(vals))
 
-                if val is None:
-                    raise mvpipe.ParseError("Variable \"%s\" not found!" % k)
+    def pop(self):
+        return self.scopes.pop()
 
-                if type(val) != list:
-                    val = [val,]
+    def _scope(self, k):
+        for scope in reversed(self.scopes):
+            if k in scope:
+                return scope
+        return None
 
-                ins_vals = []
-                for v in val:
-                    ins_vals.append('%s%s%s' % (m.group(2), v, m.group(4)))
+    def get(self, k):
+        for scope in reversed(self.scopes):
+            val = scope.get(k, _Unset)
+            if val is not _Unset:
+                return val
 
-                token = '%s%s%s' % (m.group(1), ' '.join(ins_vals) , m.group(5))
-                m = regex_array.match(token)
-            else:
-                m = None
+        if k in os.environ:
+            return os.environ[k]
+        return None
 
-        # var-replace ranges - replace foo@{1..3}baz with space delimited versions... foo1baz foo2baz foo3baz...
-        regex_range = re.compile('^(.*?)([A-Za-z0-9_\-\.]*)\@\{[ \t]*([^ \t]+)[ \t]*\.\.[ \t]*([^ \t]+)[ \t]*\}([A-Za-z0-9_\-\.]*)(.*?)$')
-        m = regex_range.match(token)
+    def contains(self, k):
+        return self._scope(k) is not None
 
-        while m:
-            if m.group(3) and m.group(4):
-                # print "var found => %s" % m.group(2)
+    def set(self, k, v):
+        scope = self._scope(k)
+        if scope is None:
+            scope = self.scopes[-1]
+        scope[k] = v
 
-                allow_missing = False
-                frm = mvpipe.support.autotype(self.replace_token(m.group(3)))
-                to = mvpipe.support.autotype(self.replace_token(m.group(4)))
+    def set_ine(self, k, v):
+        # set the value if it doesn't already exist
+        # (allows for defaults to be given on command-line)
+        if not self.contains(k):
+            self.scopes[-1][k] = v
 
-                if type(frm) != int:
-                    raise mvpipe.ParseError("Invalid range start \"%s\"!" % frm)
-                if type(to) != int:
-                    raise mvpipe.ParseError("Invalid range end \"%s\"!" % to)
+    def append(self, k, v):
+        scope = self._scope(k)
+        if scope is None:
+            scope = self.scopes[-1]
+        scope.append(k, v)
 
-                ins_vals = []
-                for i in range(frm, to+1):
-                    ins_vals.append('%s%s%s' % (m.group(2), i, m.group(5)))
+    def unset(self, k):
+        scope = self._scope(k)
+        if scope is not None:
+            del scope[k]
 
-                token = '%s%s%s' % (m.group(1), ' '.join(ins_vals) , m.group(6))
-                m = regex_range.match(token)
-            else:
-                m = None
-
-        # given numarg-replace
-        if numargs:
-            regex = re.compile('^(.*)\$\{([0-9]+)\}(.*)$')
-            m = regex.match(token)
-
-            while m:
-                if m.group(2):
-                    mi = int(m.group(2)) - 1
-                    if mi < len(numargs):
-                        # print "var found => %s" % m.group(2)
-                        token = '%s%s%s' % (m.group(1), numargs[mi], m.group(3))
-                        m = regex.match(token)
-                    else:
-                        raise mvpipe.ParseError("Unknown num-arg: ${%s}" % m.group(2))
-                else:
-                    m = None
-
-        # global numarg-replace
-        if self.var_numargs:
-            regex = re.compile('^(.*)\$\{([0-9]+)\}(.*)$')
-            m = regex.match(token)
-
-            while m:
-                if m.group(2):
-                    mi = int(m.group(2)) - 1
-                    if mi < len(self.var_numargs):
-                        # print "var found => %s" % m.group(2)
-                        token = '%s%s%s' % (m.group(1), self.var_numargs[mi], m.group(3))
-                        m = regex.match(token)
-                    else:
-                        raise mvpipe.ParseError("Unknown num-arg: ${%s}" % m.group(2))
-                else:
-                    m = None
-
-        # inputs-replace
-        if self.var_inputs:
-            regex = re.compile('^(.*)\$\<([0-9]*)(.*)$')
-            m = regex.match(token)
-
-            while m:
-                if m.group(2):
-                    mi = int(m.group(2)) - 1
-                    if 0 <= mi and mi < len(self.var_inputs):
-                        # print "var found => %s" % m.group(2)
-                        token = '%s%s%s' % (m.group(1), self.var_inputs[mi], m.group(3))
-                    else:
-                        raise mvpipe.ParseError("Unknown input-num: $<%s" % m.group(2))
-                else:
-                    token = '%s%s%s' % (m.group(1), ' '.join(self.var_inputs), m.group(3))
-
-                m = regex.match(token)
-
-        # outputs-replace
-        if self.var_outputs:
-            regex = re.compile('^(.*)\$\>([0-9]*)(.*)$')
-            m = regex.match(token)
-
-            while m:
-                if m.group(2):
-                    mi = int(m.group(2)) - 1
-                    if mi < len(self.var_outputs):
-                        # print "var found => %s" % m.group(2)
-                        token = '%s%s%s' % (m.group(1), self.var_outputs[mi], m.group(3))
-                    else:
-                        raise mvpipe.ParseError("Unknown output-num: $>%s" % m.group(2))
-                else:
-                    token = '%s%s%s' % (m.group(1), ' '.join(self.var_outputs), m.group(3))
-                
-                m = regex.match(token)
-
-        # shell-out
-        regex = re.compile('^(.*)\$\((.*)\)(.*)$')
-        m = regex.match(token)
-
-        while m:
-            if m.group(2):
-                cmd = m.group(2)
-                # print "shell found => %s" % cmd
-                
-                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-                out, err = proc.communicate()
-                # if out:
-                #     sys.stderr.write('%s *> %s\n' % (cmd, out))
-                if err:
-                    self.root.loader.log('$(%s) => %s\n' % (cmd, err))
-
-                if proc.returncode != 0:
-                    raise mvpipe.ParseError("Error running shell command: %s" % cmd)
-                token = '%s%s%s' % (m.group(1), out.strip(), m.group(3))
-
-                m = regex.match(token)
-            else:
-                m = None
+    def _clonevals(self):
+        # if a name is in more than one scope, the outer one wins
+        vals = {}
+        for scope in reversed(self.scopes):
+            vals.update(scope.flatten())
+        return vals
 
-        token = token.replace("$__ESCAPED_$__", "$")
-        token = token.replace("$__ESCAPED_@__", "@")
+    def snapshot(self):
+        '''
+        Returns frozen copies of all of the scopes
+        '''
+        return [scope.snapshot() for scope in self.scopes]
 
-        return token
+    def replace_token(self, token, numargs=None, allow_missing=False):
+        if not token:
+            return ''
 
-    def eval_line(self, line):
-        if line[:2] != '#$':
-            if line[0] not in ['#',' ','\t'] and ':' in line:
-                self.child = TargetContext(self, line)
-                if not self.active:
-                    self.child.badtarget=True
-                self.root._targets.append(self.child)
-                return True
+        return template.get_template(token).render(self, numargs, allow_missing)
 
-            if self.active:
-                self.root.out.append(self.replace_token(line))
-            return True
+    def shell(self, cmd, cache=True):
+        return self.shell_async(cmd, cache).get()
 
-        line = line[2:].strip()
+    def shell_async(self, cmd, cache=True):
+        if self.loader and self.loader.shell_cache:
+            return self.loader.shell_cache.submit(cmd, cache)
 
-        for op in [ops.setop, ops.setineop, ops.unsetop, ops.appendop, ops.ifop, ops.forop]:
-            if op(self, line):
-                return True
+        return shellcache.Done(shellcache.execute(cmd, self.loader.log if self.loader else None))
 
-        return False
 
 class RootContext(ExecContext):
-    def __init__(self, parent, initvals=None, loader=None, verbose=False):
-        ExecContext.__init__(self, parent, initvals, verbose)
-        self.loader = loader
+    def __init__(self, initvals=None, loader=None, verbose=False):
+        ExecContext.__init__(self, initvals, verbose, loader)
         self._targets = []
         self.out = []
-        self.level=0
-
-    def eval_line(self, line):
-        if ExecContext.eval_line(self, line):
-            return True
-        else:
-            if line[:2] == '#$':
-                # If this isn't a normal line, check for an import
-                if ops.includeop(self, line[2:].strip()):
-                    return True
-
-                if ops.logop(self, line[2:].strip()):
-                    return True
-
-                if ops.outfileop(self, line[2:].strip()):
-                    return True
-
-        return False
-
-
-class IfContext(ExecContext):
-    def __init__(self, parent, test):
-        ExecContext.__init__(self, parent)
-        self.test = test
-
-    def append(self, k, v):
-        self.parent.append(k,v)
-
-    def set_ine(self, k, v):
-        self.parent.set_ine(k,v)
-
-    def set(self, k, v):
-        self.parent.set(k,v)
 
-    def eval_line(self, line):
-        if line[:2] == '#$':
-            for op in [ops.elseop, ops.endifop]:
-                if op(self, line[2:].strip()):
-                    return True
-        return ExecContext.eval_line(self, line)
+    def add_out(self, tmpl):
+        self.out.append(tmpl.render(self))
 
+    def add_target(self, tgt):
+        self._targets.append(tgt)
 
-class ElseContext(ExecContext):
-    def __init__(self, parent):
-        ExecContext.__init__(self, parent.parent)
-        self.test = not parent.test
-
-    def append(self, k, v):
-        self.parent.append(k,v)
-
-    def set_ine(self, k, v):
-        self.parent.set_ine(k,v)
-
-    def set(self, k, v):
-        self.parent.set(k,v)
-
-    def eval_line(self, line):
-        if line[:2] == '#$':
-            if ops.endifop(self, line[2:].strip()):
-                return True
-
-        return ExecContext.eval_line(self, line)
-
-
-class ForContext(ExecContext):
-    def __init__(self, parent, var, varlist):
-        ExecContext.__init__(self, parent)
-        self.var = var
-        self.varlist = varlist
-        self._body = []
-        self.loop_count = 0
-
-    def append(self, k, v):
-        self.parent.append(k,v)
-
-    def set_ine(self, k, v):
-        self.parent.set_ine(k,v)
-
-    def set(self, k, v):
-        self.parent.set(k,v)
-
-    def eval_line(self, line):
-        if line[:2] == '#$':
-            tmp = line[2:].strip()
-
-            if self.loop_count == 0 and tmp == 'done':
-                self.done()
-                self.parent.child = None
-                return True
-
-            if line[:2] == '#$':
-                tmp = line[2:].strip()
-                if tmp.split(' ')[0] == 'for':
-                    self.loop_count += 1
-                elif tmp == 'done':
-                    self.loop_count -= 1
-
-        self._body.append(line)
-        return True
-
-    def done(self):
-        for i in self.varlist:
-            sub = ExecContext(self)
-            sub.set(self.var, i)
-            self.child = sub
-
-            for line in self._body:
-                sub.parse_line(line)
-                # self.root.out.append(ret)
-        self.child = None
-        self.parent.child = None
 
 class TargetContext(ExecContext):
-    def __init__(self, parent, defline):
+    def __init__(self, parent, defline, body=None, recipe=None):
         # we capture a copy of the current scope
         # this way variables in the global scope 
         # can be altered for retaining tasks
@@ -501,48 +308,63 @@ class TargetContext(ExecContext):
         # so targets can't change variables in the global
         # scope... only their own. Very similar to a closure
         # in that regard.
+        #
+        # The copy is a snapshot, so only the variables that changed since
+        # the last target was defined are copied.
 
-        ExecContext.__init__(self, None, parent._clonevals())
-        self.rootctx = parent
-        self.verbose = parent.verbose
-
-        self.level = len(parent.root._targets)
+        ExecContext.__init__(self, None, parent.verbose, parent.loader)
+        self.scopes = parent.snapshot()
 
-        self._body = []
+        self._body = body or []
+        self.recipe = recipe if recipe is not None else directives.compile_recipe(self._body)
         self.defline = defline
-        self._leading_whitespace = ''
-        self.out = []
         self.badtarget = False
 
+        # the recipe bound to this scope and the job.* settings for the
+        # target (see _bind), and the evaluated recipes for each match
+        self._bound = None
+        self._assigns = None
+        self._args = None
+        self._shared = False
+        self._volatile = False
+        self._instances = None
+
         spl = defline.split(':')
 
         # the target will output these files
+        self.outputs = []
         try:
             self.outputs = self.replace_token(spl[0].strip()).split()
         except:
             self.badtarget = True
+
         self.outputs_regex = []
+        self.outputs_prefix = []
+        self.outputs_suffix = []
+        self.wildcard_names = []
 
         for out in self.outputs:
-            stars = 0
-            for ch in out:
-                if ch == '%':
-                    stars += 1
-            if stars > 1:
-                raise ValueError("Target names can only have one '%' wildcard.")
-
-            regex = '^%s$' % re.escape(self.replace_token(out)).replace('\%', '(.*)')
-            self.outputs_regex.append(re.compile(regex))
+            regex, prefix, suffix, names = targetindex.parse_output(out)
+            self.outputs_regex.append(regex)
+            self.outputs_prefix.append(prefix)
+            self.outputs_suffix.append(suffix)
+            for name in names:
+                if not name in self.wildcard_names:
+                    self.wildcard_names.append(name)
 
         # the target requires one of these groups of files...
         # these are not fully evaluated now, but will need to be at run time
-        # (for output-based wildcard matching).
+        # (for output-based wildcard matching). Named wildcards are left as
+        # ${name} so they can be filled in for each match.
 
+        self.push(dict([(n, '${%s}' % n) for n in self.wildcard_names]))
         try:
             self.inputs = [x.strip() for x in self.replace_token(spl[1]).split()]
         except:
             self.badtarget = True
             self.inputs = None
+        finally:
+            self.pop()
 
 #        print self.defline
 #        print self.outputs
@@ -553,64 +375,145 @@ class TargetContext(ExecContext):
     def __repr__(self):
         return self.defline
 
-    def eval_line(self, line):
-        if line and line[0] in [' ', '\t']:
-            if not self._leading_whitespace:
-                while line[0] in [' ', '\t']:
-                    self._leading_whitespace = '%s%s' % (self._leading_whitespace, line[0])
-                    line = line[1:]
-
-            self._body.append(line.rstrip().lstrip(self._leading_whitespace))
-            return True
-        else:
-            self.rootctx.child = None
-            self.rootctx.eval_line(line)
-            return True
-
     def match_target(self, target):
+        '''
+        Returns (match, numargs, outputs, wildcards) where numargs are the
+        anonymous wildcard values (${1}, ${2}...) for each matching output
+        and wildcards are the values for any named wildcards.
+        '''
         if self.badtarget:
-            return False, None, None
+            return False, None, None, None
 
-        wildcards = []
+        numargs = []
         outputs = []
+        wildcards = {}
         match_target = False
         for out, regex in zip(self.outputs, self.outputs_regex):
             if not target:
-                # self.rootctx.root.loader.log("MATCH (null) %s " % target)
+                # self.loader.log("MATCH (null) %s " % target)
                 match_target = True
-                wildcards.append('')
+                numargs.append('')
                 outputs.append(out)
+            elif not regex:
+                if out == target:
+                    match_target = True
+                    numargs.append('')
+                    outputs.append(out)
             else:
-                m = regex.match(target)
+                m = targetindex.match_output(regex, target)
                 if m:
-                    # self.rootctx.root.loader.log("MATCH (%s) %s" % (regex.pattern, target))
+                    # self.loader.log("MATCH (%s) %s" % (regex.pattern, target))
                     match_target = True
-                    if m.groups():
-                        wildcards.append(m.group(1))
-                        outputs.append(out.replace("%", m.group(1)))
-                    else:
-                        wildcards.append('')
-                        outputs.append(out)
+                    anon, named = m
+                    wildcards.update(named)
+                    numargs.append(anon)
+                    outputs.append(targetindex.fill_output(out, anon, named))
                 # else:
-                    # self.rootctx.root.loader.log("NO MATCH (%s)" % regex.pattern)
+                    # self.loader.log("NO MATCH (%s)" % regex.pattern)
 
         if match_target:
-            return True, wildcards, outputs
+            return True, numargs, outputs, wildcards
         else:
-            return False, None, None
+            return False, None, None, None
 
-    def eval_src(self, outputs=None, inputs=None, numargs=None):
-        ctx = TargetExecContext(self._clonevals(), outputs, inputs, numargs, verbose=self.verbose)
-        for line in self._body:
-            ctx.parse_line(line)
+    def eval_inputs(self, numargs=None, wildcards=None):
+        self.push(wildcards)
+        try:
+            return [self.replace_token(inputstr, numargs) for inputstr in self.inputs]
+        finally:
+            self.pop()
+
+    def _bind(self):
+        '''
+        Binds the recipe to the target's scope. Variables that are set in the
+        recipe or that come from named wildcards are left to be filled in
+        for each match.
+        '''
+        self._assigns = directives.assigned(self.recipe)
+        self._bound = directives.bind(self.recipe, self, self._assigns.union(self.wildcard_names))
+
+        vals = self._clonevals()
+        self._args = dict([(k[4:], vals[k]) for k in vals if k[:4] == 'job.'])
+
+        # if the recipe doesn't set any variables, it can run against the
+        # target's scopes directly
+        self._shared = not self._assigns
+        self._volatile = directives.volatile(self.recipe)
+
+        # evaluated recipes are only kept while something (a job) still
+        # needs them
+        self._instances = weakref.WeakValueDictionary()
+
+    def _job_args(self, ctx):
+        '''
+        The job.* settings (without the prefix) for an evaluated recipe
+        '''
+        if self._shared:
+            return self._args
+
+        args = dict(self._args)
+        for k in self._assigns:
+            if k[:4] == 'job.':
+                val = ctx.get(k)
+                if val is None:
+                    args.pop(k[4:], None)
+                else:
+                    args[k[4:]] = val
+        return args
+
+    def eval_src(self, outputs=None, inputs=None, numargs=None, wildcards=None, defer=False):
+        '''
+        Evaluates the target body. Shell-outs in the body lines are run
+        concurrently. If defer is set, they aren't joined until
+        ctx.resolve() is called, so that the shell-outs from many targets
+        can run at the same time.
+
+        The evaluated body is kept for each set of outputs/inputs, so
+        resolving the same output again doesn't re-evaluate it (unless the
+        body has $!(...) shell-outs). The job.* settings for the target are
+        in ctx.args.
+        '''
+        if self._bound is None:
+            self._bind()
+
+        key = (tuple(outputs or ()), tuple(inputs or ()), tuple(numargs or ()), tuple(sorted(wildcards.items())) if wildcards else ())
+        ctx = self._instances.get(key)
+        if ctx is None:
+            if self._shared:
+                scopes = list(self.scopes)
+            else:
+                scopes = [Scope(None, scope) for scope in self.scopes]
+            if wildcards:
+                scopes.append(Scope(wildcards))
+
+            ctx = TargetExecContext(scopes, outputs, inputs, numargs, loader=self.loader, verbose=self.verbose)
+            directives.run(self._bound, ctx)
+            ctx.args = self._job_args(ctx)
+
+            if not self._volatile:
+                self._instances[key] = ctx
+
+        if not defer:
+            ctx.resolve()
         return ctx
 
 
 class TargetExecContext(ExecContext):
-    def __init__(self, initvals, outputs, inputs, numargs, verbose=False):
-        ExecContext.__init__(self, None, initvals=initvals, verbose=verbose)
+    def __init__(self, scopes, outputs, inputs, numargs, loader=None, verbose=False):
+        ExecContext.__init__(self, None, verbose, loader)
+        self.scopes = scopes
         self.out = []
         self._var_outputs = outputs
         self._var_inputs = inputs
         self._var_numargs = numargs
-        self.level = 0
+        self._resolved = False
+        self.args = None
+
+    def add_out(self, tmpl):
+        self.out.append(tmpl.start(self))
+
+    def resolve(self):
+        if not self._resolved:
+            self.out = [x.get() for x in self.out]
+            self._resolved = True
+        return self.out
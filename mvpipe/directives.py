@@ -0,0 +1,464 @@
+'''
+Compiler and interpreter for the "#$" directive language
+
+A pipeline file is compiled once into a block (a list of statements), where
+if/else/endif and for/done are nested blocks, and each build target
+definition keeps the lines of its body. The block is then run against a
+context. Statements in a branch that isn't taken aren't evaluated at all, and
+the body of a for loop is compiled once, no matter how many times it runs.
+
+Contexts are flat scope stacks (see context.ExecContext): each iteration of a
+for loop pushes a scope for the loop variable (and any new variables set in
+the body), and pops it when the iteration is done. If/else blocks don't have
+their own scope.
+
+Target bodies are compiled when the target is defined. The compiled bodies
+are kept in an LRU cache keyed on the body lines, so targets defined in a
+loop (with the same body) are only compiled once. Before a target body is
+first run, it is bound to the target's scope (see bind()), so that only the
+values for each match are substituted when it is run.
+
+'''
+
+import re
+import copy
+
+import mvpipe
+import template
+from support import autotype
+
+CACHE_SIZE = 4096
+
+regex_set = re.compile('^([A-Za-z_\.][A-Za-z0-9_\.]*)[ \t]*=[ \t]*(.*)$')
+regex_setine = re.compile('^([A-Za-z_\.][A-Za-z0-9_\.]*)[ \t]*\?=[ \t]*(.*)$')
+regex_append = re.compile('^([A-Za-z_\.][A-Za-z0-9_\.]*)[ \t]*\+=[ \t]*(.*)$')
+regex_unset = re.compile('^unset[ \t]+([A-Za-z_\.][A-Za-z0-9_\.]*)$')
+
+regex_if = re.compile('^if[ \t]+(\$\{[^ \t]+\??\})[ \t]*([=<>!]+)[ \t]*(.*)$')
+regex_ifset = re.compile('^if[ \t]+(\$\{[^ \t]+\??\})$')
+regex_ifnot = re.compile('^if[ \t]+\![ \t]*(\$\{[^ \t]+\??\})$')
+
+regex_for = re.compile('^for[ \t]+([a-zA-Z_][a-zA-Z0-9_\.]*)[ \t]*in[ \t]*([^ \t]+)$')
+regex_include = re.compile('^include[ \t]+(.*)$')
+
+_compare = {
+    '==': lambda l, r: l == r,
+    '<': lambda l, r: l < r,
+    '>': lambda l, r: l > r,
+    '<=': lambda l, r: l <= r,
+    '>=': lambda l, r: l >= r,
+    '!=': lambda l, r: l != r,
+}
+
+
+class Statement(object):
+    def __init__(self, lineno, line):
+        self.lineno = lineno
+        self.line = line
+
+    def __repr__(self):
+        return '<%s:%s>' % (self.__class__.__name__, self.lineno)
+
+    def run(self, context):
+        raise NotImplementedError
+
+    def bind(self, context, keep):
+        return self
+
+
+class Output(Statement):
+    '''
+    Any line that isn't a directive or a target definition. In a pipeline
+    file, these are echoed (after substitution). In a target body, these are
+    the script.
+    '''
+    def __init__(self, lineno, line, tmpl=None):
+        Statement.__init__(self, lineno, line)
+        self.template = tmpl or template.get_template(line)
+
+    def run(self, context):
+        context.add_out(self.template)
+
+    def bind(self, context, keep):
+        tmpl = self.template.bind(context, keep)
+        if tmpl is self.template:
+            return self
+        return Output(self.lineno, self.line, tmpl)
+
+
+class SetOp(Statement):
+    def __init__(self, lineno, line, name, expr):
+        Statement.__init__(self, lineno, line)
+        self.name = name
+        self.expr = expr
+
+    def value(self, context):
+        v = autotype(context.replace_token(self.expr))
+        if v == '[]':
+            v = []
+        return v
+
+    def run(self, context):
+        context.set(self.name, self.value(context))
+
+
+class SetIneOp(SetOp):
+    def run(self, context):
+        context.set_ine(self.name, self.value(context))
+
+
+class AppendOp(SetOp):
+    def run(self, context):
+        vals = autotype(context.replace_token(self.expr))
+        if type(vals) == list:
+            for v in vals:
+                context.append(self.name, v)
+        else:
+            context.append(self.name, vals)
+
+
+class UnsetOp(Statement):
+    def __init__(self, lineno, line, name):
+        Statement.__init__(self, lineno, line)
+        self.name = name
+
+    def run(self, context):
+        context.unset(self.name)
+
+
+class IfOp(Statement):
+    '''
+    if ${var} op value / if ${var} / if !${var}
+    '''
+    def __init__(self, lineno, line, var, op=None, rhs=None, negate=False):
+        Statement.__init__(self, lineno, line)
+        self.var = var
+        self.op = op
+        self.rhs = autotype(rhs) if op else None
+        self.negate = negate
+        self.body = []
+        self.orelse = []
+
+    def test(self, context):
+        if self.op:
+            return _compare[self.op](autotype(context.replace_token(self.var)), self.rhs)
+
+        if autotype(context.replace_token(self.var, allow_missing=True)):
+            return not self.negate
+        return self.negate
+
+    def run(self, context):
+        if self.test(context):
+            run(self.body, context)
+        else:
+            run(self.orelse, context)
+
+    def bind(self, context, keep):
+        stmt = copy.copy(self)
+        stmt.body = bind(self.body, context, keep)
+        stmt.orelse = bind(self.orelse, context, keep)
+        return stmt
+
+
+class ForOp(Statement):
+    '''
+    for var in ${list} / for var in start..end
+    '''
+    def __init__(self, lineno, line, var, expr):
+        Statement.__init__(self, lineno, line)
+        self.var = var
+        self.expr = expr
+        self.body = []
+
+    def values(self, context):
+        if '..' in self.expr:
+            spl = [x.strip() for x in self.expr.split('..')]
+
+            frm = autotype(context.replace_token(spl[0]))
+            to = autotype(context.replace_token(spl[1]))
+
+            if type(frm) == int and type(to) == int:
+                return range(frm, to+1)
+            return []
+
+        varlist = autotype(context.replace_token(self.expr))
+        if type(varlist) != list:
+            varlist = [varlist,] if varlist != '' else []
+        return varlist
+
+    def run(self, context):
+        varlist = self.values(context)
+        if not varlist:
+            raise mvpipe.ParseError("Can't handle list: %s" % self.expr)
+
+        for val in varlist:
+            context.push()
+            try:
+                context.set(self.var, val)
+                run(self.body, context)
+            finally:
+                context.pop()
+
+    def bind(self, context, keep):
+        stmt = copy.copy(self)
+        stmt.body = bind(self.body, context, keep)
+        return stmt
+
+
+class IncludeOp(Statement):
+    def __init__(self, lineno, line, fname):
+        Statement.__init__(self, lineno, line)
+        if fname and fname[0] == '"' and fname[-1] =='"':
+            fname = fname[1:-1]
+        self.fname = fname
+
+    def run(self, context):
+        context.loader.load_file(self.fname)
+
+
+class LogOp(Statement):
+    def __init__(self, lineno, line, expr):
+        Statement.__init__(self, lineno, line)
+        self.expr = expr
+
+    def fname(self, context):
+        fname = context.replace_token(self.expr)
+        if fname[0] == '"' and fname[-1] == '"':
+            fname = fname[1:-1]
+        return fname
+
+    def run(self, context):
+        context.loader.set_log(self.fname(context))
+
+
+class OutfileOp(LogOp):
+    def run(self, context):
+        context.loader.set_outfile(self.fname(context))
+
+
+class TargetOp(Statement):
+    '''
+    A build target definition (outputs: inputs), the lines of its body and
+    the compiled body
+    '''
+    def __init__(self, lineno, line, body, recipe):
+        Statement.__init__(self, lineno, line)
+        self.body = body
+        self.recipe = recipe
+
+    def run(self, context):
+        context.add_target(mvpipe.context.TargetContext(context, self.line, self.body, self.recipe))
+
+
+class _Compiler(object):
+    def __init__(self, lines, recipe=False):
+        self.lines = lines
+        self.recipe = recipe
+        self.pos = 0
+
+    def compile(self):
+        block, end = self.block(())
+        return block
+
+    def block(self, ends):
+        '''
+        Compiles statements up to one of the directives in ends (else, endif,
+        done). Returns the statements and the directive that ended the block
+        (or None at the end of the file).
+        '''
+        stmts = []
+        while self.pos < len(self.lines):
+            lineno, line = self.lines[self.pos]
+            self.pos += 1
+
+            if line[:2] != '#$':
+                if not self.recipe and line[0] not in ['#',' ','\t'] and ':' in line:
+                    stmts.append(self.target(lineno, line))
+                else:
+                    stmts.append(Output(lineno, line))
+                continue
+
+            directive = line[2:].strip()
+            if directive in ends:
+                return stmts, directive
+
+            stmts.append(self.directive(lineno, line, directive))
+
+        return stmts, None
+
+    def target(self, lineno, defline):
+        '''
+        The body of a target is every indented line following the definition.
+        The indentation of the first line is removed from all of them.
+        '''
+        body = []
+        linenos = []
+        indent = ''
+        while self.pos < len(self.lines):
+            bodyno, line = self.lines[self.pos]
+            if line[0] not in [' ', '\t']:
+                break
+            self.pos += 1
+            linenos.append(bodyno)
+
+            if not indent:
+                while line[0] in [' ', '\t']:
+                    indent = '%s%s' % (indent, line[0])
+                    line = line[1:]
+
+            body.append(line.rstrip().lstrip(indent))
+
+        try:
+            recipe = compile_recipe(body)
+        except mvpipe.ParseError, e:
+            # errors in the body are numbered from the start of the body
+            e.lineno = linenos[e.lineno-1]
+            raise
+
+        return TargetOp(lineno, defline, body, recipe)
+
+    def directive(self, lineno, line, directive):
+        m = regex_set.match(directive)
+        if m:
+            return SetOp(lineno, line, m.group(1), m.group(2))
+
+        m = regex_setine.match(directive)
+        if m:
+            return SetIneOp(lineno, line, m.group(1), m.group(2))
+
+        m = regex_unset.match(directive)
+        if m:
+            return UnsetOp(lineno, line, m.group(1))
+
+        m = regex_append.match(directive)
+        if m:
+            return AppendOp(lineno, line, m.group(1), m.group(2))
+
+        stmt = None
+        m = regex_if.match(directive)
+        if m:
+            if not m.group(2) in _compare:
+                raise _error(mvpipe.ParseError("Unknown test operator: %s" % m.group(2)), lineno, line)
+            stmt = IfOp(lineno, line, m.group(1), m.group(2), m.group(3))
+        else:
+            m = regex_ifset.match(directive)
+            if m:
+                stmt = IfOp(lineno, line, m.group(1))
+            else:
+                m = regex_ifnot.match(directive)
+                if m:
+                    stmt = IfOp(lineno, line, m.group(1), negate=True)
+
+        if stmt:
+            stmt.body, end = self.block(('else', 'endif'))
+            if end == 'else':
+                stmt.orelse, end = self.block(('endif',))
+            if not end:
+                raise _error(mvpipe.ParseError("Missing endif"), lineno, line)
+            return stmt
+
+        m = regex_for.match(directive)
+        if m:
+            stmt = ForOp(lineno, line, m.group(1), m.group(2))
+            stmt.body, end = self.block(('done',))
+            if not end:
+                raise _error(mvpipe.ParseError("Missing done"), lineno, line)
+            return stmt
+
+        if not self.recipe:
+            m = regex_include.match(directive)
+            if m:
+                return IncludeOp(lineno, line, m.group(1))
+
+            spl = directive.split(' ', 1)
+            if spl[0] == 'log' and len(spl) > 1:
+                return LogOp(lineno, line, spl[1].strip())
+            if spl[0] == 'outfile' and len(spl) > 1:
+                return OutfileOp(lineno, line, spl[1].strip())
+
+        raise _error(mvpipe.ParseError("Don't know how to parse line: %s" % line), lineno, line)
+
+
+def compile_file(lines):
+    '''
+    Compiles the lines of a pipeline file, given as (lineno, line)
+    '''
+    return _Compiler(lines).compile()
+
+
+_recipes = template.LRUCache(CACHE_SIZE)
+
+def compile_recipe(lines):
+    '''
+    Compiles the body of a target. Target definitions, includes and
+    log/outfile directives aren't allowed here.
+    '''
+    key = tuple(lines)
+    block = _recipes.get(key)
+    if block is None:
+        block = _Compiler([(i+1, line) for i, line in enumerate(lines)], recipe=True).compile()
+        _recipes.put(key, block)
+    return block
+
+
+def assigned(block):
+    '''
+    Returns the names of the variables that are set (or unset) in a block
+    '''
+    names = set()
+    for stmt in block:
+        if isinstance(stmt, (SetOp, UnsetOp)):
+            names.add(stmt.name)
+        elif isinstance(stmt, ForOp):
+            names.add(stmt.var)
+            names.update(assigned(stmt.body))
+        elif isinstance(stmt, IfOp):
+            names.update(assigned(stmt.body))
+            names.update(assigned(stmt.orelse))
+    return names
+
+
+def volatile(block):
+    '''
+    Returns True if a block has a $!(...) shell-out (that shouldn't be
+    cached)
+    '''
+    for stmt in block:
+        if isinstance(stmt, Output) and stmt.template.volatile:
+            return True
+        if isinstance(stmt, SetOp) and template.get_template(stmt.expr).volatile:
+            return True
+        if isinstance(stmt, ForOp) and (template.get_template(stmt.expr).volatile or volatile(stmt.body)):
+            return True
+        if isinstance(stmt, IfOp) and (volatile(stmt.body) or volatile(stmt.orelse)):
+            return True
+    return False
+
+
+def bind(block, context, keep=()):
+    '''
+    Binds the output lines in a block to a context: any variables that the
+    context has a value for (except for those in keep) are replaced with
+    their values. The block itself isn't changed.
+    '''
+    return [stmt.bind(context, keep) for stmt in block]
+
+
+def run(block, context):
+    for stmt in block:
+        try:
+            stmt.run(context)
+        except mvpipe.ParseError, e:
+            _error(e, stmt.lineno, stmt.line)
+            raise
+
+
+def _error(e, lineno, line):
+    '''
+    Sets the location of an error (if it wasn't already set by a nested
+    statement)
+    '''
+    if e.lineno is None:
+        e.lineno = lineno
+        e.line = line
+    return e
@@ -1,14 +1,66 @@
 import os
 import sys
+import gzip
+import atexit
+import hashlib
 import datetime
+import tempfile
+import threading
 
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_levels = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+'''
+Log options (mvpipe.log.*):
+
+level       - the lowest level to write to the log: debug, info, warning or
+              error (default: debug). The target-by-target trace of the build
+              is written at the debug level.
+
+buffer      - the number of bytes to buffer before writing to the log
+              (default: 65536). The buffer is also written when the log is
+              closed (or the run is aborted).
+
+archive     - keep job scripts in a content-addressed archive instead of
+              writing them into the log, one line at a time. Each distinct
+              script is stored once (gzipped) as {archive}/ab/cdef....gz and
+              the log only has a reference to it ("script abcdef..."). If
+              True, the archive is {logfile}.scripts; it may also be the
+              path to a directory, which can be shared between logs.
+              (default: True)
+
+'''
 class FileLogger(object):
-    def __init__(self, fname):
+    def __init__(self, fname, level=DEBUG, buffer=65536, archive=True):
         self.fname = fname
+        self.level = _level(level)
+        self.buffer = int(buffer)
+        self.archive_opt = archive
+        self.archive = None
+
+        self._lock = threading.Lock()
+        self._buf = []
+        self._buflen = 0
+        self.fobj = None
+
         if fname:
-            self.fobj = open(fname, 'a')
-        else:
-            self.fobj = None
+            self._open(fname)
+
+        # anything still in the buffer is written when the program exits
+        atexit.register(self.flush)
+
+    def _open(self, fname):
+        self.fobj = open(fname, 'a')
+        self.fname = fname
+
+        if self.archive_opt is True:
+            self.archive = ScriptArchive('%s.scripts' % fname)
+        elif self.archive_opt:
+            self.archive = ScriptArchive(self.archive_opt)
 
         self.sep()
         self.write("New run: %s" % datetime.datetime.now())
@@ -16,23 +68,117 @@ class FileLogger(object):
         self.write("Current directory: %s" % os.getcwd())
 
     def close(self):
-        if self.fobj:
-            self.fobj.close()
+        with self._lock:
+            self._flush()
+            if self.fobj:
+                self.fobj.close()
+                self.fobj = None
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buf and self.fobj:
+            self.fobj.write(''.join(self._buf))
+            self.fobj.flush()
+        self._buf = []
+        self._buflen = 0
+
+    def write(self, line, level=INFO):
+        if self.fobj and level >= self.level:
+            with self._lock:
+                line = '%s\n' % line
+                self._buf.append(line)
+                self._buflen += len(line)
+                if self._buflen >= self.buffer:
+                    self._flush()
+
+    def write_script(self, prefix, src, cont=None, level=INFO):
+        '''
+        Writes a job script to the log. With an archive, the script is
+        stored there and only a reference is written: "{prefix}script {hash}".
+        Otherwise, the first line is written with prefix, and the rest with
+        cont (default: prefix).
+        '''
+        if not self.fobj or level < self.level:
+            return
+
+        if self.archive:
+            self.write('%sscript %s' % (prefix, self.archive.store(src)), level)
+            return
 
-    def write(self, line):
-        if self.fobj:
-            self.fobj.write('%s\n' % line)
+        if cont is None:
+            cont = prefix
+
+        for i, line in enumerate(src.split('\n')):
+            self.write('%s%s' % (prefix if i == 0 else cont, line), level)
 
     def sep(self):
             self.write('----------------------------------------')
 
     def set_fname(self, fname):
-        if self.fobj:
-            self.fobj.close()
+        with self._lock:
+            self._flush()
+            if self.fobj:
+                self.fobj.close()
 
-        self.fobj = open(fname, 'a')
-        self.fname = fname
-        self.sep()
-        self.write("New run: %s" % datetime.datetime.now())
-        self.write("Command line: %s" % ' '.join(sys.argv))
-        self.write("Current directory: %s" % os.getcwd())
+        self._open(fname)
+
+
+class ScriptArchive(object):
+    '''
+    A content-addressed store for job scripts. Scripts are keyed by their
+    SHA-1 and written (gzipped) the first time they are seen.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def fname(self, key):
+        return os.path.join(self.path, key[:2], '%s.gz' % key[2:])
+
+    def store(self, src):
+        if type(src) == unicode:
+            src = src.encode('utf-8')
+        key = hashlib.sha1(src).hexdigest()
+
+        with self._lock:
+            if key in self._known:
+                return key
+
+            fname = self.fname(key)
+            if not os.path.exists(fname):
+                dname = os.path.dirname(fname)
+                if not os.path.exists(dname):
+                    try:
+                        os.makedirs(dname)
+                    except OSError:
+                        # another run may have made it
+                        if not os.path.isdir(dname):
+                            raise
+
+                # written to a temp file first, so a partial script is never
+                # found under the real name
+                fd, tmp = tempfile.mkstemp(dir=dname)
+                with os.fdopen(fd, 'wb') as f:
+                    gz = gzip.GzipFile(fileobj=f, mode='wb', mtime=0)
+                    gz.write(src)
+                    gz.close()
+                os.rename(tmp, fname)
+
+            self._known.add(key)
+        return key
+
+    def get(self, key):
+        with gzip.open(self.fname(key)) as f:
+            return f.read()
+
+
+def _level(val):
+    if type(val) == int:
+        return val
+    if not str(val).lower() in _levels:
+        raise ValueError('Unknown log level: %s' % val)
+    return _levels[str(val).lower()]
@@ -0,0 +1,140 @@
+'''
+Build manifest used to decide if existing outputs are out of date
+
+The manifest is a tab-delimited file stored next to the outfile. It records
+the size, mtime and content hash of files that have been checked (so large
+files are only re-read when their size or mtime changes), and for each output,
+the hash of the recipe that was used to build it and the hashes of its inputs
+at the time it was scheduled.
+
+    file    path    size    mtime   hash
+    target  output  recipe  input1  hash1   input2  hash2 ...
+
+'''
+
+import os
+import hashlib
+
+
+def hash_file(fname, blocksize=1024*1024):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        buf = f.read(blocksize)
+        while buf:
+            h.update(buf)
+            buf = f.read(blocksize)
+    return h.hexdigest()
+
+
+def hash_recipe(src):
+    return hashlib.sha1(src if src else '').hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self._files = {}
+        self._targets = {}
+        self._dirty = False
+
+        if os.path.exists(fname):
+            with open(fname) as f:
+                for line in f:
+                    cols = line.rstrip('\n').split('\t')
+                    if cols[0] == 'file' and len(cols) == 5:
+                        self._files[cols[1]] = (int(cols[2]), float(cols[3]), cols[4])
+                    elif cols[0] == 'target' and len(cols) >= 3:
+                        self._targets[cols[1]] = (cols[2], dict(zip(cols[3::2], cols[4::2])))
+
+    def file_hash(self, fname):
+        '''
+        Returns the content hash for a file, only reading the file if its
+        size or mtime changed since the last time it was hashed.
+        Returns None if the file doesn't exist.
+        '''
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+
+        if fname in self._files:
+            size, mtime, h = self._files[fname]
+            if size == st.st_size and mtime == st.st_mtime:
+                return h
+
+        if os.path.isdir(fname):
+            return None
+
+        h = hash_file(fname)
+        self._files[fname] = (st.st_size, st.st_mtime, h)
+        self._dirty = True
+        return h
+
+    def record(self, outputs, inputs, src):
+        recipe = hash_recipe(src)
+        hashes = {}
+        for inp in inputs:
+            h = self.file_hash(inp)
+            if h:
+                hashes[inp] = h
+
+        for out in outputs:
+            self._targets[out] = (recipe, hashes)
+        self._dirty = True
+
+    def changed(self, output, inputs, src):
+        '''
+        Returns a description of what changed since the output was scheduled,
+        or None if nothing has changed (or nothing was recorded).
+        '''
+        if not output in self._targets:
+            return None
+
+        recipe, hashes = self._targets[output]
+        if recipe != hash_recipe(src):
+            return 'recipe changed'
+
+        for inp in inputs:
+            if inp in hashes and self.file_hash(inp) != hashes[inp]:
+                return 'input changed: %s' % inp
+
+        return None
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        tmp = '%s.tmp' % self.fname
+        with open(tmp, 'w') as f:
+            for fname in sorted(self._files):
+                size, mtime, h = self._files[fname]
+                f.write('file\t%s\t%s\t%r\t%s\n' % (fname, size, mtime, h))
+            for out in sorted(self._targets):
+                recipe, hashes = self._targets[out]
+                cols = ['target', out, recipe]
+                for inp in sorted(hashes):
+                    cols.append(inp)
+                    cols.append(hashes[inp])
+                f.write('%s\n' % '\t'.join(cols))
+
+        os.rename(tmp, self.fname)
+        self._dirty = False
+
+
+def newer_input(output, inputs):
+    '''
+    Returns the first input that is newer than the output (by mtime), or None
+    '''
+    try:
+        out_mtime = os.stat(output).st_mtime
+    except OSError:
+        return None
+
+    for inp in inputs:
+        try:
+            if os.stat(inp).st_mtime > out_mtime:
+                return inp
+        except OSError:
+            pass
+
+    return None
@@ -0,0 +1,140 @@
+'''
+Cache for parsed pipelines
+
+After a pipeline is parsed, the result (the global values, the echoed output,
+and the target definitions with their bodies) is saved to a cache directory.
+The next time the same pipeline is loaded, it is restored from the cache
+instead of being parsed again.
+
+Entries are keyed on the pipeline file, the working directory, the
+command-line args and config values, and a declared subset of environment
+variables. Each entry also keeps the content hashes of every file that was
+loaded (the pipeline and all of its includes), so it is thrown out if any of
+them change. The "#$ log" and "#$ outfile" directives are replayed when an
+entry is restored.
+
+Shell-outs are part of the parsed values, so entries for pipelines that ran
+shell-outs are only kept for the TTL. Pipelines that use uncached
+shell-outs ($!(...)) are never cached.
+
+'''
+
+import os
+import time
+import pickle
+import hashlib
+
+import context
+import manifest
+
+# bump this if the format of the cached contexts changes
+CACHE_VERSION = 6
+
+# TargetContext attributes that link back to the loader
+_links = ['loader']
+
+
+class PipelineCache(object):
+    def __init__(self, path, ttl=3600, env=None, log=None):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.env = env.replace(':', ' ').split() if env else []
+        self._log = log
+
+    def log(self, msg):
+        if self._log:
+            self._log(msg)
+
+    def fname(self, loader, fname):
+        args = sorted([(k, repr(v)) for k, v in loader.args.items()])
+        env = [(k, os.environ.get(k, '')) for k in self.env]
+        key = hashlib.sha1(repr((CACHE_VERSION, os.path.abspath(fname), os.getcwd(), loader.libpath, args, env))).hexdigest()
+        return os.path.join(self.path, '%s.pickle' % key)
+
+    def restore(self, loader, fname):
+        '''
+        Restores a parsed pipeline into the loader's (empty) root context.
+        Returns False if there isn't a valid entry.
+        '''
+        cache_fname = self.fname(loader, fname)
+        if not os.path.exists(cache_fname):
+            return False
+
+        try:
+            with open(cache_fname, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception, e:
+            self.log('Ignoring invalid pipeline cache entry: %s (%s)' % (cache_fname, e))
+            return False
+
+        if entry.get('version') != CACHE_VERSION:
+            return False
+
+        if entry['expires'] and entry['expires'] < time.time():
+            self.log('Pipeline cache entry has expired: %s' % cache_fname)
+            return False
+
+        for path, h in entry['files']:
+            if not os.path.exists(path) or manifest.hash_file(path) != h:
+                self.log('Pipeline cache entry is out of date (%s changed): %s' % (path, cache_fname))
+                return False
+
+        self.log('Loading pipeline from cache: %s' % cache_fname)
+
+        root = loader.context
+        root.scopes = [entry['values']]
+        root.out = entry['out']
+        for attrs in entry['targets']:
+            tgt = context.TargetContext.__new__(context.TargetContext)
+            tgt.__dict__.update(attrs)
+            tgt.loader = loader
+            root.add_target(tgt)
+
+        loader.loaded_files = list(entry['files'])
+        for op, val in entry['replay']:
+            if op == 'log':
+                loader.set_log(val)
+            elif op == 'outfile':
+                loader.set_outfile(val)
+        loader.replay = list(entry['replay'])
+
+        return True
+
+    def store(self, loader, fname, shell_outs=False):
+        '''
+        Saves the loader's parsed pipeline
+        '''
+        targets = []
+        for tgt in loader.context._targets:
+            targets.append(dict([(k, v) for k, v in tgt.__dict__.items() if not k in _links]))
+
+        entry = {
+            'version': CACHE_VERSION,
+            'time': time.time(),
+            'expires': time.time() + self.ttl if shell_outs and self.ttl > 0 else None,
+            'files': loader.loaded_files,
+            'values': loader.context._values,
+            'out': loader.context.out,
+            'targets': targets,
+            'replay': loader.replay,
+        }
+
+        cache_fname = self.fname(loader, fname)
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+
+        tmp = '%s.%s.tmp' % (cache_fname, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, cache_fname)
+        except (pickle.PicklingError, TypeError), e:
+            os.unlink(tmp)
+            self.log('Unable to cache pipeline: %s' % e)
+            return
+
+        self.log('Saved pipeline to cache: %s' % cache_fname)
@@ -1,7 +1,57 @@
+import os
+import re
 import sys
+import hashlib
+import tempfile
+import weakref
+import threading
+import collections
+
+import mvpipe.logger
+import mvpipe.support
+
+class _Args(dict):
+    '''
+    Interned job settings (a dict that can be weakly referenced)
+    '''
+    __slots__ = ['__weakref__']
+
+
+# job settings are interned, so that jobs with the same settings share one
+# dict (and the runners can share the options they merge with them). Settings
+# are dropped once no job uses them.
+_interned_args = weakref.WeakValueDictionary()
+
+
+def _args_key(args):
+    return tuple([(k, repr(args[k])) for k in sorted(args)])
+
+
+def intern_args(args):
+    '''
+    Returns the shared dict with the same settings as args. The returned
+    dict shouldn't be changed.
+    '''
+    return _interned_args.setdefault(_args_key(args), _Args(args))
+
+
+def _unique(items):
+    '''
+    Returns the items as a tuple without duplicates (in their original order)
+    '''
+    seen = set()
+    out = []
+    for item in items:
+        if not item in seen:
+            seen.add(item)
+            out.append(item)
+    return tuple(out)
+
 
 class Job(object):
-    def __init__(self, src, outputs=None, name=None, depends=None, pre=None, post=None, **kwargs):
+    __slots__ = ['jobid', 'rule', 'array', 'array_index', 'priority', 'args', 'outputs', 'inputs', '_src', '_name', '_pre', '_post', '_depends']
+
+    def __init__(self, src, outputs=None, name=None, depends=None, pre=None, post=None, inputs=None, rule=None, **kwargs):
         '''
         kwargs are job-specific arguments that the runner may use to schedule the job
 
@@ -17,31 +67,58 @@ class Job(object):
         depends - a list of job-ids for jobs that this one depends on
 
         The outputs are used by the job runners to output files if the job fails.
+        The inputs are the files the job needs (these may be outputs of the
+        jobs it depends on).
+
+        rule is the target definition that the job was built from. Jobs from
+        the same rule with the same settings can be submitted as an array.
 
         '''
         self.jobid = None
+        self.rule = rule
+
+        # set if the job is submitted as part of a JobArray
+        self.array = None
+        self.array_index = None
+
+        # how urgent the job is compared to the rest of the build (0-1, set
+        # by the submission order, see JobGraph.priorities)
+        self.priority = None
 
-        # these are job runner specific settings
-        self.args=kwargs
+        # these are job runner specific settings (shared by jobs with the
+        # same settings)
+        self.args = intern_args(kwargs)
 
-        self.src = src
+        # src may also be a function that returns the script body; it will be
+        # called the first time the source is needed.
+        self._src = src
+        self._name = name
         self.outputs = outputs if outputs else []
+        self.inputs = inputs if inputs else []
+
+        # pre and post are the same for every job in a build, so they are
+        # passed in (and kept) by reference
         self._pre = pre
         self._post = post
 
-        if depends:
-            self._depends = set(depends)
-        else:
-            self._depends = set()
+        # the jobs (or job-ids) this job depends on
+        self._depends = _unique(depends) if depends else ()
 
-        if name:
-            self.name = name
-        else:
-            self.name = "job"
+    @property
+    def src(self):
+        if callable(self._src):
+            self._src = self._src()
+        return self._src
+
+    @property
+    def name(self):
+        if not self._name:
+            self._name = "job"
             for line in self.src.split('\n'):
                 if line.strip() and line.strip()[0] != '#':
-                    self.name = line.strip().split(' ')[0]
+                    self._name = line.strip().split(' ')[0]
                     break
+        return self._name
 
     @property
     def pre(self):
@@ -78,7 +155,18 @@ class Job(object):
         return '<%s: %s>' % (self.name, ','.join(self.outputs))
 
     def add_dep(self, dep):
-        self._depends.add(dep)
+        self.add_deps([dep])
+
+    def add_deps(self, deps):
+        self._depends = _unique(self._depends + tuple(deps))
+
+    def release(self):
+        '''
+        Drops the job's script once it has been submitted and logged. The
+        job's name is kept.
+        '''
+        self.name
+        self._src = None
 
     def _dump(self, i=0):
         for dep in self._depends:
@@ -87,34 +175,649 @@ class Job(object):
         indent = ' ' * (i * 4)
         sys.stderr.write('%s%s\n' % (indent, self))
 
-    def flatten(self, l=None):
-        if l is None:
-            l = []
-        
-        for d in self._depends:
+    def flatten(self):
+        '''
+        Returns this job and everything it depends on (jobs and job-ids),
+        with each job after all of its dependencies.
+        '''
+        return JobGraph.from_job(self).order()
+
+
+class JobArray(object):
+    '''
+    A group of jobs built from the same rule with the same settings that are
+    submitted together as one array job. Each job is run as one task of the
+    array, and is given the job-id "{arrayid}_{index}" (indexes start at 1),
+    so that other jobs can still depend on it.
+
+    taskvar is the environment variable the scheduler uses to pass the task
+    index to the script (SGE_TASK_ID, SLURM_ARRAY_TASK_ID).
+    '''
+    def __init__(self, jobs, taskvar):
+        self.jobs = jobs
+        self.taskvar = taskvar
+        self.jobid = None
+
+        for i, job in enumerate(jobs):
+            job.array = self
+            job.array_index = i + 1
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __repr__(self):
+        return '<%s[%s]>' % (self.name, len(self.jobs))
+
+    @property
+    def args(self):
+        return self.jobs[0].args
+
+    @property
+    def name(self):
+        return self.jobs[0].name
+
+    @property
+    def pre(self):
+        return self.jobs[0].pre
+
+    @property
+    def post(self):
+        return self.jobs[0].post
+
+    @property
+    def priority(self):
+        # the scheduler has one priority for the whole array
+        priorities = [job.priority for job in self.jobs if job.priority is not None]
+        return max(priorities) if priorities else None
+
+    @property
+    def direct_exec(self):
+        return False
+
+    @property
+    def outputs(self):
+        # outputs are removed per-task (see table)
+        return []
+
+    @property
+    def src(self):
+        return 'task_${%s}' % self.taskvar
+
+    @property
+    def cleanup(self):
+        return 'cleanup_${%s}' % self.taskvar
+
+    @property
+    def depids(self):
+        depids = []
+        for job in self.jobs:
+            for depid in job.depids:
+                if not depid in depids:
+                    depids.append(depid)
+        return depids
+
+    def set_jobid(self, jobid):
+        self.jobid = jobid
+        for job in self.jobs:
+            job.jobid = '%s_%s' % (jobid, job.array_index)
+
+    def aligned(self):
+        '''
+        Checks to see if each task only depends on the task with the same
+        index in another (same sized) array, plus jobs that all of the tasks
+        depend on. If so, the scheduler can track the dependencies element-wise
+        and returns (upstream array, list of other job-ids). Otherwise returns
+        None.
+        '''
+        upstream = None
+        shared = None
+
+        for job in self.jobs:
+            elements = []
+            others = set()
+            for d in job._depends:
+                if type(d) != str and d.array:
+                    elements.append(d)
+                else:
+                    others.add(d)
+
+            if len(elements) != 1 or elements[0].array_index != job.array_index:
+                return None
+
+            if upstream is None:
+                upstream = elements[0].array
+            elif elements[0].array is not upstream:
+                return None
+
+            if shared is None:
+                shared = others
+            elif shared != others:
+                return None
+
+        if not upstream or not upstream.jobid or len(upstream) != len(self):
+            return None
+
+        depids = []
+        for d in shared:
             if type(d) == str:
-                if not d in l:
-                    l.append(d)
-            else:
-                d.flatten(l)
+                depids.append(d)
+            elif d.jobid:
+                depids.append(d.jobid)
+
+        return upstream, depids
 
-        if self not in l:
-            l.append(self)
+    def table(self):
+        '''
+        The per-task table: a function to run each task, and a function to
+        remove the task's outputs if it fails.
+        '''
+        keepfailed = 'keepfailed' in self.args and self.args['keepfailed']
+
+        src = ''
+        for job in self.jobs:
+            src += 'task_%s() {\n%s\n}\n' % (job.array_index, job.src if job.src.strip() else ':')
+            src += 'cleanup_%s() {\n' % job.array_index
+            src += '  :\n'
+            if not keepfailed:
+                for out in job.outputs:
+                    if out[0] != '.':
+                        src += '  if [ -e "%s" ]; then rm "%s"; fi\n' % (out, out)
+            src += '}\n'
+        return src
+
+
+def split_jobid(jobid):
+    '''
+    Array tasks are tracked as "{arrayid}_{index}" - returns (arrayid, index).
+    For other jobs, index is None.
+    '''
+    m = re.match('^(.+)_([0-9]+)$', jobid)
+    if m:
+        return m.group(1), int(m.group(2))
+    return jobid, None
+
+
+def numeric_jobid(jobid):
+    '''
+    Returns True if a job-id (or array task) looks like one that SGE or SLURM
+    assigned: a number, or "{number}_{index}". Other ids (ex: the testjob.N
+    ids from dry runs) can't be valid, so they aren't sent to the scheduler.
+    '''
+    return split_jobid(jobid)[0].isdigit()
+
+
+def expand_tasks(spec):
+    '''
+    Expands the task indexes for an array job, as the schedulers list them
+    when the tasks haven't started yet (ex: "1-10", "[1-3,5,7-10%2]",
+    "4-10:2"), into a set of indexes.
+    '''
+    tasks = set()
+    spec = spec.strip().strip('[]').split('%')[0]
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+
+        step = 1
+        if ':' in part:
+            part, step = part.split(':', 1)
+            step = int(step)
+
+        if '-' in part:
+            start, end = part.split('-', 1)
+            tasks.update(xrange(int(start), int(end) + 1, step))
+        else:
+            tasks.add(int(part))
+    return tasks
+
+
+def coalesce(jobs, taskvar, max_size=1000):
+    '''
+    Groups jobs that were built from the same rule and have the same settings
+    (job.* values, pre and post) into JobArrays of at most max_size tasks.
+    Jobs that can't be grouped are returned as-is. The first job of each
+    group keeps its place in the list.
+    '''
+    groups = {}
+    units = []
+    for job in jobs:
+        if job.rule is None or job.direct_exec:
+            units.append([job])
+            continue
+
+        key = (id(job.rule), _args_key(job.args), job.pre, job.post)
+        if not key in groups or len(groups[key]) >= max_size:
+            groups[key] = []
+            units.append(groups[key])
+        groups[key].append(job)
+
+    out = []
+    for unit in units:
+        if len(unit) > 1:
+            out.append(JobArray(unit, taskvar))
+        else:
+            out.append(unit[0])
+    return out
+
+
+# the submission orders (see JobGraph.priorities)
+ORDERS = ['critical', 'breadth', 'depth']
+
+
+def estimate_durations(jobs):
+    '''
+    Returns a function that estimates the duration of a job (in seconds)
+    from its walltime. Jobs without a walltime are given the average of the
+    jobs that have one (or 1, if none do, so that each job counts the same).
+    '''
+    known = {}
+    for job in jobs:
+        if 'walltime' in job.args:
+            known[job] = mvpipe.support.calc_seconds(job.args['walltime'])
+
+    default = float(sum(known.values())) / len(known) if known else 1
+
+    def duration(job):
+        return known.get(job, default)
+    return duration
+
+
+class JobGraph(object):
+    '''
+    The dependency graph for a build. The nodes are Jobs, or job-ids (str) for
+    jobs that were submitted by an earlier run. Each node is given an integer
+    index when it is added, and the edges are kept as sets of indexes in both
+    directions, so dependencies, dependents, roots and leaves can be found
+    without walking the graph.
+    '''
+    def __init__(self):
+        self.nodes = []
+        self._index = {}
+        self._deps = []
+        self._rdeps = []
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __contains__(self, node):
+        return node in self._index
+
+    def add(self, node):
+        if node in self._index:
+            return self._index[node]
+
+        idx = len(self.nodes)
+        self.nodes.append(node)
+        self._index[node] = idx
+        self._deps.append(set())
+        self._rdeps.append(set())
+        return idx
+
+    def add_dep(self, node, dep):
+        '''
+        node depends on dep (both are added to the graph if needed)
+        '''
+        idx = self.add(node)
+        depidx = self.add(dep)
+        self._deps[idx].add(depidx)
+        self._rdeps[depidx].add(idx)
+
+    def deps(self, node):
+        return [self.nodes[i] for i in sorted(self._deps[self._index[node]])]
+
+    def dependents(self, node):
+        return [self.nodes[i] for i in sorted(self._rdeps[self._index[node]])]
+
+    def roots(self):
+        '''
+        Nodes that don't depend on anything
+        '''
+        return [node for i, node in enumerate(self.nodes) if not self._deps[i]]
+
+    def leaves(self):
+        '''
+        Nodes that nothing depends on
+        '''
+        return [node for i, node in enumerate(self.nodes) if not self._rdeps[i]]
+
+    def _walk(self, node, edges):
+        seen = set([self._index[node]])
+        stack = [self._index[node]]
+        while stack:
+            for i in edges[stack.pop()]:
+                if not i in seen:
+                    seen.add(i)
+                    stack.append(i)
+        return [self.nodes[i] for i in sorted(seen)]
+
+    def ancestors(self, node):
+        '''
+        The node and everything it depends on (directly or not)
+        '''
+        return self._walk(node, self._deps)
+
+    def descendants(self, node):
+        '''
+        The node and everything that depends on it (directly or not)
+        '''
+        return self._walk(node, self._rdeps)
+
+    def subgraph(self, nodes):
+        '''
+        A new graph with only these nodes (and the edges between them)
+        '''
+        graph = JobGraph()
+        for node in nodes:
+            graph.add(node)
+
+        for node in nodes:
+            for i in self._deps[self._index[node]]:
+                if self.nodes[i] in graph:
+                    graph.add_dep(node, self.nodes[i])
+        return graph
+
+    def order(self):
+        '''
+        Returns all of the nodes with each one after all of its dependencies.
+        Nodes that are ready at the same time are kept in the order that they
+        were added.
+        '''
+        waiting = [len(d) for d in self._deps]
+        ready = collections.deque([i for i, n in enumerate(waiting) if n == 0])
+        out = []
+        while ready:
+            i = ready.popleft()
+            out.append(self.nodes[i])
+            for j in sorted(self._rdeps[i]):
+                waiting[j] -= 1
+                if waiting[j] == 0:
+                    ready.append(j)
+
+        if len(out) != len(self.nodes):
+            raise ValueError('Cycle in the job graph: %s' % ', '.join([str(self.nodes[i]) for i, n in enumerate(waiting) if n > 0]))
+        return out
+
+    def layers(self):
+        '''
+        Splits the jobs into layers: each job is placed in the layer after the
+        last of its dependencies, so all of the jobs in a layer can be
+        submitted together. Job-ids (str) are skipped.
+        '''
+        depth = {}
+        out = []
+        for node in self.order():
+            if type(node) == str:
+                continue
+
+            d = 0
+            for i in self._deps[self._index[node]]:
+                if i in depth:
+                    d = max(d, depth[i] + 1)
+            depth[self._index[node]] = d
+
+            while len(out) <= d:
+                out.append([])
+            out[d].append(node)
+
+        return out
+
+    def critical_path(self, duration):
+        '''
+        For each node, the length of the longest chain of jobs that starts
+        with it (its own duration plus the longest path through the jobs that
+        depend on it). duration(job) is the estimated duration for a job.
+        Job-ids (str) have no duration.
+        '''
+        length = [0] * len(self.nodes)
+        for node in reversed(self.order()):
+            i = self._index[node]
+            d = duration(node) if type(node) != str else 0
+            length[i] = d + max([length[j] for j in self._rdeps[i]] or [0])
+        return dict([(node, length[i]) for i, node in enumerate(self.nodes)])
+
+    def depth_first(self):
+        '''
+        Returns all of the nodes with each one after all of its dependencies,
+        starting from the leaves, so that each chain (ex: the jobs for one
+        sample) comes before the next one is started.
+        '''
+        seen = set()
+        out = []
+        for leaf in self.leaves():
+            stack = [(self._index[leaf], False)]
+            while stack:
+                i, expanded = stack.pop()
+                if expanded:
+                    out.append(self.nodes[i])
+                    continue
+                if i in seen:
+                    continue
+                seen.add(i)
+                stack.append((i, True))
+                for j in sorted(self._deps[i], reverse=True):
+                    if not j in seen:
+                        stack.append((j, False))
+        return out
+
+    def priorities(self, order, duration=None):
+        '''
+        Ranks the jobs for a submission order (see ORDERS) and returns
+        {job: priority}, with priorities from 0 (least urgent) to 1 (most
+        urgent).
+
+        critical - jobs at the start of the longest chains (by estimated
+                   duration, see estimate_durations) first
+        breadth  - each step for all of the samples before the next step
+        depth    - all of the steps for one sample before the next sample
+        '''
+        jobs = [node for node in self.nodes if type(node) != str]
+
+        if order == 'critical':
+            if not duration:
+                duration = estimate_durations(jobs)
+            length = self.critical_path(duration)
+            score = dict([(job, length[job]) for job in jobs])
+        elif order == 'breadth':
+            score = {}
+            for i, layer in enumerate(self.layers()):
+                for job in layer:
+                    score[job] = -i
+        elif order == 'depth':
+            score = {}
+            for i, node in enumerate(self.depth_first()):
+                if type(node) != str:
+                    score[node] = -i
+        else:
+            raise ValueError('Unknown submission order: %s' % order)
+
+        if not score:
+            return {}
+
+        lo = min(score.values())
+        hi = max(score.values())
+        if hi == lo:
+            return dict([(job, 1.0) for job in score])
+        return dict([(job, float(score[job] - lo) / (hi - lo)) for job in score])
+
+    @staticmethod
+    def from_job(job):
+        '''
+        Builds the graph for a job and everything it depends on
+        '''
+        graph = JobGraph()
+        graph.add(job)
+        stack = [job]
+        while stack:
+            node = stack.pop()
+            if type(node) == str:
+                continue
+            for dep in node._depends:
+                if not dep in graph:
+                    stack.append(dep)
+                graph.add_dep(node, dep)
+        return graph
+
+
+def runtime_src(preamble, pre, post):
+    '''
+    The code that is shared by the job scripts in a run: the runner's
+    preamble, and the __pre__ and __post__ bodies as functions (if they are
+    set). Job scripts call __pre__ and __post__ around their own source.
+    '''
+    src = 'set -o pipefail\n'
+    src += preamble
+    if pre:
+        src += '__pre__() {\n:\n%s\n}\n' % pre
+    if post:
+        # ':' comes first, so the return value is still from the last
+        # command in post
+        src += '__post__() {\n:\n%s\n}\n' % post
+    return src
+
+
+def job_body(job):
+    '''
+    The body of a job script, calling the shared __pre__ and __post__
+    functions (see runtime_src)
+    '''
+    body = ''
+    if job.pre:
+        body += '__pre__\n'
+    body += job.src
+    if job.post:
+        body += '\n__post__'
+    return body
+
+
+class RuntimeLibrary(object):
+    '''
+    A content-addressed store for the code shared by the job scripts in a
+    run (see runtime_src). Each version of the code is written once, as
+    {path}/runtime.{sha1}.sh, and sourced by the job scripts, so the
+    scripts that are submitted only need their own source. The path should
+    be on a filesystem that is shared with the cluster nodes.
+    '''
+    def __init__(self, path, dryrun=False, log=None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.dryrun = dryrun
+        self.log = log
+        self._known = set()
+        self._lock = threading.Lock()
 
-        return l
+    def fname(self, key):
+        return os.path.join(self.path, 'runtime.%s.sh' % key)
+
+    def store(self, src):
+        '''
+        Writes the code (if it hasn't been already) and returns the filename
+        '''
+        key = hashlib.sha1(src).hexdigest()
+        fname = self.fname(key)
+
+        with self._lock:
+            if key in self._known:
+                return fname
+
+            if not self.dryrun and not os.path.exists(fname):
+                if not os.path.exists(self.path):
+                    try:
+                        os.makedirs(self.path)
+                    except OSError:
+                        # another run may have made it
+                        if not os.path.isdir(self.path):
+                            raise
+
+                # written to a temp file first, so a job never sources a
+                # partial file
+                fd, tmp = tempfile.mkstemp(dir=self.path)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(src)
+                os.chmod(tmp, 0644)
+                os.rename(tmp, fname)
+
+            if self.log:
+                self.log('Runtime library: %s' % fname)
+                for line in src.split('\n'):
+                    self.log('runtime: %s' % line, level=mvpipe.logger.DEBUG)
+
+            self._known.add(key)
+        return fname
 
 
 class Runner(object):
+    # the environment variable with the task index for array jobs (if the
+    # runner supports them)
+    array_taskvar = None
+
+    # the number of jobs that can be submitted at the same time (from
+    # different threads). Runners that can handle more should set this
+    # and protect any shared state with self._lock.
+    max_submit = 1
+
+    # set if the runner still needs the jobs' scripts after they have been
+    # submitted (if the jobs are only run in done())
+    deferred = False
+
     def __init__(self, dryrun, verbose, logger=None):
         self.dryrun = dryrun
         self.verbose = verbose
         self.logger = logger
         self._name = None
+        self._lock = threading.RLock()
+
+        # the shared runtime library, for runners that support one
+        self.runtime = None
+
+        # the number of jobs that failed, for runners that run the jobs
+        # themselves (set by done())
+        self.failed = 0
+
+        # merged job options (see merge_options)
+        self._merged_options = {}
 
         # self._output_jobs = {}
 
     def check_jobid(self, jobid):
-        return False, None
+        return False
+
+    def check_jobids(self, jobids):
+        '''
+        Checks a list of job-ids at once. Returns a dict of jobid => True/False
+        (is the job still valid). Runners should override this to query the
+        scheduler in bulk. If the scheduler can't be queried, this raises a
+        RuntimeError (jobs are only invalid if the scheduler says so).
+        '''
+        valid = {}
+        for jobid in jobids:
+            valid[jobid] = self.check_jobid(jobid)
+        return valid
+
+    def merge_options(self, defaults, args):
+        '''
+        Returns the runner's default options updated with a job's (interned)
+        settings. The merged options are shared by all jobs with the same
+        settings, so they shouldn't be changed.
+        '''
+        key = (id(defaults), id(args))
+        entry = self._merged_options.get(key)
+        if entry is None:
+            opts = dict(defaults)
+            opts.update(args)
+            # defaults and args are kept, so that their ids can't be reused
+            entry = self._merged_options[key] = (defaults, args, opts)
+        return entry[2]
+
+    def coalesce(self, jobs):
+        '''
+        Given a list of jobs that don't depend on each other, returns the
+        list of Jobs (or JobArrays) to submit. By default, each job is
+        submitted on its own.
+        '''
+        return list(jobs)
 
     def reset(self):
         raise NotImplementedError
@@ -122,13 +825,47 @@ class Runner(object):
     def abort(self):
         pass
 
-    def log(self, msg, tostderr=False):
-        if self.logger:
-            self.logger.write('%s' % msg)
-            if tostderr:
+    def log(self, msg, tostderr=False, level=mvpipe.logger.INFO):
+        with self._lock:
+            if self.logger:
+                self.logger.write('%s' % msg, level)
+                if tostderr:
+                    sys.stderr.write('%s\n' % msg)
+            else:
                 sys.stderr.write('%s\n' % msg)
-        else:
-            sys.stderr.write('%s\n' % msg)
+
+    def log_script(self, jobid, src, table=None):
+        '''
+        Logs the script for a submitted job (as a reference to the script
+        archive, if the logger has one). In verbose mode, the whole script
+        is also written to stderr.
+
+        For array jobs, table is the per-task table (JobArray.table), which
+        grows with each task. Outside of the archive, it is logged as a
+        one-line summary (task count, size and hash) instead.
+        '''
+        summary = src
+        if table:
+            summary = src.replace(table, '# task table: %s task(s), %s bytes, sha1 %s\n' % (len(re.findall(r'^task_\S+\(\) \{$', table, re.M)), len(table), hashlib.sha1(table).hexdigest()))
+
+        with self._lock:
+            if self.logger:
+                self.logger.write('job: %s' % jobid)
+                self.logger.write_script('job: ', src if self.logger.archive else summary)
+
+            if self.verbose or not self.logger:
+                for line in summary.split('\n'):
+                    sys.stderr.write('job: %s\n' % line)
+
+    def source_runtime(self, job, preamble=''):
+        '''
+        Returns the code that sets up a job script (see runtime_src). With a
+        runtime library, this just sources the shared file.
+        '''
+        src = runtime_src(preamble, job.pre, job.post)
+        if self.runtime:
+            return '. "%s"\n' % self.runtime.store(src)
+        return src
 
     @property
     def name(self):
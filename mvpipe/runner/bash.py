@@ -41,6 +41,8 @@ class BashRunner(Runner):
                 proc = subprocess.Popen([shell], stdin=subprocess.PIPE)
                 proc.communicate(input=src)
                 proc.wait()
+                if proc.returncode != 0:
+                    self.failed = 1
 
 
     def submit(self, job):
@@ -0,0 +1,287 @@
+'''
+Job runner that executes the pipeline on the local machine
+
+Jobs are started as soon as the jobs they depend on have finished
+successfully, as long as there are enough free processors and memory for the
+job (job.procs, job.mem). If the next job in line doesn't fit, smaller jobs
+that do fit are started in the gap. If a job fails, all of the jobs that
+depend on it are cancelled.
+
+'''
+
+import os
+import sys
+import stat
+import time
+import signal
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import mvpipe.config
+import mvpipe.support
+from mvpipe.runner import Runner, JobGraph
+
+'''
+Local options:
+
+procs       - the number of processors to use (default: all of them)
+
+mem         - the amount of memory to use (ex: 16G, default: all of it)
+
+limits      - enforce each job's memory (job.mem) and CPU time
+              (job.walltime * job.procs) with rlimits (default: True)
+
+'''
+class LocalRunner(Runner):
+    # the jobs are run in done()
+    deferred = True
+
+    def __init__(self, dryrun, verbose, logger, procs=None, mem=None, limits=True, poll=0.1):
+        Runner.__init__(self, dryrun, verbose, logger)
+        self.procs = int(procs) if procs else multiprocessing.cpu_count()
+        self.mem = mvpipe.support.calc_mem(mem) if mem else _total_mem()
+        self.limits = limits
+        self.poll = float(poll)
+
+        self.jobs = []
+        self._jobs = {}
+        self._name = 'local'
+
+    def reset(self):
+        pass
+
+    def submit(self, job):
+        if not job.src:
+            return
+
+        job.jobid = 'local.%s' % (len(self.jobs) + 1)
+        self.jobs.append(job)
+        self._jobs[job.jobid] = job
+
+    def _needs(self, job):
+        procs = int(job.args['procs']) if 'procs' in job.args else 1
+        mem = mvpipe.support.calc_mem(job.args['mem']) if 'mem' in job.args else 0
+
+        # jobs that are bigger than the machine run by themselves
+        return min(max(procs, 1), self.procs), min(mem, self.mem)
+
+    def _deps(self, job):
+        deps = []
+        for depid in job.depids:
+            if depid in self._jobs:
+                deps.append(depid)
+            else:
+                self.log('WARNING: %s depends on a job outside of this run (%s), ignoring' % (job.jobid, depid), True)
+        return deps
+
+    def done(self):
+        if not self.jobs:
+            return
+
+        if self.dryrun:
+            for job in self.jobs:
+                procs, mem = self._needs(job)
+                print '%s\t%s\tprocs=%s\tmem=%s\tdepends=%s' % (job.jobid, job.name, procs, mem, ','.join(self._deps(job)))
+            return
+
+        tmpdir = tempfile.mkdtemp(prefix='mvpipe.')
+        try:
+            self.run(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def run(self, tmpdir):
+        graph = JobGraph()
+        for job in self.jobs:
+            graph.add(job)
+            for depid in self._deps(job):
+                graph.add_dep(job, self._jobs[depid])
+
+        status = {}
+        times = {}
+        # with a submission order, the most urgent jobs are started first
+        pending = sorted(self.jobs, key=lambda job: -(job.priority or 0))
+        running = {}
+        free_procs = self.procs
+        free_mem = self.mem
+
+        self.log('Running %s job(s) with %s processors, %s memory' % (len(self.jobs), self.procs, _fmt_mem(self.mem)), True)
+
+        try:
+            while pending or running:
+                for job in list(pending):
+                    if [d for d in graph.deps(job) if status.get(d.jobid) != 'done']:
+                        continue
+
+                    procs, mem = self._needs(job)
+                    if procs > free_procs or mem > free_mem:
+                        # try to fit smaller jobs in the gap
+                        continue
+
+                    pending.remove(job)
+                    free_procs -= procs
+                    free_mem -= mem
+                    running[job.jobid] = (self._start(job, tmpdir), time.time())
+                    status[job.jobid] = 'running'
+                    self.log('Started: %s %s' % (job.jobid, job.name), self.verbose)
+
+                if not running:
+                    # this shouldn't happen...
+                    self.log('ERROR: no jobs can be started: %s' % ', '.join([j.jobid for j in pending]), True)
+                    break
+
+                time.sleep(self.poll)
+
+                for jobid in running.keys():
+                    job = self._jobs[jobid]
+                    proc, start = running[jobid]
+
+                    if proc.poll() is None:
+                        if 'walltime' in job.args and time.time() - start > mvpipe.support.calc_seconds(job.args['walltime']):
+                            self.log('Job %s exceeded its walltime, killing it' % jobid, True)
+                            _kill(proc)
+                        continue
+
+                    del running[jobid]
+                    times[jobid] = time.time() - start
+                    procs, mem = self._needs(job)
+                    free_procs += procs
+                    free_mem += mem
+
+                    if proc.returncode == 0:
+                        status[jobid] = 'done'
+                        self.log('Finished: %s %s (%s)' % (jobid, job.name, _fmt_time(times[jobid])), self.verbose)
+                    else:
+                        status[jobid] = 'failed'
+                        self.log('Failed: %s %s (exit: %s)' % (jobid, job.name, proc.returncode), True)
+
+                        # cancel everything downstream of this job
+                        for child in graph.descendants(job):
+                            if not child.jobid in status:
+                                status[child.jobid] = 'cancelled'
+                                pending.remove(child)
+                                self.log('Cancelled: %s %s' % (child.jobid, child.name), True)
+
+        except KeyboardInterrupt:
+            for jobid in running:
+                _kill(running[jobid][0])
+                status[jobid] = 'killed'
+            self.report(status, times)
+            raise
+
+        self.report(status, times)
+
+    def report(self, status, times):
+        '''
+        Logs the status of each job, and sets self.failed to the number of
+        jobs that didn't finish
+        '''
+        failed = 0
+        self.log('Job report:')
+        for job in self.jobs:
+            st = status.get(job.jobid, 'not run')
+            if st != 'done':
+                failed += 1
+            wall = _fmt_time(times[job.jobid]) if job.jobid in times else '-'
+            self.log('    %s\t%s\t%s\t%s' % (job.jobid, st, wall, job.name), self.verbose)
+
+        if failed:
+            self.log('%s of %s job(s) did not finish' % (failed, len(self.jobs)), True)
+        else:
+            self.log('All %s job(s) finished' % len(self.jobs), True)
+
+        self.failed = failed
+
+    def _script(self, job):
+        if 'shell' in job.args:
+            shell = job.args['shell']
+        else:
+            shell = mvpipe.config.get_shell()
+
+        body = ''
+        if job.pre:
+            body += '%s\n' % job.pre
+        body += job.src
+        if job.post:
+            body += '\n%s' % job.post
+
+        src = '#!%s\n' % shell
+        src += 'set -o pipefail\nfunc () {\n  %s\n  return $?\n}\n' % body
+        src += 'func\n'
+        src += 'RETVAL=$?\n'
+        src += 'if [ $RETVAL -ne 0 ]; then\n'
+        src += '  :\n'
+        if not 'keepfailed' in job.args or not job.args['keepfailed']:
+            for out in job.outputs:
+                if out[0] != '.':
+                    src += '  if [ -e "%s" ]; then rm "%s"; fi\n' % (out, out)
+        src += 'fi\n'
+        src += 'exit $RETVAL\n'
+        return src
+
+    def _start(self, job, tmpdir):
+        fname = os.path.join(tmpdir, '%s.sh' % job.jobid)
+        src = self._script(job)
+        with open(fname, 'w') as f:
+            f.write(src)
+        os.chmod(fname, stat.S_IRUSR | stat.S_IXUSR)
+
+        self.log_script(job.jobid, src)
+
+        stdout = open(job.args['stdout'], 'w') if 'stdout' in job.args else None
+        stderr = open(job.args['stderr'], 'w') if 'stderr' in job.args else None
+
+        procs, mem = self._needs(job)
+        cputime = None
+        if 'walltime' in job.args:
+            cputime = mvpipe.support.calc_seconds(job.args['walltime']) * procs
+
+        def setup():
+            # new process group, so the whole job can be killed
+            os.setsid()
+            if self.limits and resource:
+                if mem:
+                    resource.setrlimit(resource.RLIMIT_AS, (mem, mem))
+                if cputime:
+                    resource.setrlimit(resource.RLIMIT_CPU, (cputime, cputime))
+
+        try:
+            return subprocess.Popen([fname], stdout=stdout, stderr=stderr, cwd=job.args['wd'] if 'wd' in job.args else None, preexec_fn=setup, close_fds=True)
+        finally:
+            if stdout:
+                stdout.close()
+            if stderr:
+                stderr.close()
+
+
+def _kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def _total_mem():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return sys.maxint
+
+
+def _fmt_time(secs):
+    return '%s (%.1fs)' % (mvpipe.support.calc_time(str(int(secs))), secs)
+
+
+def _fmt_mem(val):
+    for unit in ['', 'K', 'M', 'G']:
+        if val < 1024:
+            return '%.0f%s' % (val, unit)
+        val = val / 1024.0
+    return '%.1fT' % val
@@ -0,0 +1,206 @@
+import os
+import sys
+import stat
+import subprocess
+
+import mvpipe.config
+from mvpipe.runner import Runner
+
+'''
+Ninja/Make options:
+
+ninja_file  - the build file to write (default: build.ninja)
+
+makefile    - also write a Makefile with the same build graph (default: none)
+
+scriptdir   - the directory for the job scripts (default: .mvpipe)
+
+restat      - let ninja skip downstream jobs if a job didn't change its
+              outputs (default: True)
+
+autoexec    - run ninja after the build file is written (default: False)
+
+jobs        - the number of jobs for ninja to run at once with autoexec
+              (default: ninja's default)
+
+'''
+class NinjaRunner(Runner):
+    def __init__(self, dryrun, verbose, logger, ninja_file='build.ninja', makefile=None, scriptdir='.mvpipe', restat=True, autoexec=False, jobs=None):
+        Runner.__init__(self, dryrun, verbose, logger)
+        self.ninja_file = ninja_file
+        self.makefile = makefile
+        self.scriptdir = scriptdir
+        self.restat = restat
+        self.autoexec = autoexec
+        self.jobs = jobs
+
+        # (jobid, outputs, inputs, deps, script, src)
+        self.edges = []
+        self._outputs = {}
+
+        self._name = 'ninja'
+
+    def reset(self):
+        pass
+
+    def submit(self, job):
+        src = job.src
+        if not src:
+            return
+
+        jobid = 'job_%s' % (len(self.edges) + 1)
+        script = os.path.join(self.scriptdir, '%s.sh' % jobid)
+
+        outputs = list(job.outputs)
+        stamp = None
+        if not outputs:
+            # jobs without outputs still need something for ninja/make to track
+            stamp = os.path.join(self.scriptdir, '%s.stamp' % jobid)
+            outputs = [stamp]
+
+        deps = []
+        for dep in job.depids:
+            if dep in self._outputs:
+                for out in self._outputs[dep]:
+                    if not out in deps:
+                        deps.append(out)
+            else:
+                self.log('WARNING: %s depends on a job outside of this build (%s), ignoring' % (jobid, dep))
+
+        # outputs from the jobs this one depends on that aren't listed as
+        # inputs are added as implicit dependencies
+        inputs = list(job.inputs)
+        deps = [x for x in deps if not x in inputs]
+
+        self.edges.append((jobid, outputs, inputs, deps, script, self._script(job, stamp)))
+        self._outputs[jobid] = outputs
+        job.jobid = jobid
+
+    def _script(self, job, stamp):
+        if 'shell' in job.args:
+            shell = job.args['shell']
+        else:
+            shell = mvpipe.config.get_shell()
+
+        body = ''
+        if job.pre:
+            body += '%s\n' % job.pre
+        body += job.src
+        if job.post:
+            body += '\n%s' % job.post
+
+        src = '#!%s\n' % shell
+        if 'wd' in job.args:
+            src += 'cd "%s" || exit 1\n' % job.args['wd']
+
+        src += 'set -o pipefail\nfunc () {\n  %s\n  return $?\n}\n' % body
+        src += 'func\n'
+        src += 'RETVAL=$?\n'
+        src += 'if [ $RETVAL -ne 0 ]; then\n'
+        src += '  :\n'
+        if not 'keepfailed' in job.args or not job.args['keepfailed']:
+            for out in job.outputs:
+                if out[0] != '.':
+                    src += '  if [ -e "%s" ]; then rm "%s"; fi\n' % (out, out)
+        if stamp:
+            src += 'else\n'
+            src += '  touch "%s"\n' % stamp
+        src += 'fi\n'
+        src += 'exit $RETVAL\n'
+        return src
+
+    def ninja_src(self):
+        src = '# generated by mvpipe\n'
+        src += 'ninja_required_version = 1.3\n\n'
+        src += 'rule mvpipe\n'
+        src += '  command = $script\n'
+        src += '  description = $name\n'
+        if self.restat:
+            src += '  restat = 1\n'
+        src += '\n'
+
+        for jobid, outputs, inputs, deps, script, _ in self.edges:
+            src += 'build %s: mvpipe' % ' '.join([_ninja_escape(x) for x in outputs])
+            if inputs:
+                src += ' %s' % ' '.join([_ninja_escape(x) for x in inputs])
+            # the script is an implicit dependency, so changing the recipe
+            # rebuilds the outputs
+            src += ' | %s' % ' '.join([_ninja_escape(x) for x in deps + [script]])
+            src += '\n'
+            src += '  script = %s\n' % _ninja_escape(script)
+            src += '  name = %s\n\n' % jobid
+
+        return src
+
+    def make_src(self):
+        src = '# generated by mvpipe\n'
+        src += '.PHONY: _mvpipe_all\n'
+        src += '_mvpipe_all: %s\n\n' % ' '.join([_make_escape(out) for edge in self.edges for out in edge[1]])
+
+        for jobid, outputs, inputs, deps, script, _ in self.edges:
+            # with more than one output, the recipe is attached to the first
+            # one so that it is only run once
+            src += '%s: %s\n' % (_make_escape(outputs[0]), ' '.join([_make_escape(x) for x in inputs + deps + [script]]))
+            src += '\t%s\n' % _make_escape(script)
+            for out in outputs[1:]:
+                src += '%s: %s\n' % (_make_escape(out), _make_escape(outputs[0]))
+            src += '\n'
+
+        return src
+
+    def done(self):
+        if not self.edges:
+            return
+
+        if self.dryrun:
+            for jobid, outputs, inputs, deps, script, src in self.edges:
+                print '# %s' % script
+                print src
+            print '# %s' % self.ninja_file
+            print self.ninja_src()
+            if self.makefile:
+                print '# %s' % self.makefile
+                print self.make_src()
+            return
+
+        if not os.path.exists(self.scriptdir):
+            os.makedirs(self.scriptdir)
+
+        for jobid, outputs, inputs, deps, script, src in self.edges:
+            _write_if_changed(script, src)
+            os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+        _write_if_changed(self.ninja_file, self.ninja_src())
+        self.log('Wrote: %s (%s jobs)' % (self.ninja_file, len(self.edges)), True)
+
+        if self.makefile:
+            _write_if_changed(self.makefile, self.make_src())
+            self.log('Wrote: %s' % self.makefile, True)
+
+        if self.autoexec:
+            cmd = ['ninja', '-f', self.ninja_file]
+            if self.jobs:
+                cmd.extend(['-j', str(self.jobs)])
+            retval = subprocess.call(cmd)
+            if retval != 0:
+                sys.stderr.write('ninja exited with status %s\n' % retval)
+                self.failed = 1
+
+
+def _write_if_changed(fname, src):
+    # unchanged files keep their mtime, so ninja/make don't see them as new
+    if os.path.exists(fname):
+        with open(fname) as f:
+            if f.read() == src:
+                return
+
+    with open(fname, 'w') as f:
+        f.write(src)
+
+
+def _ninja_escape(s):
+    return s.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
+def _make_escape(s):
+    return s.replace('$', '$$').replace(' ', '\\ ')
@@ -1,13 +1,45 @@
 import os
 import string
 import subprocess
+import xml.etree.ElementTree
 
 import mvpipe.support
 import mvpipe.config
-from mvpipe.runner import Runner, Job
+from mvpipe.runner import Runner, Job, JobArray, RuntimeLibrary, coalesce, job_body, split_jobid, numeric_jobid, expand_tasks
 
 def_options = {'env': True, 'wd': os.path.abspath(os.curdir), 'mail': 'ea', 'hold': False}
 
+# the functions that every job script needs (shared in the runtime library)
+_preamble = '''\
+FAILED=""
+notify_stop() {
+kill_deps_signal "SIGSTOP"
+}
+notify_kill() {
+kill_deps_signal "SIGKILL"
+}
+kill_deps_signal() {
+  FAILED="1"
+  kill_deps
+}
+kill_deps() {
+  DEPS="$(qstat -f -j $JOB_ID | grep jid_successor_list | awk '{print $2}' | sed -e 's/,/ /g')"
+  if [ "$DEPS" != "" ]; then
+    qdel $DEPS
+  fi
+}
+wait_for_kill() {
+  # wait for SGE to kill the job for accounting purposes (max 120 sec)
+  I=0
+  while [ $I -lt 120 ]; do
+    sleep 1
+    let "I=$I+1"
+  done
+}
+trap notify_stop SIGUSR1
+trap notify_kill SIGUSR2
+'''
+
 '''
 SGE options:
 
@@ -26,9 +58,32 @@ hvmem_total - h_vmem should be specified as the total amount of memory, default
 
 shell       - a shell to use for the script (default(s): /bin/bash, /usr/bin/bash, /usr/local/bin/bash, /bin/sh)
 
+job_arrays  - submit jobs from the same target definition with the same
+              settings as a single array job (-t), default: False
+
+max_array   - the maximum number of tasks in an array job, default: 1000
+
+max_submit  - the maximum number of jobs that can be submitted at the same
+              time, default: 8
+
+array_limit - the maximum number of tasks from an array that can run at the
+              same time (-tc), default: no limit
+
+runtime_dir - the directory for the runtime library that the job scripts
+              source (the shared functions, __pre__ and __post__). This
+              needs to be on a filesystem that the nodes can see. If it is
+              blank, the code is included in each script.
+              default: .mvpipe
+
+priority_range - with a submission order (mvpipe.loader.order), jobs are
+              given a priority (-p) from -{priority_range} (least urgent) to
+              0 (most urgent), default: 100 (max: 1023, 0 to disable)
+
 '''
 class SGERunner(Runner):
-    def __init__(self, dryrun, verbose, logger, global_hold=False, global_depends=None, account=None, parallelenv='shm', hvmem_total=False):
+    array_taskvar = 'SGE_TASK_ID'
+
+    def __init__(self, dryrun, verbose, logger, global_hold=False, global_depends=None, account=None, parallelenv='shm', hvmem_total=False, job_arrays=False, max_array=1000, array_limit=None, max_submit=8, runtime_dir='.mvpipe', priority_range=100):
         Runner.__init__(self, dryrun, verbose, logger)
         self.global_hold = global_hold
         self._holding_job = None
@@ -36,6 +91,13 @@ class SGERunner(Runner):
         self.account = account
         self.parallelenv = parallelenv
         self.hvmem_total = hvmem_total
+        self.job_arrays = job_arrays
+        self.max_array = int(max_array)
+        self.max_submit = int(max_submit)
+        self.array_limit = array_limit
+        self.priority_range = min(int(priority_range), 1023) if priority_range else 0
+        if runtime_dir:
+            self.runtime = RuntimeLibrary(runtime_dir, dryrun, self.log)
 
         self.jobids = []
 
@@ -44,6 +106,11 @@ class SGERunner(Runner):
     def reset(self):
         pass
 
+    def coalesce(self, jobs):
+        if not self.job_arrays:
+            return Runner.coalesce(self, jobs)
+        return coalesce(jobs, self.array_taskvar, self.max_array)
+
     def abort(self):
         if self._holding_job:
             self.qdel(self._holding_job.jobid)
@@ -62,10 +129,62 @@ class SGERunner(Runner):
         self.global_depends.append(self._holding_job.jobid)
 
     def check_jobid(self, jobid):
-        with open('/dev/null', 'w') as devnull:
-            if subprocess.call(["qstat", "-j", jobid], stdout=devnull, stderr=devnull) == 0:
-                return True
+        # array tasks are checked by their array job-id (so a task counts as
+        # valid while any task of the array is still active)
+        if not numeric_jobid(jobid):
+            return False
+
+        try:
+            proc = subprocess.Popen(["qstat", "-j", _base_id(jobid)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate()
+        except OSError, e:
+            raise RuntimeError('Error running qstat: %s' % e)
+
+        if proc.returncode == 0:
+            return True
+
+        # any other error doesn't mean that the job is gone
+        if 'do not exist' in stderr or 'do not exist' in stdout:
             return False
+        raise RuntimeError('Error running qstat (%s): %s' % (proc.returncode, stderr.strip()))
+
+    def check_jobids(self, jobids):
+        # one 'qstat -xml' call lists all of the active (pending/running) jobs
+        try:
+            with open('/dev/null', 'w') as devnull:
+                proc = subprocess.Popen(["qstat", "-xml"], stdout=subprocess.PIPE, stderr=devnull)
+                stdout, stderr = proc.communicate()
+        except OSError, e:
+            raise RuntimeError('Error running qstat: %s' % e)
+
+        if proc.returncode != 0:
+            self.log('Error running qstat, checking jobs individually')
+            return Runner.check_jobids(self, jobids)
+
+        # arrayid => the task indexes that are still active (None for the
+        # whole job). Tasks that haven't started are listed as a range.
+        active = {}
+        for el in xml.etree.ElementTree.fromstring(stdout).iter('job_list'):
+            num = el.findtext('JB_job_number')
+            if not num:
+                continue
+            num = num.strip()
+            tasks = el.findtext('tasks')
+            if tasks and tasks.strip():
+                if active.get(num, set()) is not None:
+                    active.setdefault(num, set()).update(expand_tasks(tasks))
+            else:
+                active[num] = None
+
+        valid = {}
+        for jobid in jobids:
+            base, idx = split_jobid(jobid)
+            base = base.split('.')[0]
+            if not base in active:
+                valid[jobid] = False
+            else:
+                valid[jobid] = active[base] is None or idx is None or idx in active[base]
+        return valid
 
     def qrls(self, jobid):
         subprocess.call(["qrls", jobid])
@@ -77,26 +196,11 @@ class SGERunner(Runner):
         if not job.src:
             return
 
-        if self.global_hold and not self._holding_job:
-            self._setup_holding_job()
-
-        jobopts = dict(def_options)
-        for k in job.args:
-            jobopts[k] = job.args[k]
-
-        body = ''
-
-        if not 'nopre' in jobopts or not jobopts['nopre']:
-            if job.pre:
-                body = job.pre
-                body += '\n'
-
-        body += job.src
-
-        if job.post:
-            body += '\n'
-            body += job.post
+        with self._lock:
+            if self.global_hold and not self._holding_job:
+                self._setup_holding_job()
 
+        jobopts = self.merge_options(def_options, job.args)
 
         if 'shell' in jobopts:
             shell = jobopts['shell']
@@ -111,6 +215,11 @@ class SGERunner(Runner):
         if 'hold' in jobopts and jobopts['hold']:
             src += '#$ -h\n'
 
+        if isinstance(job, JobArray):
+            src += '#$ -t 1-%s\n' % len(job)
+            if self.array_limit:
+                src += '#$ -tc %s\n' % self.array_limit
+
         if 'env' in jobopts and jobopts['env']:
             src += '#$ -V\n'
 
@@ -139,16 +248,29 @@ class SGERunner(Runner):
         if 'stack' in jobopts:
             src += '#$ -l h_stack=%s\n' % jobopts['stack']
 
+        aligned = job.aligned() if isinstance(job, JobArray) else None
+        if aligned:
+            # each task waits for the task with the same index upstream
+            src += '#$ -hold_jid_ad %s\n' % aligned[0].jobid
+
         if job.depids or self.global_depends:
-            depids = job.depids
+            depids = aligned[1] if aligned else job.depids
             if self.global_depends:
                 depids.extend(self.global_depends)
 
-            if depids:
-                src += '#$ -hold_jid %s\n' % ','.join(depids)
+            # SGE can only hold on a whole array job
+            holdids = []
+            for depid in depids:
+                if not _base_id(depid) in holdids:
+                    holdids.append(_base_id(depid))
+
+            if holdids:
+                src += '#$ -hold_jid %s\n' % ','.join(holdids)
 
-        # if 'priority' in jobopts:
-        #     src += '#$ -p %s\n' % jobopts['priority']
+        if job.priority is not None and self.priority_range:
+            # users can only lower the priority (-1023 to 0), so the most
+            # urgent jobs keep the default
+            src += '#$ -p %s\n' % -int(round((1 - job.priority) * self.priority_range))
 
         if 'qos' in jobopts:
             # this is actually the "Project" in SGE terms
@@ -179,29 +301,14 @@ class SGERunner(Runner):
             src += '#$ -e %s\n' % jobopts['stderr']
 
         src += '#$ -notify\n'
-        src += 'FAILED=""\n'
-        src += 'notify_stop() {\nkill_deps_signal "SIGSTOP"\n}\n'
-        src += 'notify_kill() {\nkill_deps_signal "SIGKILL"\n}\n'
-        src += 'kill_deps_signal() {\n'
-        src += '  FAILED="1"\n'
-        src += '  kill_deps\n'
+        src += self.source_runtime(job, _preamble)
 
-        # if monitor:
-        #     src += '  "%s" "%s" abort "%s.$JOB_ID" "$1"\n' % (clustrun.CLUSTRUN_MON_BIN, monitor, cluster)
-
-        src += '}\n'
-
-        src += 'kill_deps() {\n'
-        src += '  DEPS="$(qstat -f -j $JOB_ID | grep jid_successor_list | awk \'{print $2}\' | sed -e \'s/,/ /g\')"\n'
-        src += '  if [ "$DEPS" != "" ]; then\n'
-        src += '    qdel $DEPS\n'
-        src += '  fi\n'
-        src += '}\n'
+        table = None
+        if isinstance(job, JobArray):
+            table = job.table()
+            src += table
 
-        src += 'trap notify_stop SIGUSR1\n'
-        src += 'trap notify_kill SIGUSR2\n'
-    
-        src += 'set -o pipefail\nfunc () {\n  %s\n  return $?\n}\n' % body
+        src += 'func () {\n  %s\n  return $?\n}\n' % job_body(job)
 
         # if monitor:
         #     src += '"%s" "%s" start "%s.$JOB_ID" $HOSTNAME\n' % (clustrun.CLUSTRUN_MON_BIN, monitor, cluster)
@@ -226,6 +333,8 @@ class SGERunner(Runner):
 
         src += '  if [ $RETVAL -ne 0 ]; then\n'
         src += '    kill_deps\n'
+        if isinstance(job, JobArray):
+            src += '    %s\n' % job.cleanup
         for out in job.outputs:
             if not 'keepfailed' in jobopts or not jobopts['keepfailed']:
                 if out[0] != '.':
@@ -236,12 +345,7 @@ class SGERunner(Runner):
 
         src += '  exit $RETVAL\n'
         src += 'else\n'
-        src += '  # wait for SGE to kill the job for accounting purposes (max 120 sec)\n'
-        src += '  I=0\n'
-        src += '  while [ $I -lt 120 ]; do\n'
-        src += '    sleep 1\n'
-        src += '    let "I=$I+1"\n'
-        src += '  done\n'
+        src += '  wait_for_kill\n'
         src += 'fi\n'
 
         if not self.dryrun:
@@ -254,21 +358,31 @@ class SGERunner(Runner):
                 raise RuntimeError(output)
 
             jobid = output.strip()
+            if isinstance(job, JobArray):
+                # -terse returns "jobid.1-N:1" for array jobs
+                jobid = jobid.split('.')[0]
         else:
-            jobid = 'testjob.%s' % self.testjobcount
-            self.testjobcount += 1
+            with self._lock:
+                jobid = 'testjob.%s' % self.testjobcount
+                self.testjobcount += 1
 
-        job.jobid = jobid
+        self._submitted(job, jobid, src, table)
 
-        # for out in job.outputs:
-        #     self._output_jobs[out] = jobid
+    def _submitted(self, job, jobid, src, table=None):
+        # jobs may be submitted from more than one thread
+        with self._lock:
+            if isinstance(job, JobArray):
+                job.set_jobid(jobid)
+            else:
+                job.jobid = jobid
+
+            # for out in job.outputs:
+            #     self._output_jobs[out] = jobid
 
-        print jobid
-        self.jobids.append(jobid)
+            print jobid
+            self.jobids.append(jobid)
 
-        self.log('job: %s' % jobid)
-        for line in src.split('\n'):
-            self.log('job: %s' % line.strip('\n'), self.verbose)
+            self.log_script(jobid, src, table)
 
             # if jobid and monitor and self.postaccounting:
             #     acct_src = accounting_script % (jobid, jobid, jobid, clustrun.CLUSTRUN_MON_BIN, cluster, clustrun.CLUSTRUN_MON_BIN, cluster)
@@ -278,3 +392,10 @@ class SGERunner(Runner):
             #     if retval != 0:
             #         sys.stderr.write('Error submitting accounting job for %s: %s\n' % (jobid, output))
             #         raise RuntimeError(output)
+
+
+def _base_id(jobid):
+    '''
+    Array tasks are tracked as "{jobid}_{index}" - returns the array job-id
+    '''
+    return split_jobid(jobid)[0]
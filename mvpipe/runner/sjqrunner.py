@@ -3,6 +3,16 @@ Job runner for SJQ - Simple Job Queue
 
 SJQ is included with MVpipe as a single-user batch scheduler
 
+SJQ options:
+
+global_hold - start all pipelines with a "placeholder" job to synchronize
+              starts
+
+runtime_dir - the directory for the runtime library that the job scripts
+              source (__pre__ and __post__). If it is blank, the code is
+              included in each script.
+              default: .mvpipe
+
 '''
 
 import os
@@ -11,7 +21,7 @@ import socket
 import string
 import multiprocessing
 import mvpipe.config
-from mvpipe.runner import Runner, Job
+from mvpipe.runner import Runner, Job, RuntimeLibrary, job_body
 
 import sjq.client
 import sjq.server
@@ -19,11 +29,13 @@ import sjq.server
 def_options = {'env': True, 'cwd': os.path.abspath(os.curdir)}
 
 class SJQRunner(Runner):
-    def __init__(self, dryrun, verbose, logger, global_hold=False, global_depends=None):
+    def __init__(self, dryrun, verbose, logger, global_hold=False, global_depends=None, runtime_dir='.mvpipe'):
         Runner.__init__(self, dryrun, verbose, logger)
         self.global_hold = global_hold
         self._holding_job = None
         self.global_depends = global_depends if global_depends else []
+        if runtime_dir:
+            self.runtime = RuntimeLibrary(runtime_dir, dryrun, self.log)
 
         self.jobids = []
 
@@ -105,21 +117,7 @@ class SJQRunner(Runner):
         if self.global_hold and not self._holding_job:
             self._setup_holding_job()
 
-        body = ''
-
-        if job.pre:
-            body = job.pre
-            body += '\n'
-
-        body += job.src
-
-        if job.post:
-            body += '\n'
-            body += job.post
-
-        jobopts = dict(def_options)
-        for k in job.args:
-            jobopts[k] = job.args[k]
+        jobopts = self.merge_options(def_options, job.args)
 
         hold = False
         env = False
@@ -165,7 +163,8 @@ class SJQRunner(Runner):
             shell = mvpipe.config.get_shell()
 
         src = '#!%s\n' % shell
-        src += 'set -o pipefail\nfunc () {\n  %s\n  return $?\n}\n' % body
+        src += self.source_runtime(job)
+        src += 'func () {\n  %s\n  return $?\n}\n' % job_body(job)
         src += 'func\n'
         src += 'RETVAL=$?\n'
 
@@ -198,6 +197,4 @@ class SJQRunner(Runner):
         print jobid
         self.jobids.append(jobid)
 
-        self.log('job: %s' % jobid)
-        for line in src.split('\n'):
-            self.log('job: %s' % line.strip('\n'), self.verbose)
+        self.log_script(jobid, src)
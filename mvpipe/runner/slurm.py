@@ -1,13 +1,36 @@
 import os
+import re
 import string
 import subprocess
 
 import mvpipe.support
 import mvpipe.config
-from mvpipe.runner import Runner, Job
+from mvpipe.runner import Runner, Job, JobArray, RuntimeLibrary, coalesce, job_body, split_jobid, numeric_jobid, expand_tasks
 
 def_options = {'env': True, 'wd': os.path.abspath(os.curdir), 'hold': False, 'nodes': 1}
 
+# the sbatch flag for each of the normalized job options, in the order they
+# are written to the script
+_sbatch_flags = [
+    ('name', '-J %s'),
+    ('hold', '-H'),
+    ('array', '--array=%s'),
+    ('export', '--export=%s'),
+    ('time', '-t %s'),
+    ('cpus', '-c %s'),
+    ('tasks', '-n %s'),
+    ('nodes', '-N %s'),
+    ('mem', '--mem=%s'),
+    ('dependency', '-d %s'),
+    ('qos', '--qos=%s'),
+    ('nice', '--nice=%s'),
+    ('mail', '--mail-type=%s'),
+    ('wd', '-D %s'),
+    ('account', '-A %s'),
+    ('stdout', '-o %s'),
+    ('stderr', '-e %s'),
+]
+
 '''
 SLURM options:
 
@@ -17,14 +40,44 @@ global_hold - start all pipelines with a "placeholder" job to synchronize
 
 account     - a default account to use
 
+job_arrays  - submit jobs from the same target definition with the same
+              settings as a single array job (--array), default: False
+
+max_array   - the maximum number of tasks in an array job, default: 1000
+
+max_submit  - the maximum number of jobs that can be submitted at the same
+              time, default: 8
+
+array_limit - the maximum number of tasks from an array that can run at the
+              same time (--array=1-N%limit), default: no limit
+
+runtime_dir - the directory for the runtime library that the job scripts
+              source (__pre__ and __post__). This needs to be on a
+              filesystem that the nodes can see. If it is blank, the code is
+              included in each script.
+              default: .mvpipe
+
+priority_range - with a submission order (mvpipe.loader.order), jobs are
+              given a nice value (--nice) from 0 (most urgent) to
+              {priority_range} (least urgent), default: 100 (0 to disable)
+
 '''
 class SlurmRunner(Runner):
-    def __init__(self, dryrun, verbose, logger, global_hold=False, global_depends=None, account=None):
+    array_taskvar = 'SLURM_ARRAY_TASK_ID'
+
+    def __init__(self, dryrun, verbose, logger, global_hold=False, global_depends=None, account=None, job_arrays=False, max_array=1000, array_limit=None, max_submit=8, runtime_dir='.mvpipe', priority_range=100):
         Runner.__init__(self, dryrun, verbose, logger)
         self.global_hold = global_hold
         self._holding_job = None
         self.global_depends = global_depends if global_depends else []
         self.account = account
+        self.job_arrays = job_arrays
+        self.max_array = int(max_array)
+        self.max_submit = int(max_submit)
+        self.array_limit = array_limit
+        self.priority_range = int(priority_range) if priority_range else 0
+        if runtime_dir:
+            self.runtime = RuntimeLibrary(runtime_dir, dryrun, self.log)
 
         self.jobids = []
 
@@ -33,6 +86,11 @@ class SlurmRunner(Runner):
     def reset(self):
         pass
 
+    def coalesce(self, jobs):
+        if not self.job_arrays:
+            return Runner.coalesce(self, jobs)
+        return coalesce(jobs, self.array_taskvar, self.max_array)
+
     def abort(self):
         if self._holding_job:
             self.cancel(self._holding_job.jobid)
@@ -51,15 +109,53 @@ class SlurmRunner(Runner):
         self.global_depends.append(self._holding_job.jobid)
 
     def check_jobid(self, jobid):
-        with open('/dev/null', 'w') as devnull:
-            proc = subprocess.Popen(["sacct", "-b", "-p", "-j", jobid], stdout=subprocess.PIPE, stderr=devnull)
-            stdout, stderr = proc.communicate()
+        return self.check_jobids([jobid])[jobid]
+
+    def check_jobids(self, jobids, chunk_size=500):
+        # sacct -b prints: JobID|State|ExitCode. Array tasks that haven't
+        # started are listed as one record: {arrayid}_[{task range}], so the
+        # query is for the array job-ids and the ranges are expanded.
+        valid = dict([(jobid, False) for jobid in jobids])
+        # sacct fails for ids it can't parse, so only numeric ids are queried
+        # (the others are invalid)
+        tasks = {}
+        queryids = set()
+        for jobid in valid:
+            if not numeric_jobid(jobid):
+                continue
+            base, idx = split_jobid(jobid)
+            queryids.add(base)
+            if idx is not None:
+                tasks.setdefault(base, {})[idx] = jobid
+
+        queryids = sorted(queryids)
+        for i in xrange(0, len(queryids), chunk_size):
+            try:
+                proc = subprocess.Popen(["sacct", "-b", "-n", "-P", "-j", ','.join(queryids[i:i+chunk_size])], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                stdout, stderr = proc.communicate()
+            except OSError, e:
+                raise RuntimeError('Error running sacct: %s' % e)
+
+            # if sacct failed, the jobs it didn't list aren't known to be
+            # invalid
+            if proc.returncode != 0:
+                raise RuntimeError('Error running sacct (%s): %s' % (proc.returncode, stderr.strip()))
+
             for line in stdout.split('\n'):
                 cols = line.strip().split('|')
-                if cols[0] == jobid:
-                    if cols[-1].split(':')[0] == '0':
-                        return True
-            return False
+                if len(cols) < 3 or cols[2].split(':')[0] != '0':
+                    continue
+
+                if cols[0] in valid:
+                    valid[cols[0]] = True
+                    continue
+
+                m = re.match('^(.+)_(\[.*\])$', cols[0])
+                if m and m.group(1) in tasks:
+                    for idx in expand_tasks(m.group(2)):
+                        if idx in tasks[m.group(1)]:
+                            valid[tasks[m.group(1)][idx]] = True
+        return valid
 
     def release(self, jobid):
         subprocess.call(["scontrol", "release", jobid])
@@ -71,50 +167,56 @@ class SlurmRunner(Runner):
         if not job.src:
             return
 
-        if self.global_hold and not self._holding_job:
-            self._setup_holding_job()
-
-        body = ''
-
-        if job.pre:
-            body = job.pre
-            body += '\n'
-
-        body += job.src
+        with self._lock:
+            if self.global_hold and not self._holding_job:
+                self._setup_holding_job()
 
-        if job.post:
-            body += '\n'
-            body += job.post
+        jobopts = self.merge_options(def_options, job.args)
 
-        jobopts = dict(def_options)
-        for k in job.args:
-            jobopts[k] = job.args[k]
+        opts = self.job_options(job, jobopts)
+        table = job.table() if isinstance(job, JobArray) else None
+        src = self.job_script(job, jobopts, opts, table)
 
-        if 'shell' in jobopts:
-            shell = jobopts['shell']
+        if not self.dryrun:
+            jobid = self._submit_script(job, src, opts)
         else:
-            shell = mvpipe.config.get_shell()
+            with self._lock:
+                jobid = 'testjob.%s' % self.testjobcount
+                self.testjobcount += 1
 
-        src = '#!%s\n' % shell
-        src += '#SBATCH -J %s\n' % (job.name if job.name[0] in string.ascii_letters else 'mvp_%s' % job.name)
+        self._submitted(job, jobid, src, table)
+
+    def job_options(self, job, jobopts):
+        '''
+        Converts the job settings into normalized SLURM options (see
+        _sbatch_flags for the names).
+        '''
+        opts = {}
+        opts['name'] = job.name if job.name[0] in string.ascii_letters else 'mvp_%s' % job.name
 
         if 'hold' in jobopts and jobopts['hold']:
-            src += '#SBATCH -H\n'
+            opts['hold'] = True
+
+        if isinstance(job, JobArray):
+            if self.array_limit:
+                opts['array'] = '1-%s%%%s' % (len(job), self.array_limit)
+            else:
+                opts['array'] = '1-%s' % len(job)
 
         if 'env' in jobopts and jobopts['env']:
-            src += '#SBATCH --export=ALL\n'
+            opts['export'] = 'ALL'
 
         if 'walltime' in jobopts:
-            src += '#SBATCH -t %s\n' % mvpipe.support.calc_time(jobopts['walltime'])
+            opts['time'] = mvpipe.support.calc_time(jobopts['walltime'])
 
         if 'procs' in jobopts and int(jobopts['procs']) > 1:
-            src += '#SBATCH -c %s\n' % (jobopts['procs'])
+            opts['cpus'] = jobopts['procs']
 
         if 'tasks' in jobopts and int(jobopts['tasks']) > 1:
-            src += '#SBATCH -n %s\n' % (jobopts['tasks'])
+            opts['tasks'] = jobopts['tasks']
 
         if 'nodes' in jobopts and int(jobopts['nodes']) > 1:
-            src += '#SBATCH -N %s\n' % (jobopts['nodes'])
+            opts['nodes'] = jobopts['nodes']
 
         if 'mem' in jobopts:
             if jobopts['mem'][-1] == 'M':
@@ -124,43 +226,75 @@ class SlurmRunner(Runner):
             else:
                 mem = jobopts['mem']
 
-            src += '#SBATCH --mem=%s\n' % mem
+            opts['mem'] = mem
 
         # if 'stack' in jobopts:
         #     src += '#$ -l h_stack=%s\n' % jobopts['stack']
 
+        aligned = job.aligned() if isinstance(job, JobArray) else None
+
         if job.depids or self.global_depends:
-            depids = job.depids
+            depids = aligned[1] if aligned else job.depids
             if self.global_depends:
                 depids.extend(self.global_depends)
 
+            deps = []
+            if aligned:
+                # each task waits for the task with the same index upstream
+                deps.append('aftercorr:%s' % aligned[0].jobid)
             if depids:
-                src += '#SBATCH -d afterok:%s\n' % ':'.join(depids)
+                deps.append('afterok:%s' % ':'.join(depids))
+
+            if deps:
+                opts['dependency'] = ','.join(deps)
 
         if 'qos' in jobopts:
-            src += '#SBATCH --qos=%s\n' % jobopts['qos']
+            opts['qos'] = jobopts['qos']
 
-        # if 'priority' in jobopts:
-        #     src += '#SBATCH --priority=%s\n' % jobopts['priority']
+        if job.priority is not None and self.priority_range:
+            # users can only lower the priority (nice >= 0), so the most
+            # urgent jobs keep the default
+            opts['nice'] = int(round((1 - job.priority) * self.priority_range))
 
         if 'mail' in jobopts:
-            src += '#SBATCH --mail-type=%s\n' % jobopts['mail']
+            opts['mail'] = jobopts['mail']
 
         if 'wd' in jobopts:
-            src += '#SBATCH -D %s\n' % jobopts['wd']
+            opts['wd'] = jobopts['wd']
 
         if 'account' in jobopts:
-            src += '#SBATCH -A %s\n' % jobopts['account']
+            opts['account'] = jobopts['account']
         elif self.account:
-            src += '#SBATCH -A %s\n' % self.account
+            opts['account'] = self.account
 
         if 'stdout' in jobopts:
-            src += '#SBATCH -o %s\n' % jobopts['stdout']
+            opts['stdout'] = jobopts['stdout']
 
         if 'stderr' in jobopts:
-            src += '#SBATCH -e %s\n' % jobopts['stderr']
+            opts['stderr'] = jobopts['stderr']
 
-        src += 'set -o pipefail\nfunc () {\n  %s\n  return $?\n}\n' % body
+        return opts
+
+    def job_script(self, job, jobopts, opts, table=None):
+        if 'shell' in jobopts:
+            shell = jobopts['shell']
+        else:
+            shell = mvpipe.config.get_shell()
+
+        src = '#!%s\n' % shell
+        for k, flag in _sbatch_flags:
+            if k in opts:
+                if opts[k] is True:
+                    src += '#SBATCH %s\n' % flag
+                else:
+                    src += '#SBATCH %s\n' % (flag % opts[k])
+
+        src += self.source_runtime(job)
+
+        if table:
+            src += table
+
+        src += 'func () {\n  %s\n  return $?\n}\n' % job_body(job)
 
         src += 'if [ "$0" == "" ]; then\n'
         src += '    srun $0 run\n'
@@ -169,6 +303,8 @@ class SlurmRunner(Runner):
         src += '    RETVAL=$?\n'
 
         tmpbody = ''
+        if isinstance(job, JobArray):
+            tmpbody += '    %s\n' % job.cleanup
         if not 'keepfailed' in jobopts or not jobopts['keepfailed']:
             for out in job.outputs:
                 if out[0] != '.':
@@ -182,31 +318,34 @@ class SlurmRunner(Runner):
         src += '    exit $RETVAL\n'
         src += 'fi\n'
 
-        if not self.dryrun:
-            proc = subprocess.Popen(["sbatch", ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            output = proc.communicate(src)[0]
-            retval = proc.wait()
+        return src
 
-            if retval != 0:
-                self.log('Error submitting job %s: %s\n' % (job.name, output), True)
-                raise RuntimeError(output)
+    def _submit_script(self, job, src, opts):
+        proc = subprocess.Popen(["sbatch", ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate(src)[0]
+        retval = proc.wait()
 
-            jobid = output.strip().split(' ')[-1]
-        else:
-            jobid = 'testjob.%s' % self.testjobcount
-            self.testjobcount += 1
+        if retval != 0:
+            self.log('Error submitting job %s: %s\n' % (job.name, output), True)
+            raise RuntimeError(output)
 
-        job.jobid = jobid
+        return output.strip().split(' ')[-1]
+
+    def _submitted(self, job, jobid, src, table=None):
+        # jobs may be submitted from more than one thread
+        with self._lock:
+            if isinstance(job, JobArray):
+                job.set_jobid(jobid)
+            else:
+                job.jobid = jobid
 
-        # for out in job.outputs:
-        #     self._output_jobs[out] = jobid
+            # for out in job.outputs:
+            #     self._output_jobs[out] = jobid
 
-        print jobid
-        self.jobids.append(jobid)
+            print jobid
+            self.jobids.append(jobid)
 
-        self.log('job: %s' % jobid)
-        for line in src.split('\n'):
-            self.log('job: %s' % line.strip('\n'), self.verbose)
+            self.log_script(jobid, src, table)
 
             # if jobid and monitor and self.postaccounting:
             #     acct_src = accounting_script % (jobid, jobid, jobid, clustrun.CLUSTRUN_MON_BIN, cluster, clustrun.CLUSTRUN_MON_BIN, cluster)
@@ -0,0 +1,302 @@
+import os
+import json
+import socket
+import getpass
+import httplib
+import urlparse
+import threading
+
+from mvpipe.runner import expand_tasks
+from mvpipe.runner.slurm import SlurmRunner
+
+'''
+SLURM REST options (in addition to the SLURM options):
+
+url         - the slurmrestd address, either http://host:port or
+              unix:///path/to/socket (default: http://localhost:6820)
+
+api_version - the slurmrestd API version to use (default: v0.0.38). Jobs
+              are cancelled with one request for v0.0.40 and later, and
+              one request per job for older versions.
+
+user        - the user name to authenticate as (default: the current user)
+
+token       - the JWT token to authenticate with (default: $SLURM_JWT). This
+              isn't needed when connecting over a unix socket.
+
+connections - the maximum number of open connections to slurmrestd
+              (default: max_submit)
+
+timeout     - the timeout for each request in seconds (default: 60)
+
+'''
+
+# job states that are still valid (if the exit code is 0)
+_valid_states = frozenset(['PENDING', 'CONFIGURING', 'RUNNING', 'SUSPENDED', 'COMPLETING', 'COMPLETED'])
+
+
+class SlurmRestRunner(SlurmRunner):
+    def __init__(self, dryrun, verbose, logger, url='http://localhost:6820', api_version='v0.0.38', user=None, token=None, connections=None, timeout=60, **kwargs):
+        SlurmRunner.__init__(self, dryrun, verbose, logger, **kwargs)
+        self.url = url
+        self.api_version = api_version
+        self.user = user if user else getpass.getuser()
+        self.token = token if token else os.environ.get('SLURM_JWT')
+        self.pool = ConnectionPool(url, int(connections) if connections else self.max_submit, timeout)
+
+    def done(self):
+        SlurmRunner.done(self)
+        self.pool.close()
+
+    def abort(self):
+        if self._holding_job:
+            self.cancel_jobs([self._holding_job.jobid])
+        else:
+            self.cancel_jobs(self.jobids)
+        self.pool.close()
+
+    def _request(self, method, path, data=None):
+        headers = {'Accept': 'application/json'}
+        if data is not None:
+            data = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        if not self.pool.unix:
+            headers['X-SLURM-USER-NAME'] = self.user
+            if self.token:
+                headers['X-SLURM-USER-TOKEN'] = self.token
+
+        status, body = self.pool.request(method, '/slurm/%s/%s' % (self.api_version, path), data, headers)
+
+        try:
+            resp = json.loads(body) if body else {}
+        except ValueError:
+            raise RuntimeError('Invalid response from slurmrestd (%s): %s' % (status, body))
+
+        if status >= 400 or resp.get('errors'):
+            errors = resp.get('errors')
+            if errors:
+                msg = '; '.join([e.get('error', e.get('description', str(e))) if type(e) == dict else str(e) for e in errors])
+            else:
+                msg = body
+            raise RuntimeError('slurmrestd error (%s): %s' % (status, msg))
+
+        return resp
+
+    def _submit_script(self, job, src, opts):
+        try:
+            resp = self._request('POST', 'job/submit', {'script': src, 'job': self.job_desc(opts)})
+        except (RuntimeError, socket.error, httplib.HTTPException), e:
+            self.log('Error submitting job %s: %s\n' % (job.name, e), True)
+            raise RuntimeError(str(e))
+
+        return str(resp['job_id'])
+
+    def job_desc(self, opts):
+        '''
+        Converts the normalized SLURM options into a slurmrestd job description
+        '''
+        desc = {}
+        if opts.get('export') == 'ALL':
+            desc['environment'] = dict(os.environ)
+        else:
+            # slurmrestd requires an environment
+            desc['environment'] = {'PATH': os.environ.get('PATH', '/bin:/usr/bin')}
+
+        for k, key in [('name', 'name'), ('array', 'array'), ('dependency', 'dependency'),
+                       ('qos', 'qos'), ('mail', 'mail_type'), ('wd', 'current_working_directory'),
+                       ('account', 'account'), ('stdout', 'standard_output'), ('stderr', 'standard_error')]:
+            if k in opts:
+                desc[key] = opts[k]
+
+        for k, key in [('cpus', 'cpus_per_task'), ('tasks', 'tasks'), ('nodes', 'nodes'), ('mem', 'memory_per_node'), ('nice', 'nice')]:
+            if k in opts:
+                desc[key] = int(opts[k])
+
+        if 'hold' in opts:
+            desc['hold'] = True
+
+        if 'time' in opts:
+            # time_limit is in minutes
+            h, m, s = [int(x) for x in opts['time'].split(':')]
+            desc['time_limit'] = h * 60 + m + (1 if s else 0)
+
+        return desc
+
+    def check_jobids(self, jobids):
+        # one request lists all of the jobs the controller knows about
+        try:
+            resp = self._request('GET', 'jobs')
+        except (RuntimeError, socket.error, httplib.HTTPException), e:
+            # the jobs aren't known to be invalid if the query failed
+            raise RuntimeError('Error querying slurmrestd: %s' % e)
+
+        known = {}
+        for j in resp.get('jobs', []):
+            state = j.get('job_state')
+            if type(state) == list:
+                state = state[0] if state else None
+
+            valid = state in _valid_states and _exit_code(j.get('exit_code')) == 0
+
+            arrayid = _number(j.get('array_job_id'))
+            taskid = _number(j.get('array_task_id'))
+            if arrayid and taskid is not None:
+                known['%s_%s' % (arrayid, taskid)] = valid
+            elif arrayid and j.get('array_task_string'):
+                # array tasks that haven't started are one record
+                for idx in expand_tasks(j['array_task_string']):
+                    known['%s_%s' % (arrayid, idx)] = valid
+            known[str(_number(j.get('job_id')))] = valid
+
+        valid = {}
+        for jobid in jobids:
+            valid[jobid] = known.get(jobid, False)
+        return valid
+
+    def release(self, jobid):
+        self._request('POST', 'job/%s' % jobid, {'hold': False})
+
+    def cancel(self, jobid):
+        self.cancel_jobs([jobid])
+
+    def cancel_jobs(self, jobids):
+        if not jobids:
+            return
+
+        if _version(self.api_version) >= (0, 0, 40):
+            self._request('DELETE', 'jobs', {'jobs': list(jobids)})
+            return
+
+        # older API versions can only cancel one job per request
+        errors = []
+        for jobid in jobids:
+            try:
+                self._request('DELETE', 'job/%s' % jobid)
+            except (RuntimeError, socket.error, httplib.HTTPException), e:
+                errors.append(str(e))
+
+        if errors:
+            raise RuntimeError('Error cancelling %s job(s): %s' % (len(errors), errors[0]))
+
+
+def _version(api_version):
+    '''
+    Converts an API version (v0.0.38) into a tuple: (0, 0, 38)
+    '''
+    try:
+        return tuple([int(x) for x in api_version.lstrip('v').split('.')])
+    except ValueError:
+        return ()
+
+
+def _number(val):
+    '''
+    Numbers are plain values in older API versions, and {"set": T/F,
+    "number": N} in newer ones. Returns None if the number isn't set.
+    '''
+    if type(val) == dict:
+        if not val.get('set', True):
+            return None
+        return val.get('number')
+    return val
+
+
+def _exit_code(val):
+    if type(val) == dict:
+        # newer API versions: {"status": ..., "return_code": N}
+        val = val.get('return_code', 0)
+        if type(val) == dict:
+            val = val.get('number', 0)
+    return int(val) if val else 0
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, sock_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.sock_path = sock_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout:
+            sock.settimeout(self.timeout)
+        sock.connect(self.sock_path)
+        self.sock = sock
+
+
+class ConnectionPool(object):
+    '''
+    A pool of persistent (keep-alive) HTTP connections to one server. At
+    most 'size' connections are open at once; idle connections are reused.
+    '''
+    def __init__(self, url, size=4, timeout=60):
+        parsed = urlparse.urlparse(url)
+        self.scheme = parsed.scheme
+        self.unix = parsed.scheme == 'unix'
+        self.host = parsed.netloc
+        self.sock_path = parsed.path if self.unix else None
+        self.timeout = timeout
+
+        if not self.scheme in ['http', 'https', 'unix']:
+            raise ValueError('Unknown slurmrestd URL: %s' % url)
+
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(size, 1))
+
+    def _connect(self):
+        if self.unix:
+            return UnixHTTPConnection(self.sock_path, timeout=self.timeout)
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        '''
+        Returns (status, response body)
+        '''
+        self._slots.acquire()
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+
+            reused = conn is not None
+            if not reused:
+                conn = self._connect()
+
+            try:
+                sent = False
+                try:
+                    conn.request(method, path, body, headers if headers else {})
+                    sent = True
+                    resp = conn.getresponse()
+                except (socket.error, httplib.HTTPException):
+                    conn.close()
+                    # the server may have closed an idle connection - try
+                    # again on a new connection (unless a submission might
+                    # have already been received)
+                    if not reused or (sent and method == 'POST'):
+                        raise
+                    conn = self._connect()
+                    conn.request(method, path, body, headers if headers else {})
+                    resp = conn.getresponse()
+
+                data = resp.read()
+            except:
+                conn.close()
+                raise
+
+            if resp.getheader('connection', '').lower() == 'close':
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+
+            return resp.status, data
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
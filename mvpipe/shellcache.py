@@ -0,0 +1,181 @@
+'''
+Cache for $(...) shell-outs evaluated while parsing a pipeline
+
+Results are keyed on the fully expanded command, the working directory and
+a declared subset of environment variables. The cache is kept in memory
+for the life of a PipelineLoader and can optionally be persisted to a file,
+in which case entries older than the TTL are discarded.
+
+Commands can also be started in a bounded thread pool with submit(). The
+returned handle is joined with get(), so independent shell-outs can run at
+the same time. Identical commands that are already running share a handle.
+
+'''
+
+import os
+import json
+import time
+import subprocess
+import multiprocessing.pool
+
+import mvpipe
+
+
+class ShellCache(object):
+    def __init__(self, fname=None, ttl=3600, env=None, threads=4, log=None):
+        self.fname = os.path.expanduser(fname) if fname else None
+        self.ttl = ttl
+        self.env = env.replace(':', ' ').split() if env else []
+        self.threads = threads
+        self._log = log
+        self._vals = {}
+        self._pending = {}
+        self._pool = None
+        self._dirty = False
+
+        self.hits = 0
+        self.misses = 0
+
+        # all commands, and the ones that weren't cached ($!(...))
+        self.calls = 0
+        self.uncached = 0
+
+        if self.fname and os.path.exists(self.fname):
+            self._load()
+
+    def _key(self, cmd, cwd):
+        return (cmd, cwd, tuple([(k, os.environ.get(k, '')) for k in self.env]))
+
+    def _load(self):
+        now = time.time()
+        try:
+            with open(self.fname) as f:
+                entries = json.load(f)
+        except ValueError:
+            self.log('Ignoring invalid shell cache file: %s' % self.fname)
+            return
+
+        for entry in entries:
+            if self.ttl > 0 and now - entry['time'] > self.ttl:
+                self._dirty = True
+                continue
+            env = tuple([(k, _str(entry['env'].get(k, ''))) for k in self.env])
+            self._vals[(_str(entry['cmd']), _str(entry['cwd']), env)] = (_str(entry['out']), entry['time'])
+
+    def log(self, msg):
+        if self._log:
+            self._log(msg)
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+        if not self.fname or not self._dirty:
+            return
+
+        entries = []
+        for (cmd, cwd, env), (out, t) in self._vals.items():
+            entries.append({'cmd': cmd, 'cwd': cwd, 'env': dict(env), 'out': out, 'time': t})
+
+        tmp = '%s.tmp' % self.fname
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp, self.fname)
+        self._dirty = False
+
+    def run(self, cmd, cache=True):
+        cwd = os.getcwd()
+        if cache:
+            key = self._key(cmd, cwd)
+            if key in self._vals:
+                self.hits += 1
+                return self._vals[key][0]
+            self.misses += 1
+
+        out = execute(cmd, self._log)
+
+        if cache:
+            self._vals[key] = (out, time.time())
+            self._dirty = True
+
+        return out
+
+    def submit(self, cmd, cache=True):
+        self.calls += 1
+        if not cache:
+            self.uncached += 1
+
+        if not self.threads or self.threads < 2:
+            return Done(self.run(cmd, cache))
+
+        key = None
+        if cache:
+            key = self._key(cmd, os.getcwd())
+            if key in self._vals:
+                self.hits += 1
+                return Done(self._vals[key][0])
+            if key in self._pending:
+                self.hits += 1
+                return self._pending[key]
+            self.misses += 1
+
+        if not self._pool:
+            self._pool = multiprocessing.pool.ThreadPool(self.threads)
+
+        handle = _Pending(self, key, self._pool.apply_async(execute, (cmd, self._log)))
+        if cache:
+            self._pending[key] = handle
+        return handle
+
+
+class Done(object):
+    def __init__(self, val):
+        self.val = val
+
+    def get(self):
+        return self.val
+
+
+class _Pending(object):
+    def __init__(self, cache, key, result):
+        self.cache = cache
+        self.key = key
+        self.result = result
+        self.val = None
+        self.done = False
+
+    def get(self):
+        if not self.done:
+            if self.key:
+                self.cache._pending.pop(self.key, None)
+
+            # errors from the command are re-raised here
+            self.val = self.result.get()
+            self.done = True
+
+            if self.key:
+                self.cache._vals[self.key] = (self.val, time.time())
+                self.cache._dirty = True
+        return self.val
+
+
+def _str(val):
+    if type(val) == unicode:
+        return val.encode('utf-8')
+    return val
+
+
+def execute(cmd, log=None):
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    out, err = proc.communicate()
+    # if out:
+    #     sys.stderr.write('%s *> %s\n' % (cmd, out))
+    if err and log:
+        log('$(%s) => %s\n' % (cmd, err))
+
+    if proc.returncode != 0:
+        raise mvpipe.ParseError("Error running shell command: %s" % cmd)
+
+    return out.strip()
@@ -0,0 +1,239 @@
+'''
+State store for the outputs that have been scheduled (the outfile)
+
+The state is kept in an SQLite database ({outfile}.db, in WAL mode) with
+three tables:
+
+    outputs  output (primary key), jobid, script hash, time
+    jobs     jobid (primary key), runner, submit time, status
+    history  every output/jobid that has been recorded
+
+Lookups are indexed queries, so the database isn't read into memory.
+New records are written in batched transactions (and when the store is
+closed). A job's status starts as "submitted", and is set to "valid" or
+"invalid" when the job is checked with the job runner. A status is only
+recorded when the scheduler could be queried, so invalid jobs are never
+checked again. The scheduler's final state for a job (completed, failed...)
+isn't recorded: SGE can only list the jobs that are still active, so all
+that is known is whether a job is still valid.
+
+An existing tab-delimited outfile (output, jobid) is imported the first time
+the database is created. The history table can be trimmed to the latest
+record for each output with compact() (mvstate compact).
+
+If sqlite3 isn't available, the old tab-delimited outfile is used instead.
+'''
+
+import os
+import time
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+_schema = [
+    'CREATE TABLE IF NOT EXISTS outputs (output TEXT PRIMARY KEY, jobid TEXT NOT NULL, script TEXT, recorded REAL)',
+    'CREATE TABLE IF NOT EXISTS jobs (jobid TEXT PRIMARY KEY, runner TEXT, submitted REAL, status TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, output TEXT NOT NULL, jobid TEXT NOT NULL, script TEXT, recorded REAL)',
+    'CREATE INDEX IF NOT EXISTS outputs_jobid ON outputs (jobid)',
+    'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, val TEXT)',
+]
+
+
+def open_store(outfile, batch=1000):
+    '''
+    Opens the state store for an outfile
+    '''
+    if sqlite3:
+        return StateStore(db_name(outfile), outfile, batch)
+    return TextStateStore(outfile)
+
+
+def db_name(outfile):
+    if outfile.endswith('.db'):
+        return outfile
+    return '%s.db' % outfile
+
+
+class StateStore(object):
+    def __init__(self, fname, legacy=None, batch=1000):
+        self.fname = fname
+        self.batch = int(batch)
+        self._pending = []
+        self._statuses = []
+        self._lock = threading.RLock()
+
+        exists = os.path.exists(fname)
+
+        self.conn = sqlite3.connect(fname, timeout=60, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            for sql in _schema:
+                self.conn.execute(sql)
+
+        if not exists and legacy and legacy != fname and os.path.exists(legacy):
+            self.import_outfile(legacy)
+
+    def import_outfile(self, fname):
+        '''
+        Imports a tab-delimited outfile (output, jobid). Later lines replace
+        earlier ones. Returns the number of lines imported.
+        '''
+        now = time.time()
+        rows = []
+        with open(fname) as f:
+            for line in f:
+                cols = line.strip('\n').split('\t')
+                if len(cols) >= 2 and cols[0]:
+                    rows.append((cols[0], cols[1], None, now))
+
+        with self._lock:
+            self.flush()
+            with self.conn:
+                self.conn.executemany('INSERT INTO history (output, jobid, script, recorded) VALUES (?, ?, ?, ?)', rows)
+                self.conn.executemany('INSERT OR REPLACE INTO outputs (output, jobid, script, recorded) VALUES (?, ?, ?, ?)', rows)
+                self.conn.executemany("INSERT OR IGNORE INTO jobs (jobid, runner, submitted, status) VALUES (?, NULL, NULL, 'submitted')", set([(r[1],) for r in rows]))
+                self.conn.execute('INSERT OR REPLACE INTO meta (key, val) VALUES (?, ?)', ('imported', os.path.abspath(fname)))
+        return len(rows)
+
+    def get(self, output):
+        '''
+        Returns the jobid for the latest job to build this output (or None)
+        '''
+        with self._lock:
+            for out, jobid, script, recorded, runner in reversed(self._pending):
+                if out == output:
+                    return jobid
+
+            row = self.conn.execute('SELECT jobid FROM outputs WHERE output = ?', (output,)).fetchone()
+        return row[0] if row else None
+
+    def status(self, jobid):
+        with self._lock:
+            for j, status in reversed(self._statuses):
+                if j == jobid:
+                    return status
+            row = self.conn.execute('SELECT status FROM jobs WHERE jobid = ?', (jobid,)).fetchone()
+        return row[0] if row else None
+
+    def active_jobids(self):
+        '''
+        The jobs for current outputs that haven't been found to be invalid
+        '''
+        with self._lock:
+            self.flush()
+            rows = self.conn.execute("SELECT DISTINCT o.jobid FROM outputs o JOIN jobs j ON o.jobid = j.jobid WHERE j.status != 'invalid'").fetchall()
+        return [row[0] for row in rows]
+
+    def record(self, output, jobid, runner=None, script=None):
+        with self._lock:
+            self._pending.append((output, jobid, script, time.time(), runner))
+            if len(self._pending) >= self.batch:
+                self.flush()
+
+    def set_status(self, jobid, status):
+        with self._lock:
+            self._statuses.append((jobid, status))
+            if len(self._statuses) >= self.batch:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending and not self._statuses:
+                return
+
+            with self.conn:
+                if self._pending:
+                    rows = [(out, jobid, script, recorded) for out, jobid, script, recorded, runner in self._pending]
+                    self.conn.executemany('INSERT INTO history (output, jobid, script, recorded) VALUES (?, ?, ?, ?)', rows)
+                    self.conn.executemany('INSERT OR REPLACE INTO outputs (output, jobid, script, recorded) VALUES (?, ?, ?, ?)', rows)
+                    self.conn.executemany("INSERT OR IGNORE INTO jobs (jobid, runner, submitted, status) VALUES (?, ?, ?, 'submitted')", [(jobid, runner, recorded) for out, jobid, script, recorded, runner in self._pending])
+                if self._statuses:
+                    self.conn.executemany('UPDATE jobs SET status = ? WHERE jobid = ?', [(status, jobid) for jobid, status in self._statuses])
+
+            self._pending = []
+            self._statuses = []
+
+    def rows(self, outputs=None):
+        '''
+        Returns (output, jobid, runner, submitted, status, script) for the
+        current outputs (or just these outputs)
+        '''
+        sql = 'SELECT o.output, o.jobid, j.runner, j.submitted, j.status, o.script FROM outputs o LEFT JOIN jobs j ON o.jobid = j.jobid'
+        with self._lock:
+            self.flush()
+            if outputs:
+                out = []
+                for output in outputs:
+                    out.extend(self.conn.execute('%s WHERE o.output = ?' % sql, (output,)).fetchall())
+                return out
+            return self.conn.execute('%s ORDER BY o.output' % sql).fetchall()
+
+    def compact(self):
+        '''
+        Removes old history (keeping the latest record for each output) and
+        jobs that no longer build any outputs. Returns the number of history
+        records removed.
+        '''
+        with self._lock:
+            self.flush()
+            with self.conn:
+                removed = self.conn.execute('DELETE FROM history WHERE id NOT IN (SELECT MAX(id) FROM history GROUP BY output)').rowcount
+                self.conn.execute('DELETE FROM jobs WHERE jobid NOT IN (SELECT jobid FROM outputs)')
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.conn.execute('VACUUM')
+        return removed
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self.conn.close()
+
+
+class TextStateStore(object):
+    '''
+    The tab-delimited outfile (output, jobid), used if sqlite3 isn't
+    available. Duplicate outputs are kept in the file; the last one wins.
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self._jobids = {}
+        self._statuses = {}
+
+        if not os.path.exists(fname):
+            open(fname, 'w').close()
+            return
+
+        with open(fname) as f:
+            for line in f:
+                cols = line.strip('\n').split('\t')
+                if len(cols) >= 2:
+                    self._jobids[cols[0]] = cols[1]
+
+    def get(self, output):
+        return self._jobids.get(output)
+
+    def status(self, jobid):
+        return self._statuses.get(jobid)
+
+    def active_jobids(self):
+        return [jobid for jobid in set(self._jobids.values()) if self._statuses.get(jobid) != 'invalid']
+
+    def record(self, output, jobid, runner=None, script=None):
+        self._jobids[output] = jobid
+        with open(self.fname, 'a') as f:
+            f.write('%s\t%s\n' % (output, jobid))
+
+    def set_status(self, jobid, status):
+        self._statuses[jobid] = status
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
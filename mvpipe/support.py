@@ -1,4 +1,5 @@
 import os
+import multiprocessing.pool
 
 def autotype(val):
     if not val:
@@ -23,12 +24,107 @@ def autotype(val):
             return val
 
 
-def target_exists(fname):
+def target_exists(fname, cache=None):
+    if cache:
+        return cache.exists(fname)
     if os.path.exists(fname):
         return True
     return False
 
 
+def _listdir(path):
+    try:
+        return path, frozenset(os.listdir(path))
+    except OSError:
+        return path, None
+
+
+class StatCache(object):
+    '''
+    Caches file existence checks by directory. The first lookup in a
+    directory reads the whole directory listing (one readdir instead of one
+    stat per file), and later lookups for that directory are answered from
+    memory, including negative results.
+
+    Outputs for jobs that have been submitted in this run can be marked
+    as pending, so they are never checked on the filesystem.
+    '''
+    def __init__(self, threads=4):
+        self.threads = threads
+        self._dirs = {}
+        self._pending = set()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _split(self, fname):
+        dname, bname = os.path.split(fname)
+        if not bname or bname in ['.', '..']:
+            return None, None
+        return dname if dname else '.', bname
+
+    def exists(self, fname):
+        if fname in self._pending:
+            self.hits += 1
+            return False
+
+        dname, bname = self._split(fname)
+        if not dname:
+            self.misses += 1
+            return os.path.exists(fname)
+
+        if dname in self._dirs:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._dirs[dname] = _listdir(dname)[1]
+
+        if self._dirs[dname] is None:
+            return False
+        return bname in self._dirs[dname]
+
+    def prefetch(self, fnames):
+        '''
+        Reads the listings for all of the directories needed for these files,
+        using a thread pool if there is more than one directory to read.
+        '''
+        dnames = set()
+        for fname in fnames:
+            if fname in self._pending:
+                continue
+            dname = self._split(fname)[0]
+            if dname and not dname in self._dirs:
+                dnames.add(dname)
+
+        if not dnames:
+            return
+
+        self.misses += len(dnames)
+        if len(dnames) == 1 or not self.threads or self.threads < 2:
+            results = [_listdir(d) for d in dnames]
+        else:
+            pool = multiprocessing.pool.ThreadPool(min(self.threads, len(dnames)))
+            results = pool.map(_listdir, dnames)
+            pool.close()
+            pool.join()
+
+        for dname, names in results:
+            self._dirs[dname] = names
+
+    def set_pending(self, fname):
+        self._pending.add(fname)
+
+    def invalidate(self, fname):
+        '''
+        Forget what we know about this file (and its directory) - for example,
+        after a job that creates it was run directly.
+        '''
+        self._pending.discard(fname)
+        dname = self._split(fname)[0]
+        if dname in self._dirs:
+            del self._dirs[dname]
+
+
 def calc_time(val, multiplier=1):
     seconds = 0
     if ':' in val:
@@ -55,3 +151,29 @@ def calc_time(val, multiplier=1):
     s = seconds % 60
 
     return '%d:%02d:%02d' % (h, m, s)
+
+
+def calc_mem(val):
+    '''
+    Converts a memory value (ex: 500M, 4G) to bytes
+    '''
+    val = str(val).strip().upper()
+    if val and val[-1] == 'B':
+        val = val[:-1]
+
+    mult = 1
+    for i, unit in enumerate('KMGT'):
+        if val and val[-1] == unit:
+            mult = 1024 ** (i + 1)
+            val = val[:-1]
+            break
+
+    return int(float(val) * mult)
+
+
+def calc_seconds(val):
+    '''
+    Converts a time value (ex: 1:30:00, 90:00, 5400) to seconds
+    '''
+    h, m, s = [int(x) for x in calc_time(str(val)).split(':')]
+    return s + (m * 60) + (h * 60 * 60)
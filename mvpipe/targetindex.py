@@ -0,0 +1,141 @@
+'''
+Index of target definitions by their outputs
+
+Literal outputs are stored in a hash map. Wildcard outputs are stored by
+their literal suffix (the text after the last wildcard), grouped by suffix
+length, so finding the candidates for a file name only needs one hash lookup
+per distinct suffix length. Candidates are returned in definition order and
+still need to be checked with TargetContext.match_target().
+
+'''
+
+import re
+
+import mvpipe
+
+_wildcard = re.compile('%(\{([A-Za-z_][A-Za-z0-9_]*)\})?')
+
+
+def parse_output(out):
+    '''
+    Splits an output name into its literal parts and wildcards. A plain '%'
+    is an anonymous wildcard (${1}, ${2}...) and '%{name}' is a named wildcard
+    (${name}). Each output can have one anonymous wildcard and any number of
+    named ones.
+
+    Returns (regex, prefix, suffix, names). For literal outputs, regex is None.
+    '''
+    parts = []
+    names = []
+    anon = False
+    pos = 0
+    prefix = None
+
+    for m in _wildcard.finditer(out):
+        if prefix is None:
+            prefix = out[:m.start()]
+
+        parts.append(re.escape(out[pos:m.start()]))
+        name = m.group(2)
+        if name:
+            if name in names:
+                parts.append('(?P=%s)' % name)
+            else:
+                parts.append('(?P<%s>.*)' % name)
+                names.append(name)
+        else:
+            if anon:
+                raise mvpipe.ParseError("Target names can only have one '%%' wildcard (use named wildcards: %%{name}): %s" % out)
+            parts.append('(.*)')
+            anon = True
+        pos = m.end()
+
+    if prefix is None:
+        return None, out, out, names
+
+    parts.append(re.escape(out[pos:]))
+    return re.compile('^%s$' % ''.join(parts)), prefix, out[pos:], names
+
+
+def match_output(regex, target):
+    '''
+    Matches a file name against an output regex (from parse_output). Returns
+    (anonymous value, {named values}), or None if it doesn't match. The
+    anonymous value is '' if the output doesn't have a '%' wildcard.
+    '''
+    m = regex.match(target)
+    if not m:
+        return None
+
+    # the anonymous wildcard is the only group without a name (named
+    # wildcards can come before it)
+    anon = ''
+    named = set(regex.groupindex.values())
+    for i in xrange(1, regex.groups + 1):
+        if not i in named:
+            anon = m.group(i)
+            break
+
+    return anon, m.groupdict()
+
+
+def fill_output(out, wildcard, named):
+    '''
+    Replaces the wildcards in an output name with the matched values.
+    '''
+    def repl(m):
+        if m.group(2):
+            return named[m.group(2)]
+        return wildcard
+    return _wildcard.sub(repl, out)
+
+
+class TargetIndex(object):
+    def __init__(self, targets):
+        self.targets = targets
+        self.size = len(targets)
+        self._literal = {}
+        self._suffixes = {}
+
+        for i, tgt in enumerate(targets):
+            if tgt.badtarget:
+                continue
+            if '__pre__' in tgt.outputs or '__post__' in tgt.outputs:
+                continue
+
+            for out, regex, prefix, suffix in zip(tgt.outputs, tgt.outputs_regex, tgt.outputs_prefix, tgt.outputs_suffix):
+                if not regex:
+                    self._add(self._literal, out, i)
+                else:
+                    if not len(suffix) in self._suffixes:
+                        self._suffixes[len(suffix)] = {}
+                    self._add(self._suffixes[len(suffix)], suffix, (i, prefix))
+
+        self._lengths = sorted(self._suffixes)
+
+    def _add(self, d, k, v):
+        if not k in d:
+            d[k] = [v]
+        elif d[k][-1] != v:
+            d[k].append(v)
+
+    def candidates(self, target):
+        '''
+        Returns the target definitions that may be able to build this file,
+        in the order they were defined.
+        '''
+        if not target:
+            return [tgt for tgt in self.targets if not '__pre__' in tgt.outputs and not '__post__' in tgt.outputs]
+
+        idx = set(self._literal.get(target, []))
+        for l in self._lengths:
+            if l > len(target):
+                break
+            suffixes = self._suffixes[l]
+            key = target[len(target)-l:] if l else ''
+            if key in suffixes:
+                for i, prefix in suffixes[key]:
+                    if target.startswith(prefix):
+                        idx.add(i)
+
+        return [self.targets[i] for i in sorted(idx)]
@@ -0,0 +1,410 @@
+'''
+Compiled templates for variable substitution
+
+Each template string is parsed once into a list of tokens (literal text,
+${var}, @{list}, @{n..m}, ${num}, $<, $> and $(shell) references). The
+parsed templates are kept in an LRU cache keyed on the raw string, so lines
+that are evaluated repeatedly (loop bodies, target bodies) are only parsed
+once. Rendering a template is a single pass over its tokens.
+
+A template can also be bound to a context, which replaces the ${var}
+references that the context can resolve with their values. Only the holes
+that are left (for example ${1}, $< and $>) are filled in when the bound
+template is rendered.
+
+'''
+
+import re
+import collections
+
+import mvpipe
+import mvpipe.support
+
+LITERAL = 0
+VAR = 1
+ARRAY = 2
+RANGE = 3
+NUMARG = 4
+INPUT = 5
+OUTPUT = 6
+SHELL = 7
+
+CACHE_SIZE = 4096
+
+_special = re.compile('[\\\\$@]')
+_varname = re.compile('^[a-zA-Z_][a-zA-Z0-9_\.]*\??$')
+_numarg = re.compile('^[0-9]+$')
+_digits = re.compile('[0-9]*')
+_range = re.compile('^[ \t]*([^ \t]+)[ \t]*\.\.[ \t]*([^ \t]+)[ \t]*$')
+
+# characters that are captured around an @{} expansion
+_context_chars = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-.')
+
+
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._vals = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, k):
+        try:
+            val = self._vals.pop(k)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._vals[k] = val
+        return val
+
+    def put(self, k, val):
+        if k in self._vals:
+            del self._vals[k]
+        elif len(self._vals) >= self.maxsize:
+            self._vals.popitem(last=False)
+        self._vals[k] = val
+
+    def clear(self):
+        self._vals.clear()
+
+    def __len__(self):
+        return len(self._vals)
+
+
+_cache = LRUCache(CACHE_SIZE)
+
+
+def get_template(src):
+    tmpl = _cache.get(src)
+    if tmpl is None:
+        tmpl = Template(src)
+        _cache.put(src, tmpl)
+    return tmpl
+
+
+def _find_close(src, start, opench, closech):
+    '''
+    Returns the position of the matching close character, starting after
+    an open character at start-1. Nested pairs are skipped. Returns -1 if
+    there is no match.
+    '''
+    depth = 1
+    i = start
+    while i < len(src):
+        ch = src[i]
+        if ch == '\\':
+            i += 2
+            continue
+        if ch == opench:
+            depth += 1
+        elif ch == closech:
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return -1
+
+
+class _Expansion(object):
+    '''
+    Placeholder for an @{} expansion - these are resolved after all other
+    tokens have been rendered, so that the surrounding context can be captured.
+    '''
+    def __init__(self, vals):
+        self.vals = vals
+
+
+class Template(object):
+    def __init__(self, src):
+        self.src = src
+        self.tokens = []
+        self.has_shell = False
+        # set if there is a $!(...) shell-out (that shouldn't be cached)
+        self.volatile = False
+        self._parse()
+
+    def __repr__(self):
+        return '<Template: %s>' % self.src
+
+    def _literal(self, s):
+        if not s:
+            return
+        if self.tokens and self.tokens[-1][0] == LITERAL:
+            self.tokens[-1] = (LITERAL, self.tokens[-1][1] + s)
+        else:
+            self.tokens.append((LITERAL, s))
+
+    def _parse(self):
+        src = self.src
+        pos = 0
+
+        while pos < len(src):
+            m = _special.search(src, pos)
+            if not m:
+                self._literal(src[pos:])
+                break
+
+            i = m.start()
+            self._literal(src[pos:i])
+            ch = src[i]
+            nxt = src[i+1] if i + 1 < len(src) else ''
+
+            if ch == '\\':
+                if nxt in ['$', '@']:
+                    self._literal(nxt)
+                    pos = i + 2
+                else:
+                    self._literal(ch)
+                    pos = i + 1
+                continue
+
+            if ch == '$' and nxt == '{':
+                end = src.find('}', i + 2)
+                if end > -1:
+                    name = src[i+2:end]
+                    if _varname.match(name):
+                        if name[-1] == '?':
+                            self.tokens.append((VAR, name[:-1], True))
+                        else:
+                            self.tokens.append((VAR, name, False))
+                        pos = end + 1
+                        continue
+                    if _numarg.match(name):
+                        self.tokens.append((NUMARG, int(name), src[i:end+1]))
+                        pos = end + 1
+                        continue
+
+            elif ch == '$' and nxt in ['<', '>']:
+                m = _digits.match(src, i + 2)
+                num = int(m.group(0)) if m.group(0) else None
+                self.tokens.append((INPUT if nxt == '<' else OUTPUT, num, src[i:m.end()]))
+                pos = m.end()
+                continue
+
+            elif ch == '$' and (nxt == '(' or src[i+1:i+3] == '!('):
+                # $!(...) marks a shell-out that should never be cached
+                start = i + 2 if nxt == '(' else i + 3
+                end = _find_close(src, start, '(', ')')
+                if end > -1:
+                    cmd = Template(src[start:end])
+                    self.tokens.append((SHELL, cmd, nxt == '('))
+                    self.has_shell = True
+                    self.volatile = self.volatile or nxt != '(' or cmd.volatile
+                    pos = end + 1
+                    continue
+
+            elif ch == '@' and nxt == '{':
+                end = _find_close(src, i + 2, '{', '}')
+                if end > -1:
+                    inner = src[i+2:end]
+                    if _varname.match(inner) and inner[-1] != '?':
+                        self.tokens.append((ARRAY, inner))
+                        pos = end + 1
+                        continue
+
+                    m = _range.match(inner)
+                    if m:
+                        self.tokens.append((RANGE, Template(m.group(1)), Template(m.group(2))))
+                        pos = end + 1
+                        continue
+
+            self._literal(ch)
+            pos = i + 1
+
+    def bind(self, context, keep=()):
+        '''
+        Returns a copy of the template where the ${var} references that can
+        be found in the context are replaced with their values. Variables in
+        keep (and any that can't be found) are left as they are. If nothing
+        could be replaced, the template itself is returned.
+        '''
+        tokens = []
+        changed = False
+        for tok in self.tokens:
+            kind = tok[0]
+            if kind == VAR and not tok[1] in keep:
+                val = context.get(tok[1])
+                if val is not None:
+                    if type(val) == list:
+                        val = ' '.join([str(x) for x in val])
+                    tok = (LITERAL, '%s' % val)
+                    changed = True
+
+            elif kind == SHELL:
+                cmd = tok[1].bind(context, keep)
+                if cmd is not tok[1]:
+                    tok = (SHELL, cmd, tok[2])
+                    changed = True
+
+            elif kind == RANGE:
+                frm = tok[1].bind(context, keep)
+                to = tok[2].bind(context, keep)
+                if frm is not tok[1] or to is not tok[2]:
+                    tok = (RANGE, frm, to)
+                    changed = True
+
+            if tok[0] == LITERAL and tokens and tokens[-1][0] == LITERAL:
+                tokens[-1] = (LITERAL, tokens[-1][1] + tok[1])
+            else:
+                tokens.append(tok)
+
+        if not changed:
+            return self
+
+        tmpl = Template.__new__(Template)
+        tmpl.src = self.src
+        tmpl.tokens = tokens
+        tmpl.has_shell = self.has_shell
+        tmpl.volatile = self.volatile
+        return tmpl
+
+    def render(self, context, numargs=None, allow_missing=False):
+        return self.start(context, numargs, allow_missing).get()
+
+    def start(self, context, numargs=None, allow_missing=False):
+        '''
+        Renders everything except for the output of shell-outs, which are
+        dispatched with context.shell_async(). The shell-outs are joined when
+        get() is called on the returned value.
+        '''
+        out = []
+        shells = []
+        expansions = False
+
+        if not numargs:
+            numargs = context.var_numargs
+
+        for tok in self.tokens:
+            kind = tok[0]
+            if kind == LITERAL:
+                out.append(tok[1])
+
+            elif kind == VAR:
+                val = context.get(tok[1])
+                if val is None:
+                    if not allow_missing and not tok[2]:
+                        raise mvpipe.ParseError("Variable \"%s\" not found!" % tok[1])
+                    val = ''
+                elif type(val) == list:
+                    val = ' '.join([str(x) for x in val])
+                out.append('%s' % val)
+
+            elif kind == ARRAY:
+                val = context.get(tok[1])
+                if val is None:
+                    raise mvpipe.ParseError("Variable \"%s\" not found!" % tok[1])
+                if type(val) != list:
+                    val = [val,]
+                out.append(_Expansion(val))
+                expansions = True
+
+            elif kind == RANGE:
+                frm = mvpipe.support.autotype(tok[1].render(context, numargs))
+                to = mvpipe.support.autotype(tok[2].render(context, numargs))
+
+                if type(frm) != int:
+                    raise mvpipe.ParseError("Invalid range start \"%s\"!" % frm)
+                if type(to) != int:
+                    raise mvpipe.ParseError("Invalid range end \"%s\"!" % to)
+
+                out.append(_Expansion(range(frm, to+1)))
+                expansions = True
+
+            elif kind == NUMARG:
+                if not numargs:
+                    out.append(tok[2])
+                elif 0 < tok[1] <= len(numargs):
+                    out.append('%s' % numargs[tok[1]-1])
+                else:
+                    raise mvpipe.ParseError("Unknown num-arg: ${%s}" % tok[1])
+
+            elif kind == INPUT or kind == OUTPUT:
+                if kind == INPUT:
+                    vals = context.var_inputs
+                    label = 'input'
+                else:
+                    vals = context.var_outputs
+                    label = 'output'
+
+                if not vals:
+                    out.append(tok[2])
+                elif tok[1] is None:
+                    out.append(' '.join(vals))
+                elif 0 < tok[1] <= len(vals):
+                    out.append(vals[tok[1]-1])
+                else:
+                    raise mvpipe.ParseError("Unknown %s-num: %s" % (label, tok[2]))
+
+            elif kind == SHELL:
+                cmd = tok[1].render(context, numargs, allow_missing)
+                shells.append(len(out))
+                out.append(context.shell_async(cmd, tok[2]))
+
+        return _Rendered(out, shells, expansions)
+
+
+class _Rendered(object):
+    def __init__(self, pieces, shells, expansions):
+        self.pieces = pieces
+        self.shells = shells
+        self.expansions = expansions
+
+    def get(self):
+        out = self.pieces
+        for i in self.shells:
+            out[i] = out[i].get()
+
+        if self.expansions:
+            out = _expand(out)
+
+        return ''.join(out)
+
+
+def _expand(pieces):
+    '''
+    Resolve @{} expansions: foo_@{bar}_baz => foo_bar1_baz foo_bar2_baz ...
+
+    The prefix is taken from the already resolved text (including prior
+    expansions) and the suffix from the literal text that follows.
+    '''
+    out = []
+    for i, piece in enumerate(pieces):
+        if not isinstance(piece, _Expansion):
+            if piece:
+                out.append(piece)
+            continue
+
+        prefix = []
+        while out:
+            last = out[-1]
+            j = len(last)
+            while j > 0 and last[j-1] in _context_chars:
+                j -= 1
+            if j == len(last):
+                break
+            prefix.insert(0, last[j:])
+            if j > 0:
+                out[-1] = last[:j]
+                break
+            out.pop()
+        prefix = ''.join(prefix)
+
+        suffix = []
+        k = i + 1
+        while k < len(pieces) and not isinstance(pieces[k], _Expansion):
+            nxt = pieces[k]
+            j = 0
+            while j < len(nxt) and nxt[j] in _context_chars:
+                j += 1
+            suffix.append(nxt[:j])
+            pieces[k] = nxt[j:]
+            if j < len(nxt):
+                break
+            k += 1
+        suffix = ''.join(suffix)
+
+        out.append(' '.join(['%s%s%s' % (prefix, v, suffix) for v in piece.vals]))
+
+    return out
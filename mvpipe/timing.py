@@ -0,0 +1,175 @@
+'''
+Phase timing for planning runs (mvpipe -profile / mvsub -profile)
+
+The hot paths (parsing, includes, variable substitution, shell-outs, file
+checks, job-id checks and job submission) are wrapped while profiling is on,
+so there is no overhead for normal runs. For each phase, the number of calls,
+the total time and the p50/p99/max time per call are kept. Phases are
+inclusive: the time spent in an include is also part of "parse", and the time
+for a shell-out is also part of the "substitute" call that started it. A
+phase that is re-entered (for example, _build for each input) is only timed
+for the outermost call.
+
+Python 2 doesn't have tracemalloc, so the memory numbers are the process
+high-water mark (ru_maxrss) at the end of each phase.
+'''
+import sys
+import json
+import math
+import time
+import array
+import resource
+import threading
+
+import mvpipe
+import support
+import template
+import shellcache
+
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.times = array.array('d')
+        self.total = 0.0
+        self.maxrss = 0
+
+    def add(self, secs, maxrss=None):
+        self.times.append(secs)
+        self.total += secs
+        if maxrss and maxrss > self.maxrss:
+            self.maxrss = maxrss
+
+    def summary(self):
+        times = sorted(self.times)
+        return {
+            'count': len(times),
+            'total_secs': round(self.total, 6),
+            'p50_secs': round(_percentile(times, 50), 6),
+            'p99_secs': round(_percentile(times, 99), 6),
+            'max_secs': round(times[-1], 6) if times else 0,
+            'maxrss_kb': self.maxrss,
+        }
+
+
+class Profiler(object):
+    def __init__(self):
+        self.phases = {}
+        self.start = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._patched = []
+
+    def _active(self):
+        if not hasattr(self._local, 'active'):
+            self._local.active = set()
+        return self._local.active
+
+    def record(self, name, secs, maxrss=None):
+        with self._lock:
+            if not name in self.phases:
+                self.phases[name] = Phase(name)
+            self.phases[name].add(secs, maxrss)
+
+    def wrap(self, obj, attr, name, nested=None, rss=True):
+        '''
+        Replaces obj.attr (a function or method) with a timed version. If the
+        phase is already active in this thread, the call is timed as 'nested'
+        (or not at all, if nested isn't given).
+        '''
+        orig = getattr(obj, attr)
+        if isinstance(obj, type):
+            # keep the plain function, so it's re-bound to each instance
+            orig = orig.im_func
+        profiler = self
+
+        def timed(*args, **kwargs):
+            active = profiler._active()
+            phase = name
+            if name in active:
+                if not nested:
+                    return orig(*args, **kwargs)
+                phase = nested
+
+            active.add(phase)
+            start = time.time()
+            try:
+                return orig(*args, **kwargs)
+            finally:
+                secs = time.time() - start
+                active.discard(phase)
+                profiler.record(phase, secs, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if rss else None)
+
+        timed.__name__ = getattr(orig, '__name__', attr)
+        timed.__doc__ = getattr(orig, '__doc__', None)
+
+        self._patched.append((obj, attr, obj.__dict__.get(attr) if attr in obj.__dict__ else None))
+        setattr(obj, attr, timed)
+
+    def install(self):
+        '''
+        Instruments the loader, contexts and support functions
+        '''
+        self.wrap(mvpipe.PipelineLoader, 'load_file', 'parse', nested='include')
+        self.wrap(mvpipe.PipelineLoader, 'build', 'build')
+        self.wrap(mvpipe.PipelineLoader, '_build', 'plan')
+        self.wrap(mvpipe.PipelineLoader, 'check_jobid', 'check_jobid')
+        # all substitutions (directives, target bodies and bound recipes) are
+        # rendered by a Template
+        self.wrap(template.Template, 'render', 'substitute', rss=False)
+        self.wrap(template.Template, 'start', 'substitute', rss=False)
+        self.wrap(support, 'target_exists', 'target_exists', rss=False)
+        self.wrap(shellcache, 'execute', 'shell')
+
+    def install_runner(self, runner_inst):
+        self.wrap(runner_inst, 'submit', 'submit')
+        self.wrap(runner_inst, 'check_jobids', 'check_jobids')
+        self.wrap(runner_inst, 'done', 'runner_done')
+
+    def uninstall(self):
+        for obj, attr, orig in reversed(self._patched):
+            if orig is None:
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, orig)
+        self._patched = []
+
+    def summary(self):
+        phases = {}
+        for name in self.phases:
+            phases[name] = self.phases[name].summary()
+
+        return {
+            'argv': sys.argv,
+            'wall_secs': round(time.time() - self.start, 6),
+            'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'phases': phases,
+        }
+
+    def report(self, log):
+        '''
+        Writes the summary with the function 'log' (one line at a time)
+        '''
+        summary = self.summary()
+        log('Profile: %.3fs wall, %sK maxrss' % (summary['wall_secs'], summary['maxrss_kb']))
+        log('    %-16s %8s %10s %10s %10s %10s %10s' % ('phase', 'count', 'total', 'p50', 'p99', 'max', 'maxrss'))
+
+        phases = summary['phases']
+        for name in sorted(phases, key=lambda x: -phases[x]['total_secs']):
+            p = phases[name]
+            log('    %-16s %8s %9.3fs %9.6fs %9.6fs %9.6fs %9sK' % (name, p['count'], p['total_secs'], p['p50_secs'], p['p99_secs'], p['max_secs'], p['maxrss_kb']))
+
+    def write(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def _percentile(vals, pct):
+    '''
+    vals must be sorted (nearest-rank)
+    '''
+    if not vals:
+        return 0
+    idx = int(math.ceil(pct / 100.0 * len(vals))) - 1
+    return vals[max(0, min(idx, len(vals) - 1))]
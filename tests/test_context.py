@@ -0,0 +1,166 @@
+import unittest
+
+import mvpipe
+import mvpipe.context
+import mvpipe.directives
+
+
+def _run(src, initvals=None):
+    lines = [(i+1, line) for i, line in enumerate(src.split('\n')) if line]
+    ctx = mvpipe.context.RootContext(initvals)
+    mvpipe.directives.run(mvpipe.directives.compile_file(lines), ctx)
+    return ctx
+
+
+class ScopeTest(unittest.TestCase):
+    def test_snapshot(self):
+        scope = mvpipe.context.Scope({'a': 1, 'b': 2})
+        snap = scope.snapshot()
+
+        # changes to the scope aren't seen by the snapshot
+        scope['a'] = 10
+        scope['c'] = 3
+        del scope['b']
+        self.assertEqual(snap.flatten(), {'a': 1, 'b': 2})
+        self.assertEqual(scope.flatten(), {'a': 10, 'c': 3})
+        self.assertFalse('b' in scope)
+        self.assertRaises(KeyError, scope.__getitem__, 'b')
+        self.assertEqual(scope.get('b', 'x'), 'x')
+
+        # the snapshot is the scope's base, and is shared (not copied)
+        self.assertTrue(scope.base is snap)
+        self.assertEqual(scope.vals, {'a': 10, 'c': 3, 'b': mvpipe.context._Unset})
+
+    def test_snapshot_unchanged(self):
+        scope = mvpipe.context.Scope({'a': 1})
+        snap = scope.snapshot()
+        self.assertTrue(scope.snapshot() is snap)
+        self.assertTrue(scope.snapshot() is snap)
+
+        scope['a'] = 2
+        snap2 = scope.snapshot()
+        self.assertTrue(snap2.base is snap)
+        self.assertEqual(snap2.vals, {'a': 2})
+        self.assertEqual((snap['a'], snap2['a'], scope['a']), (1, 2, 2))
+
+    def test_append(self):
+        scope = mvpipe.context.Scope({'l': ['a']})
+        snap = scope.snapshot()
+
+        # the first scope to append to a frozen list keeps appending to it
+        scope.append('l', 'b')
+        other = mvpipe.context.Scope(None, snap)
+        other.append('l', 'c')
+        self.assertTrue(scope.vals['l'] is snap.vals['l'].items)
+        self.assertFalse(other.vals['l'] is scope.vals['l'])
+        self.assertEqual((snap['l'], scope['l'], other['l']), (['a'], ['a', 'b'], ['a', 'c']))
+
+        scope.append('x', 1)
+        scope.append('x', 2)
+        scope['y'] = 1
+        scope.append('y', 2)
+        self.assertEqual((scope['x'], scope['y']), ([1, 2], [1, 2]))
+
+    def test_max_depth(self):
+        scope = mvpipe.context.Scope()
+        snaps = []
+        for i in xrange(mvpipe.context.MAX_DEPTH * 2):
+            scope['v%s' % i] = i
+            snaps.append(scope.snapshot())
+            self.assertTrue(snaps[-1].depth < mvpipe.context.MAX_DEPTH)
+
+        for i, snap in enumerate(snaps):
+            self.assertEqual(snap.flatten(), dict([('v%s' % j, j) for j in xrange(i+1)]))
+
+
+class ExecContextTest(unittest.TestCase):
+    def test_scopes(self):
+        ctx = mvpipe.context.ExecContext({'a': 1})
+        ctx.push({'b': 2})
+        ctx.set('a', 10)
+        ctx.set('c', 3)
+        self.assertEqual(ctx.scopes[0].flatten(), {'a': 10})
+        self.assertEqual(ctx.scopes[1].flatten(), {'b': 2, 'c': 3})
+
+        ctx.pop()
+        self.assertEqual((ctx.get('a'), ctx.get('b'), ctx.get('c')), (10, None, None))
+
+    def test_set_ine(self):
+        ctx = mvpipe.context.ExecContext({'a': 1})
+        ctx.set_ine('a', 2)
+        ctx.set_ine('b', 2)
+        self.assertEqual((ctx.get('a'), ctx.get('b')), (1, 2))
+
+    def test_snapshot(self):
+        ctx = mvpipe.context.ExecContext({'a': 1})
+        ctx.append('l', 'x')
+        snap = ctx.snapshot()
+        ctx.set('a', 2)
+        ctx.unset('l')
+        self.assertEqual(snap[0].flatten(), {'a': 1, 'l': ['x']})
+        self.assertEqual(ctx.scopes[0].flatten(), {'a': 2})
+
+    def test_append_snapshot(self):
+        # appending to a list from a snapshot doesn't change the snapshot
+        ctx = mvpipe.context.ExecContext()
+        ctx.append('l', 'x')
+        snap = ctx.snapshot()
+        ctx.append('l', 'y')
+        ctx.append('l', 'z')
+        self.assertEqual(snap[0]['l'], ['x'])
+        self.assertEqual(ctx.get('l'), ['x', 'y', 'z'])
+
+
+class DirectivesTest(unittest.TestCase):
+    def test_for(self):
+        ctx = _run('#$ total = \n#$ for i in 1..3\n#$ total = ${total}${i}\n#$ last = ${i}\n#$ done\n')
+        self.assertEqual(ctx.get('total'), 123)
+        self.assertEqual(ctx.get('i'), None)
+        self.assertEqual(ctx.get('last'), None)
+
+    def test_if(self):
+        src = '#$ if ${a} == 1\n#$ b = $(false)${missing}\n#$ else\n#$ b = 2\n#$ endif\n'
+        self.assertEqual(_run(src, {'a': 2}).get('b'), 2)
+        self.assertRaises(mvpipe.ParseError, _run, src, {'a': 1})
+
+    def test_errors(self):
+        try:
+            _run('#$ a = 1\n#$ b = ${missing}\n')
+        except mvpipe.ParseError, e:
+            self.assertEqual(e.lineno, 2)
+        else:
+            self.fail()
+
+        self.assertRaises(mvpipe.ParseError, _run, '#$ for i in 1..2\n')
+        self.assertRaises(mvpipe.ParseError, _run, '#$ if ${a}\n')
+        self.assertRaises(mvpipe.ParseError, _run, '#$ foo\n')
+
+    def test_targets(self):
+        # targets capture the variables as they were when they were defined
+        ctx = _run('#$ a = 1\nout1: in\n    echo ${a}\n#$ a = 2\nout2: in\n    echo ${a}\n')
+        self.assertEqual([tgt.get('a') for tgt in ctx._targets], [1, 2])
+        self.assertEqual(ctx.get('a'), 2)
+
+        ctx = _run('#$ l += a\nout1: in\n    echo ${l}\n#$ l += b\nout2: in\n    echo ${l}\n')
+        self.assertEqual([tgt.get('l') for tgt in ctx._targets], [['a'], ['a', 'b']])
+
+    def test_append_loop(self):
+        # a loop that appends to a list and defines a target each time
+        # doesn't copy the list for each target
+        n = 100
+        ctx = _run('#$ l = []\n#$ for i in 1..%s\n#$ l += ${i}\nout${i}: in\n    echo\n#$ done\n' % n)
+        self.assertEqual(len(ctx._targets), n)
+
+        frozen = [tgt.scopes[0]._find('l').vals['l'] for tgt in ctx._targets]
+        self.assertEqual([val.size for val in frozen], range(1, n+1))
+        self.assertEqual(len(set([id(val.items) for val in frozen])), 1)
+
+        self.assertEqual([tgt.get('l') for tgt in ctx._targets], [range(1, i+1) for i in xrange(1, n+1)])
+        self.assertEqual(ctx.get('l'), range(1, n+1))
+
+    def test_compile_recipe(self):
+        lines = ['#$ if ${a}', 'echo ${a}', '#$ endif']
+        self.assertTrue(mvpipe.directives.compile_recipe(lines) is mvpipe.directives.compile_recipe(list(lines)))
+        self.assertEqual(mvpipe.directives.assigned(mvpipe.directives.compile_recipe(['#$ for i in ${l}', '#$ x = 1', '#$ done'])), set(['i', 'x']))
+        self.assertTrue(mvpipe.directives.volatile(mvpipe.directives.compile_recipe(['#$ x = $!(date)'])))
+        self.assertFalse(mvpipe.directives.volatile(mvpipe.directives.compile_recipe(['echo $(date)'])))
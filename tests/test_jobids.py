@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mvpipe.runner
+import mvpipe.runner.sge
+import mvpipe.runner.slurm
+
+
+class JobidTest(unittest.TestCase):
+    def test_split_jobid(self):
+        self.assertEqual(mvpipe.runner.split_jobid('123_5'), ('123', 5))
+        self.assertEqual(mvpipe.runner.split_jobid('123'), ('123', None))
+        self.assertEqual(mvpipe.runner.split_jobid('testjob.1'), ('testjob.1', None))
+
+    def test_numeric_jobid(self):
+        self.assertTrue(mvpipe.runner.numeric_jobid('123'))
+        self.assertTrue(mvpipe.runner.numeric_jobid('123_5'))
+        self.assertFalse(mvpipe.runner.numeric_jobid('testjob.1'))
+        self.assertFalse(mvpipe.runner.numeric_jobid('testjob.1_2'))
+
+    def test_expand_tasks(self):
+        self.assertEqual(mvpipe.runner.expand_tasks('3'), set([3]))
+        self.assertEqual(mvpipe.runner.expand_tasks('1-4'), set([1, 2, 3, 4]))
+        self.assertEqual(mvpipe.runner.expand_tasks('[1-3,5,7-8%2]'), set([1, 2, 3, 5, 7, 8]))
+        self.assertEqual(mvpipe.runner.expand_tasks('4-10:2'), set([4, 6, 8, 10]))
+
+
+class FakeScheduler(object):
+    '''
+    Puts a fake scheduler command first in the PATH
+    '''
+    def __init__(self, name, stdout, returncode=0):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, 'stdout'), 'w') as f:
+            f.write(stdout)
+        fname = os.path.join(self.tmpdir, name)
+        with open(fname, 'w') as f:
+            f.write('#!/bin/sh\ncat "%s"\nexit %s\n' % (os.path.join(self.tmpdir, 'stdout'), returncode))
+        os.chmod(fname, 0755)
+
+    def __enter__(self):
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (self.tmpdir, self.path)
+        return self
+
+    def __exit__(self, *args):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmpdir)
+
+
+_sacct = '''\
+100|COMPLETED|0:0
+101_1|COMPLETED|0:0
+101_2|FAILED|1:0
+101_[3-5,7]|PENDING|0:0
+'''
+
+_qstat = '''\
+<?xml version='1.0'?>
+<job_info>
+  <queue_info>
+    <job_list state="running"><JB_job_number>201</JB_job_number><tasks>2</tasks></job_list>
+    <job_list state="running"><JB_job_number>300</JB_job_number></job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending"><JB_job_number>201</JB_job_number><tasks>4-8:2</tasks></job_list>
+  </job_info>
+</job_info>
+'''
+
+
+class CheckJobidsTest(unittest.TestCase):
+    def test_slurm(self):
+        runner = mvpipe.runner.slurm.SlurmRunner(dryrun=True, verbose=False, logger=None, runtime_dir=None)
+        with FakeScheduler('sacct', _sacct):
+            valid = runner.check_jobids(['100', '101_1', '101_2', '101_4', '101_6', '101_7', '102'])
+        self.assertEqual(valid, {'100': True, '101_1': True, '101_2': False, '101_4': True, '101_6': False, '101_7': True, '102': False})
+
+    def test_slurm_error(self):
+        runner = mvpipe.runner.slurm.SlurmRunner(dryrun=True, verbose=False, logger=None, runtime_dir=None)
+        with FakeScheduler('sacct', '', 1):
+            self.assertRaises(RuntimeError, runner.check_jobids, ['100'])
+
+    def test_slurm_dryrun_ids(self):
+        # ids from dry runs are invalid, and aren't sent to sacct (which
+        # would fail on them)
+        runner = mvpipe.runner.slurm.SlurmRunner(dryrun=True, verbose=False, logger=None, runtime_dir=None)
+        with FakeScheduler('sacct', '', 1):
+            self.assertEqual(runner.check_jobids(['testjob.1', 'testjob.2_1']), {'testjob.1': False, 'testjob.2_1': False})
+        with FakeScheduler('sacct', _sacct):
+            self.assertEqual(runner.check_jobids(['100', 'testjob.1']), {'100': True, 'testjob.1': False})
+
+    def test_sge(self):
+        runner = mvpipe.runner.sge.SGERunner(dryrun=True, verbose=False, logger=None, runtime_dir=None)
+        with FakeScheduler('qstat', _qstat):
+            valid = runner.check_jobids(['201_2', '201_3', '201_6', '300', '301'])
+        self.assertEqual(valid, {'201_2': True, '201_3': False, '201_6': True, '300': True, '301': False})
+
+    def test_sge_fallback(self):
+        runner = mvpipe.runner.sge.SGERunner(dryrun=True, verbose=False, logger=None, runtime_dir=None)
+        with FakeScheduler('qstat', 'Following jobs do not exist:\n301\n', 1):
+            self.assertEqual(runner.check_jobid('301_1'), False)
+        with FakeScheduler('qstat', 'error: unable to contact qmaster\n', 1):
+            self.assertRaises(RuntimeError, runner.check_jobid, '301_1')
+            self.assertEqual(runner.check_jobid('testjob.1'), False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+import gc
+import unittest
+
+import mvpipe.runner
+from mvpipe.runner import Job, JobArray
+
+
+def _jobs(rule, n, **kwargs):
+    return [Job('gzip f%s' % i, outputs=['f%s.gz' % i], rule=rule, **kwargs) for i in xrange(1, n+1)]
+
+
+class JobArgsTest(unittest.TestCase):
+    def test_intern(self):
+        a = Job('echo', mem='1G', procs=2)
+        b = Job('echo', procs=2, mem='1G')
+        c = Job('echo', mem='2G')
+        self.assertTrue(a.args is b.args)
+        self.assertFalse(a.args is c.args)
+        self.assertEqual(a.args, {'mem': '1G', 'procs': 2})
+
+        # settings are dropped once no job uses them
+        key = mvpipe.runner._args_key(c.args)
+        self.assertTrue(key in mvpipe.runner._interned_args)
+        del c
+        gc.collect()
+        self.assertFalse(key in mvpipe.runner._interned_args)
+
+    def test_merge_options(self):
+        defaults = {'mem': '1G', 'wd': '.'}
+        runner = mvpipe.runner.Runner(dryrun=True, verbose=False)
+        a = Job('echo', mem='2G')
+        b = Job('echo', mem='2G')
+        opts = runner.merge_options(defaults, a.args)
+        self.assertEqual(opts, {'mem': '2G', 'wd': '.'})
+        self.assertTrue(runner.merge_options(defaults, b.args) is opts)
+
+        # the options are merged again for each runner (build)
+        other = mvpipe.runner.Runner(dryrun=True, verbose=False)
+        self.assertFalse(other.merge_options(defaults, a.args) is opts)
+        self.assertEqual(other.merge_options({'wd': '/'}, a.args), {'mem': '2G', 'wd': '/'})
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_groups(self):
+        rule1 = object()
+        rule2 = object()
+        a = _jobs(rule1, 3)
+        b = _jobs(rule2, 2)
+        other = Job('echo')
+        out = mvpipe.runner.coalesce([a[0], b[0], other, a[1], b[1], a[2]], 'TASK')
+
+        # each group keeps the place of its first job
+        self.assertEqual(len(out), 3)
+        self.assertTrue(isinstance(out[0], JobArray))
+        self.assertEqual(out[0].jobs, a)
+        self.assertEqual(out[1].jobs, b)
+        self.assertTrue(out[2] is other)
+        self.assertEqual([job.array_index for job in a], [1, 2, 3])
+        self.assertTrue(a[0].array is out[0])
+
+    def test_settings(self):
+        # jobs from the same rule are only grouped if their settings match
+        rule = object()
+        a = _jobs(rule, 2, mem='1G')
+        b = _jobs(rule, 2, mem='2G')
+        single = Job('echo', rule=rule, mem='3G')
+        direct = Job('echo', rule=rule, mem='1G', **{'exec': True})
+        out = mvpipe.runner.coalesce([a[0], b[0], a[1], b[1], single, direct], 'TASK')
+        self.assertEqual([x.jobs if isinstance(x, JobArray) else x for x in out], [a, b, single, direct])
+        self.assertEqual(direct.array, None)
+
+    def test_max_size(self):
+        jobs = _jobs(object(), 5)
+        out = mvpipe.runner.coalesce(jobs, 'TASK', max_size=2)
+        self.assertEqual([len(x) if isinstance(x, JobArray) else 1 for x in out], [2, 2, 1])
+
+
+class JobArrayTest(unittest.TestCase):
+    def test_jobids(self):
+        arr = JobArray(_jobs(object(), 2), 'TASK')
+        arr.set_jobid('10')
+        self.assertEqual([job.jobid for job in arr.jobs], ['10_1', '10_2'])
+        self.assertEqual(arr.src, 'task_${TASK}')
+        self.assertEqual(arr.outputs, [])
+
+        table = arr.table()
+        self.assertTrue('task_1() {\ngzip f1\n}' in table)
+        self.assertTrue('cleanup_2() {\n  :\n  if [ -e "f2.gz" ]; then rm "f2.gz"; fi\n}' in table)
+
+    def test_aligned(self):
+        rule = object()
+        up = JobArray(_jobs(rule, 3), 'TASK')
+        up.set_jobid('10')
+
+        down = _jobs(object(), 3)
+        for i, job in enumerate(down):
+            job.add_deps([up.jobs[i], '5'])
+        arr = JobArray(down, 'TASK')
+
+        upstream, depids = arr.aligned()
+        self.assertTrue(upstream is up)
+        self.assertEqual(depids, ['5'])
+
+    def test_not_aligned(self):
+        up = JobArray(_jobs(object(), 3), 'TASK')
+        up.set_jobid('10')
+
+        # tasks depend on a different index
+        down = _jobs(object(), 3)
+        for i, job in enumerate(down):
+            job.add_dep(up.jobs[2-i])
+        self.assertEqual(JobArray(down, 'TASK').aligned(), None)
+
+        # the other dependencies aren't shared by all of the tasks
+        down = _jobs(object(), 3)
+        for i, job in enumerate(down):
+            job.add_dep(up.jobs[i])
+        down[0].add_dep('5')
+        self.assertEqual(JobArray(down, 'TASK').aligned(), None)
+
+        # the arrays are different sizes
+        down = _jobs(object(), 2)
+        for i, job in enumerate(down):
+            job.add_dep(up.jobs[i])
+        self.assertEqual(JobArray(down, 'TASK').aligned(), None)
+
+        # the upstream array hasn't been submitted
+        up2 = JobArray(_jobs(object(), 2), 'TASK')
+        down = _jobs(object(), 2)
+        for i, job in enumerate(down):
+            job.add_dep(up2.jobs[i])
+        self.assertEqual(JobArray(down, 'TASK').aligned(), None)
+
+        # no upstream array
+        self.assertEqual(JobArray(_jobs(object(), 2), 'TASK').aligned(), None)
+
+
+def _graph():
+    '''
+    Two samples with an align -> sort chain each, a merge of both, and a
+    job-id from an earlier run that the first align depends on
+    '''
+    align1 = Job('align 1', name='align1')
+    align2 = Job('align 2', name='align2')
+    sort1 = Job('sort 1', name='sort1', depends=[align1])
+    sort2 = Job('sort 2', name='sort2', depends=[align2])
+    merge = Job('merge', name='merge', depends=[sort1, sort2])
+    align1.add_dep('99')
+    return mvpipe.runner.JobGraph.from_job(merge), (align1, align2, sort1, sort2, merge)
+
+
+class JobGraphTest(unittest.TestCase):
+    def test_edges(self):
+        graph, (align1, align2, sort1, sort2, merge) = _graph()
+        self.assertEqual(len(graph), 6)
+        self.assertEqual(set(graph.roots()), set(['99', align2]))
+        self.assertEqual(graph.leaves(), [merge])
+        self.assertEqual(set(graph.deps(merge)), set([sort1, sort2]))
+        self.assertEqual(graph.dependents(align1), [sort1])
+        self.assertEqual(set(graph.ancestors(sort1)), set([sort1, align1, '99']))
+        self.assertEqual(set(graph.descendants(align2)), set([align2, sort2, merge]))
+
+        sub = graph.subgraph([align1, sort1])
+        self.assertEqual(sub.roots(), [align1])
+        self.assertEqual(sub.deps(sort1), [align1])
+
+    def test_order(self):
+        graph, jobs = _graph()
+        order = graph.order()
+        self.assertEqual(set(order), set(jobs + ('99',)))
+        for node in order:
+            if type(node) != str:
+                for dep in graph.deps(node):
+                    self.assertTrue(order.index(dep) < order.index(node))
+
+        self.assertTrue(order[-1] is jobs[4])
+        self.assertEqual(jobs[4].flatten(), order)
+
+    def test_layers(self):
+        graph, (align1, align2, sort1, sort2, merge) = _graph()
+        layers = [set(layer) for layer in graph.layers()]
+        self.assertEqual(layers, [set([align1, align2]), set([sort1, sort2]), set([merge])])
+
+    def test_depth_first(self):
+        graph, (align1, align2, sort1, sort2, merge) = _graph()
+        order = [x for x in graph.depth_first() if type(x) != str]
+
+        # each chain is finished before the next one starts
+        self.assertEqual(abs(order.index(align1) - order.index(sort1)), 1)
+        self.assertEqual(abs(order.index(align2) - order.index(sort2)), 1)
+        self.assertEqual(order[-1], merge)
+
+    def test_priorities(self):
+        graph, (align1, align2, sort1, sort2, merge) = _graph()
+
+        breadth = graph.priorities('breadth')
+        self.assertEqual((breadth[align1], breadth[sort1], breadth[merge]), (1.0, 0.5, 0.0))
+        self.assertEqual(breadth[align1], breadth[align2])
+        self.assertFalse('99' in breadth)
+
+        # the priorities follow the depth-first order
+        depth = graph.priorities('depth')
+        order = [x for x in graph.depth_first() if type(x) != str]
+        self.assertEqual([depth[job] for job in order], sorted(depth.values(), reverse=True))
+        self.assertEqual((depth[order[0]], depth[merge]), (1.0, 0.0))
+
+        # without walltimes, each job counts the same
+        critical = graph.priorities('critical')
+        self.assertEqual((critical[align1], critical[sort1], critical[merge]), (1.0, 0.5, 0.0))
+
+        self.assertRaises(ValueError, graph.priorities, 'random')
+
+    def test_critical_path(self):
+        align1 = Job('align 1', walltime='1:00:00')
+        align2 = Job('align 2', walltime='10:00')
+        sort2 = Job('sort 2', walltime='10:00', depends=[align2])
+        merge = Job('merge', depends=[align1, sort2])
+        graph = mvpipe.runner.JobGraph.from_job(merge)
+
+        duration = mvpipe.runner.estimate_durations(graph.nodes)
+        self.assertEqual(duration(align1), 3600)
+        self.assertEqual(duration(merge), (3600 + 600 + 600) / 3.0)
+
+        length = graph.critical_path(duration)
+        self.assertEqual(length[align1], 3600 + duration(merge))
+        self.assertEqual(length[align2], 1200 + duration(merge))
+
+        critical = graph.priorities('critical')
+        self.assertEqual(critical[align1], 1.0)
+        self.assertEqual(critical[merge], 0.0)
+        self.assertTrue(critical[align2] < critical[align1])
+
+        # an array has the priority of its most urgent task
+        arr = JobArray([align1, align2], 'TASK')
+        for job, priority in critical.items():
+            job.priority = priority
+        self.assertEqual(arr.priority, 1.0)
+
+    def test_cycle(self):
+        graph = mvpipe.runner.JobGraph()
+        graph.add_dep('a', 'b')
+        graph.add_dep('b', 'a')
+        self.assertRaises(ValueError, graph.order)
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mvpipe.manifest
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'outfile.manifest')
+        self.inp = self._write('in.txt', 'one\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, contents, mtime=None):
+        fname = os.path.join(self.tmpdir, name)
+        with open(fname, 'w') as f:
+            f.write(contents)
+        if mtime is not None:
+            os.utime(fname, (mtime, mtime))
+        return fname
+
+    def test_changed(self):
+        manifest = mvpipe.manifest.Manifest(self.fname)
+        self.assertEqual(manifest.changed('out.txt', [self.inp], 'cat in.txt'), None)
+
+        manifest.record(['out.txt'], [self.inp, 'missing.txt'], 'cat in.txt')
+        self.assertEqual(manifest.changed('out.txt', [self.inp], 'cat in.txt'), None)
+        self.assertEqual(manifest.changed('out.txt', [self.inp], 'sort in.txt'), 'recipe changed')
+
+        self._write('in.txt', 'two\n', 1)
+        self.assertEqual(manifest.changed('out.txt', [self.inp], 'cat in.txt'), 'input changed: %s' % self.inp)
+
+    def test_save(self):
+        manifest = mvpipe.manifest.Manifest(self.fname)
+        manifest.record(['a.txt', 'b.txt'], [self.inp], 'cat in.txt')
+        manifest.save()
+
+        manifest = mvpipe.manifest.Manifest(self.fname)
+        self.assertEqual(manifest.changed('a.txt', [self.inp], 'cat in.txt'), None)
+        self.assertEqual(manifest.changed('b.txt', [self.inp], 'cat'), 'recipe changed')
+        self.assertEqual(sorted(manifest._files), [self.inp])
+        self.assertFalse(manifest._dirty)
+
+    def test_file_hash(self):
+        # whole-second mtimes, so that they are the same after os.utime
+        self._write('in.txt', 'one\n', 1000)
+        manifest = mvpipe.manifest.Manifest(self.fname)
+        h = manifest.file_hash(self.inp)
+        self.assertEqual(h, mvpipe.manifest.hash_file(self.inp))
+        self.assertEqual(manifest.file_hash(os.path.join(self.tmpdir, 'missing')), None)
+        self.assertEqual(manifest.file_hash(self.tmpdir), None)
+
+        # the file isn't re-read if its size and mtime are the same
+        self._write('in.txt', 'two\n', 1000)
+        self.assertEqual(manifest.file_hash(self.inp), h)
+
+        self._write('in.txt', 'three\n', 1000)
+        self.assertNotEqual(manifest.file_hash(self.inp), h)
+
+    def test_newer_input(self):
+        out = self._write('out.txt', '', 100)
+        old = self._write('old.txt', '', 50)
+        new = self._write('new.txt', '', 200)
+        self.assertEqual(mvpipe.manifest.newer_input(out, [old, 'missing', new]), new)
+        self.assertEqual(mvpipe.manifest.newer_input(out, [old]), None)
+        self.assertEqual(mvpipe.manifest.newer_input('missing', [new]), None)
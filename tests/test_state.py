@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mvpipe.state
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.tmpdir, 'outfile')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _history(self, store):
+        return store.conn.execute('SELECT output, jobid FROM history ORDER BY id').fetchall()
+
+    def test_import(self):
+        with open(self.outfile, 'w') as f:
+            f.write('a.txt\t100\nb.txt\t101\na.txt\t102\n\n')
+
+        store = mvpipe.state.open_store(self.outfile)
+        try:
+            self.assertEqual(store.fname, '%s.db' % self.outfile)
+            self.assertEqual(store.get('a.txt'), '102')
+            self.assertEqual(store.get('b.txt'), '101')
+            self.assertEqual(store.get('c.txt'), None)
+            self.assertEqual(store.status('102'), 'submitted')
+            self.assertEqual(len(self._history(store)), 3)
+        finally:
+            store.close()
+
+        # the outfile is only imported when the database is created
+        with open(self.outfile, 'a') as f:
+            f.write('c.txt\t103\n')
+        store = mvpipe.state.open_store(self.outfile)
+        try:
+            self.assertEqual(store.get('c.txt'), None)
+        finally:
+            store.close()
+
+    def test_record(self):
+        store = mvpipe.state.open_store(self.outfile, batch=2)
+        try:
+            store.record('a.txt', '100', 'SGERunner', 'abc')
+            # pending records are seen before they are written
+            self.assertEqual(store.get('a.txt'), '100')
+            store.record('a.txt', '101', 'SGERunner', 'def')
+            store.record('b.txt', '101', 'SGERunner', 'def')
+            self.assertEqual(store.get('a.txt'), '101')
+            self.assertEqual(sorted(store.active_jobids()), ['101'])
+        finally:
+            store.close()
+
+        store = mvpipe.state.open_store(self.outfile)
+        try:
+            self.assertEqual(store.get('a.txt'), '101')
+            self.assertEqual([row[:2] for row in store.rows()], [('a.txt', '101'), ('b.txt', '101')])
+        finally:
+            store.close()
+
+    def test_status(self):
+        store = mvpipe.state.open_store(self.outfile)
+        try:
+            store.record('a.txt', '100')
+            store.record('b.txt', '101')
+            store.set_status('100', 'invalid')
+            store.set_status('101', 'valid')
+            self.assertEqual(store.status('100'), 'invalid')
+            self.assertEqual(store.active_jobids(), ['101'])
+        finally:
+            store.close()
+
+    def test_compact(self):
+        store = mvpipe.state.open_store(self.outfile)
+        try:
+            store.record('a.txt', '100')
+            store.record('b.txt', '100')
+            store.record('a.txt', '101')
+            store.record('a.txt', '102')
+            self.assertEqual(store.compact(), 2)
+            self.assertEqual(self._history(store), [('b.txt', '100'), ('a.txt', '102')])
+
+            # 101 doesn't build anything anymore
+            jobids = [row[0] for row in store.conn.execute('SELECT jobid FROM jobs ORDER BY jobid')]
+            self.assertEqual(jobids, ['100', '102'])
+            self.assertEqual(store.get('a.txt'), '102')
+        finally:
+            store.close()
+
+    def test_text_store(self):
+        with open(self.outfile, 'w') as f:
+            f.write('a.txt\t100\na.txt\t101\n')
+
+        store = mvpipe.state.TextStateStore(self.outfile)
+        self.assertEqual(store.get('a.txt'), '101')
+        store.record('b.txt', '102')
+        store.set_status('101', 'invalid')
+        self.assertEqual(store.active_jobids(), ['102'])
+
+        with open(self.outfile) as f:
+            self.assertEqual(f.read(), 'a.txt\t100\na.txt\t101\nb.txt\t102\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
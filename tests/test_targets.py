@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mvpipe
+import mvpipe.targetindex
+import mvpipe.runner.bash
+
+
+def _loader(src):
+    '''
+    Loads a pipeline (from a string) with a dry-run runner
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'Pipeline')
+        with open(fname, 'w') as f:
+            f.write(src)
+        runner_inst = mvpipe.runner.bash.BashRunner(dryrun=True, verbose=False, logger=None)
+        loader = mvpipe.PipelineLoader({}, runner_inst=runner_inst, dryrun=True)
+        loader.load_file(fname)
+        return loader
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _match(loader, target):
+    for tgt in loader.target_index.candidates(target):
+        match, numargs, outputs, wildcards = tgt.match_target(target)
+        if match:
+            return tgt, numargs, outputs, wildcards, tgt.eval_inputs(numargs, wildcards)
+    return None
+
+
+class ParseOutputTest(unittest.TestCase):
+    def test_literal(self):
+        regex, prefix, suffix, names = mvpipe.targetindex.parse_output('out.txt')
+        self.assertEqual(regex, None)
+        self.assertEqual((prefix, suffix, names), ('out.txt', 'out.txt', []))
+
+    def test_anonymous(self):
+        regex, prefix, suffix, names = mvpipe.targetindex.parse_output('%.bam')
+        self.assertEqual((prefix, suffix, names), ('', '.bam', []))
+        self.assertEqual(mvpipe.targetindex.match_output(regex, 'x.bam'), ('x', {}))
+        self.assertEqual(mvpipe.targetindex.match_output(regex, 'x.sam'), None)
+
+    def test_named(self):
+        regex, prefix, suffix, names = mvpipe.targetindex.parse_output('out/%{sample}.%{ref}.bam')
+        self.assertEqual((prefix, suffix, names), ('out/', '.bam', ['sample', 'ref']))
+        self.assertEqual(mvpipe.targetindex.match_output(regex, 'out/A.hg19.bam'), ('', {'sample': 'A', 'ref': 'hg19'}))
+
+    def test_repeated_name(self):
+        regex, prefix, suffix, names = mvpipe.targetindex.parse_output('%{s}/%{s}.bam')
+        self.assertEqual(mvpipe.targetindex.match_output(regex, 'A/A.bam'), ('', {'s': 'A'}))
+        self.assertEqual(mvpipe.targetindex.match_output(regex, 'A/B.bam'), None)
+
+    def test_named_before_anonymous(self):
+        regex, prefix, suffix, names = mvpipe.targetindex.parse_output('%{sample}.%.bam')
+        self.assertEqual(mvpipe.targetindex.match_output(regex, 'A.x.bam'), ('x', {'sample': 'A'}))
+
+    def test_anonymous_before_named(self):
+        regex, prefix, suffix, names = mvpipe.targetindex.parse_output('%.%{sample}.bam')
+        self.assertEqual(mvpipe.targetindex.match_output(regex, 'x.A.bam'), ('x', {'sample': 'A'}))
+
+    def test_two_anonymous(self):
+        self.assertRaises(mvpipe.ParseError, mvpipe.targetindex.parse_output, '%.%.bam')
+
+    def test_fill_output(self):
+        self.assertEqual(mvpipe.targetindex.fill_output('%{s}.%.bam', 'x', {'s': 'A'}), 'A.x.bam')
+
+
+class MatchTargetTest(unittest.TestCase):
+    def test_anonymous(self):
+        loader = _loader('%.bam: ${1}.fq\n    align $<\n')
+        tgt, numargs, outputs, wildcards, inputs = _match(loader, 'x.bam')
+        self.assertEqual(numargs, ['x'])
+        self.assertEqual(outputs, ['x.bam'])
+        self.assertEqual(wildcards, {})
+        self.assertEqual(inputs, ['x.fq'])
+
+    def test_named(self):
+        loader = _loader('%{sample}.bam: ${sample}.fq\n    align $<\n')
+        tgt, numargs, outputs, wildcards, inputs = _match(loader, 'A.bam')
+        self.assertEqual(numargs, [''])
+        self.assertEqual(outputs, ['A.bam'])
+        self.assertEqual(wildcards, {'sample': 'A'})
+        self.assertEqual(inputs, ['A.fq'])
+
+    def test_named_before_anonymous(self):
+        loader = _loader('%{sample}.%.bam: ${sample}.${1}.fq\n    align $<\n')
+        tgt, numargs, outputs, wildcards, inputs = _match(loader, 'A.x.bam')
+        self.assertEqual(numargs, ['x'])
+        self.assertEqual(outputs, ['A.x.bam'])
+        self.assertEqual(wildcards, {'sample': 'A'})
+        self.assertEqual(inputs, ['A.x.fq'])
+
+    def test_anonymous_before_named(self):
+        loader = _loader('%.%{sample}.bam: ${1}.${sample}.fq\n    align $<\n')
+        tgt, numargs, outputs, wildcards, inputs = _match(loader, 'x.A.bam')
+        self.assertEqual(numargs, ['x'])
+        self.assertEqual(outputs, ['x.A.bam'])
+        self.assertEqual(inputs, ['x.A.fq'])
+
+    def test_definition_order(self):
+        loader = _loader('%.bam: ${1}.fq\n    align $<\nspecial.bam:\n    make-special\n')
+        tgt, numargs, outputs, wildcards, inputs = _match(loader, 'special.bam')
+        self.assertEqual(str(tgt), '%.bam: ${1}.fq')
+
+        tgt, numargs, outputs, wildcards, inputs = _match(loader, 'other.bam')
+        self.assertEqual(inputs, ['other.fq'])
+
+    def test_no_match(self):
+        loader = _loader('%.bam: ${1}.fq\n    align $<\n')
+        self.assertEqual(_match(loader, 'x.vcf'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+import mvpipe
+import mvpipe.shellcache
+import mvpipe.template
+import mvpipe.context
+
+
+class _Context(mvpipe.context.ExecContext):
+    '''
+    A context that records the shell-outs instead of running them
+    '''
+    def __init__(self, initvals=None):
+        mvpipe.context.ExecContext.__init__(self, initvals)
+        self.shells = []
+
+    def shell_async(self, cmd, cache=True):
+        self.shells.append((cmd, cache))
+        return mvpipe.shellcache.Done('<%s>' % cmd)
+
+
+def _render(src, initvals=None, **kwargs):
+    return mvpipe.template.get_template(src).render(_Context(initvals), **kwargs)
+
+
+class TemplateTest(unittest.TestCase):
+    def test_vars(self):
+        self.assertEqual(_render('${foo}.txt', {'foo': 'bar'}), 'bar.txt')
+        self.assertEqual(_render('${foo}', {'foo': ['a', 'b']}), 'a b')
+        self.assertEqual(_render('${missing?}.txt'), '.txt')
+        self.assertRaises(mvpipe.ParseError, _render, '${missing}')
+        self.assertEqual(_render('${missing}', allow_missing=True), '')
+
+    def test_escapes(self):
+        self.assertEqual(_render('\\${foo} \\@{foo}', {'foo': 'bar'}), '${foo} @{foo}')
+        self.assertEqual(_render('a\\b'), 'a\\b')
+
+    def test_expansion(self):
+        vals = {'foo': ['a', 'b'], 'n': '3'}
+        self.assertEqual(_render('x_@{foo}.txt', vals), 'x_a.txt x_b.txt')
+        self.assertEqual(_render('a@{foo}b @{foo}', vals), 'aab abb a b')
+        self.assertEqual(_render('@{1..${n}}', vals), '1 2 3')
+        self.assertEqual(_render('in/@{foo}/out', {'foo': 'x'}), 'in/x/out')
+        self.assertRaises(mvpipe.ParseError, _render, '@{missing}')
+        self.assertRaises(mvpipe.ParseError, _render, '@{1..x}')
+
+    def test_empty_expansion(self):
+        # @{} (and anything else that isn't a name or a range) is literal
+        self.assertEqual(_render('@{}'), '@{}')
+        self.assertEqual(_render('@{ }'), '@{ }')
+        self.assertEqual(_render('a@{}b'), 'a@{}b')
+        self.assertEqual(_render('@{foo}', {'foo': []}), '')
+
+    def test_shell(self):
+        ctx = _Context({'foo': 'bar'})
+        tmpl = mvpipe.template.get_template('x $(echo ${foo}) y')
+        self.assertEqual(tmpl.render(ctx), 'x <echo bar> y')
+        self.assertEqual(ctx.shells, [('echo bar', True)])
+        self.assertTrue(tmpl.has_shell)
+        self.assertFalse(tmpl.volatile)
+
+    def test_nested_shell(self):
+        ctx = _Context()
+        tmpl = mvpipe.template.get_template('$(echo $(echo (hi)))')
+        self.assertEqual(tmpl.render(ctx), '<echo <echo (hi)>>')
+        self.assertEqual(ctx.shells, [('echo (hi)', True), ('echo <echo (hi)>', True)])
+
+        # an unclosed shell-out is left as-is
+        self.assertEqual(_render('$(echo'), '$(echo')
+
+    def test_volatile(self):
+        ctx = _Context()
+        tmpl = mvpipe.template.get_template('$!(date)')
+        self.assertEqual(tmpl.render(ctx), '<date>')
+        self.assertEqual(ctx.shells, [('date', False)])
+        self.assertTrue(tmpl.volatile)
+
+        # a volatile shell-out inside of a cached one makes the whole template volatile
+        ctx = _Context()
+        tmpl = mvpipe.template.get_template('$(echo $!(date))')
+        self.assertTrue(tmpl.volatile)
+        tmpl.render(ctx)
+        self.assertEqual(ctx.shells, [('date', False), ('echo <date>', True)])
+
+    def test_bind(self):
+        tmpl = mvpipe.template.get_template('${foo} ${1} $(cat ${bar}) ${baz}')
+        bound = tmpl.bind(_Context({'foo': 'a', 'bar': 'b'}), keep=('baz',))
+        self.assertEqual(bound.tokens[0], (mvpipe.template.LITERAL, 'a '))
+        self.assertEqual(bound.render(_Context({'baz': 'c'}), numargs=['x']), 'a x <cat b> c')
+
+        # nothing to replace
+        self.assertTrue(tmpl.bind(_Context()) is tmpl)
+
+    def test_cache(self):
+        self.assertTrue(mvpipe.template.get_template('${foo}') is mvpipe.template.get_template('${foo}'))